@@ -0,0 +1,66 @@
+#################################################################################
+#
+#             Project Title:  Benchmark embedding lookup steps
+#             Date:           2022-06-12
+#
+#################################################################################
+
+
+#################################################################################
+#   Module Imports
+#################################################################################
+
+import os
+import sys
+import time
+
+ROOT =os.path.abspath(os.path.join(__file__,"../../"))
+sys.path.insert(1,ROOT)
+
+import torch
+import torch.nn as nn
+
+from seq_queries.model import CausalLM
+
+#################################################################################
+#   Function-Class Declaration
+#################################################################################
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+hidden_size, num_layers = 512, 2
+vocab_sizes = [26, 1000, 10000]
+# Beam search widths, then sampling widths
+widths = [10, 100, 1000, 10000]
+num_steps, num_warmup = 50, 5
+
+def time_steps(model, tokens, rnn_args):
+    """Mean seconds per single token step, as get_next_probs takes them"""
+    for i in range(num_warmup + num_steps):
+        if i == num_warmup:
+            if device == 'cuda': torch.cuda.synchronize()
+            start = time.perf_counter()
+        rnn_args = model(tokens, rnn_args)['misc_output']
+    if device == 'cuda': torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_steps
+
+#################################################################################
+#   Main Method
+#################################################################################
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    print(f"* {device}, LSTM hidden {hidden_size} x {num_layers} layers, {num_steps} steps")
+    print(f"  {'vocab':>6} {'width':>6} {'one-hot ms':>11} {'lookup ms':>10} {'speedup':>8}")
+    with torch.no_grad():
+        for vocab_size in vocab_sizes:
+            rnn = nn.LSTM(vocab_size, hidden_size, num_layers=num_layers, batch_first=True)
+            model = CausalLM(vocab_size=vocab_size, embed_dim=hidden_size, rnn=rnn).eval().to(device)
+            for width in widths:
+                tokens = torch.randint(0, vocab_size, (width, 1), device=device)
+                rnn_args = (torch.zeros(num_layers, width, hidden_size, device=device),
+                            torch.zeros(num_layers, width, hidden_size, device=device))
+                model.embedding_lookup = False
+                one_hot = time_steps(model, tokens, rnn_args)
+                model.embedding_lookup = True
+                lookup = time_steps(model, tokens, rnn_args)
+                print(f"  {vocab_size:>6} {width:>6} {1000*one_hot:>11.3f} {1000*lookup:>10.3f} {one_hot/lookup:>8.2f}")
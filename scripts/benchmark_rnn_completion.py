@@ -0,0 +1,93 @@
+#################################################################################
+#
+#             Project Title:  Benchmark RNN completion scheduling
+#             Date:           2022-06-08
+#
+#################################################################################
+
+
+#################################################################################
+#   Module Imports
+#################################################################################
+
+import os
+import sys
+import time
+
+ROOT =os.path.abspath(os.path.join(__file__,"../../"))
+sys.path.insert(1,ROOT)
+
+import torch
+import torch.nn as nn
+
+from seq_queries.model import CausalLM
+from seq_queries.sample import complete_sequences_rnn, _exclude_terms
+
+#################################################################################
+#   Function-Class Declaration
+#################################################################################
+
+device = 'cpu'
+vocab_size, hidden_size, num_layers = 26, 512, 2
+num_samples, seq_len, batch_size = 10000, 20, 10000
+excluded_terms = [0]
+
+def masked_completion(model, hidden_states, last_tokens, num_remaining_steps,
+                      log_p_totals, log_q_totals, step_log):
+    """Previous scheduler: boolean-index every tensor on every step"""
+    while (num_remaining_steps > 0).any():
+        start = time.perf_counter()
+        to_update = num_remaining_steps > 0
+        rnn_args = (hidden_states[0][..., to_update, :], hidden_states[1][..., to_update, :])
+        logits, rnn_args = model.get_next_probs(
+            last_tokens[to_update, :], rnn_args=rnn_args,
+            max_batch_size=batch_size, device=device, return_logits=True,
+        )
+        proposal_logits = _exclude_terms(logits, excluded_terms)
+        logits, proposal_logits = torch.log_softmax(logits, dim=-1), torch.log_softmax(proposal_logits, dim=-1)
+        last_sample = torch.distributions.Categorical(logits=proposal_logits).sample().unsqueeze(-1)
+        log_q_totals[to_update] += torch.gather(proposal_logits, dim=-1, index=last_sample).squeeze(-1)
+        log_p_totals[to_update] += torch.gather(logits, dim=-1, index=last_sample).squeeze(-1)
+        hidden_states[0][..., to_update, :] = rnn_args[0]
+        hidden_states[1][..., to_update, :] = rnn_args[1]
+        step_log.append((to_update.sum().item(), time.perf_counter() - start))
+        num_remaining_steps[to_update] -= 1
+        last_tokens[to_update, :] = last_sample
+
+def report(name, step_log):
+    print(f"* {name}: {sum(t for _, t in step_log):.3f}s over {len(step_log)} steps")
+    print(f"  {'active':>8} {'ms/step':>10} {'us/active seq':>14}")
+    for n, t in step_log:
+        print(f"  {n:>8} {1000*t:>10.2f} {1e6*t/max(n,1):>14.2f}")
+
+#################################################################################
+#   Main Method
+#################################################################################
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    rnn = nn.LSTM(vocab_size, hidden_size, num_layers=num_layers, batch_first=True)
+    model = CausalLM(vocab_size=vocab_size, embed_dim=hidden_size, rnn=rnn).eval()
+
+    # Tree exit depths are heavily skewed toward the root in practice
+    depths = torch.distributions.Geometric(probs=torch.tensor(0.3)).sample((num_samples,)).long().clamp(max=seq_len)
+    inputs = {
+        "hidden_states": (torch.randn(num_layers, num_samples, hidden_size),
+                          torch.randn(num_layers, num_samples, hidden_size)),
+        "last_tokens": torch.randint(1, vocab_size, (num_samples, 1)),
+        "num_remaining_steps": (seq_len - depths).int(),
+        "log_p_totals": torch.zeros(num_samples),
+        "log_q_totals": torch.zeros(num_samples),
+    }
+    clone = lambda: {k: tuple(s.clone() for s in v) if isinstance(v, tuple) else v.clone()
+                     for k, v in inputs.items()}
+
+    with torch.no_grad():
+        masked_log = []
+        masked_completion(model, step_log=masked_log, **clone())
+        report("masked", masked_log)
+
+        compact_log = []
+        complete_sequences_rnn(model, excluded_terms=excluded_terms, batch_size=batch_size,
+                               device=device, step_log=compact_log, **clone())
+        report("compacted", compact_log)
@@ -0,0 +1,29 @@
+#################################################################################
+#
+#             Project Title:  Convert Pickled Estimates to Columnar Results
+#             Date:           2022-06-12
+#
+#################################################################################
+
+
+#################################################################################
+#   Module Imports
+#################################################################################
+
+import os
+import sys
+
+ROOT =os.path.abspath(os.path.join(__file__,"../../"))
+sys.path.insert(1,ROOT)
+
+from seq_queries.results import convert_pkl
+
+#################################################################################
+#   Main Method
+#################################################################################
+
+if __name__ == "__main__":
+    # Usage: python scripts/convert_results.py data/<folder>/<dataset>/val_dl/*.pkl
+    for pkl_path in sys.argv[1:]:
+        path = convert_pkl(pkl_path)
+        print(f"* {pkl_path} -> {path}")
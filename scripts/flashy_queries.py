@@ -26,7 +26,8 @@ from collections import defaultdict
 from seq_queries.model import get_model
 from seq_queries.arguments import get_args, print_args
 from seq_queries.train import load_checkpoint
-from seq_queries.utils import write_pkl, write_json
+from seq_queries.utils import write_json
+from seq_queries.results import save_results
 from seq_queries.sample import lm_proposal, uniform_proposal, beam_search_lower_bound, mc_estimate, mc_pseudo_gt
 from seq_queries.experiments import sample_dynamic_target_token, prep_experiment, flashy_query
 
@@ -80,7 +81,7 @@ for dataset_name in datasets:
         #         print(e, d.shape)
         # sys.exit(1)
 
-        write_pkl(estimates,
+        save_results(estimates,
         f"data/{folder}/{dataset_name}/val_dl/val-dl_{dataset_name}_{folder.replace('_','-')}_" +
         f"{args.num_mc_samples}mc.pkl")
         estimates=None
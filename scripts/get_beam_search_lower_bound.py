@@ -25,7 +25,7 @@ from collections import defaultdict
 from seq_queries.model import get_model
 from seq_queries.arguments import get_args, print_args
 from seq_queries.train import load_checkpoint
-from seq_queries.utils import write_pkl
+from seq_queries.results import save_results, results_exist
 from seq_queries.sample import lm_proposal, uniform_proposal, beam_search_lower_bound, mc_estimate, beam_search_is_hybrid
 from seq_queries.experiments import sample_dynamic_target_token, prep_experiment
 
@@ -41,6 +41,7 @@ sub_estimates = [10,30,50,100,300, 500,1000,3000,5000,10000]
 num_beams = 0.8
 model_budget = False
 max_num_queries=1000
+query_batch_size = 64
 config_path = "config/sample.yaml"
 lengths_coverage = {
 
@@ -83,6 +84,7 @@ for dataset_name in datasets:
             args.hist_len = hist_len
             args.total_seq_len = total_seq_len
             args.num_beams = coverage
+            args.query_batch_size = query_batch_size
 
             if model_budget:
                 args.model_budget_filepath = (f"{ROOT}" +
@@ -90,7 +92,7 @@ for dataset_name in datasets:
                     f"{dataset_name}_beam-search-is-hybrid_{args.hist_len}h_{args.total_seq_len}s_{args.num_mc_samples}mc" +
                     f"{f'_{max_num_queries}q' if max_num_queries else ''}.pkl")
                 try:
-                    assert os.path.exists(args.model_budget_filepath),\
+                    assert results_exist(args.model_budget_filepath),\
                         f"Model budget filepath {args.model_budget_filepath} does not exist"
                     print(args.model_budget_filepath)
                 except Exception as e:
@@ -112,7 +114,7 @@ for dataset_name in datasets:
             # sys.exit(1)
 
 
-            write_pkl(estimates,
+            save_results(estimates,
             f"data/{folder}/{dataset_name}/val_dl/val-dl_{dataset_name}_{folder.replace('_','-')}_" +
             f"{args.hist_len}h_{args.total_seq_len}s_{args.num_mc_samples}mc" +
             f"{'_' + 'model-budget' if model_budget else f'_{args.num_beams}b'}" +
@@ -26,8 +26,8 @@ from collections import defaultdict
 from seq_queries.model import get_model
 from seq_queries.arguments import get_args, print_args
 from seq_queries.train import load_checkpoint
-from seq_queries.utils import write_pkl
-from seq_queries.sample import lm_proposal, uniform_proposal, beam_search_lower_bound, mc_estimate
+from seq_queries.results import save_results
+from seq_queries.sample import lm_proposal, uniform_proposal, beam_search_lower_bound, mc_estimate, exact_enumeration
 from seq_queries.experiments import sample_dynamic_target_token, prep_experiment
 
 #################################################################################
@@ -66,9 +66,7 @@ for dataset_name in datasets:
     for folder in folders:
         for hist_len,total_seq_len in len_info:
             args = copy.deepcopy(prep_dict['args'])
-            args.estimate_type = beam_search_lower_bound
-            args.min_variance = False
-            args.num_beams = 0.0
+            args.estimate_type = exact_enumeration
             args.hist_len = hist_len
             args.total_seq_len = total_seq_len
             print("[{}] | Dataset: {} | Sample type: {} | Hist length {} | Total Seq Length {}"\
@@ -76,7 +74,7 @@ for dataset_name in datasets:
             estimates = sample_dynamic_target_token(args, val_dl, model)
             os.makedirs(f"data/{folder}/{dataset_name}/val_dl/",exist_ok=True)
             estimates['metadata']['text_dict']['text'] = None
-            write_pkl(estimates,
+            save_results(estimates,
                     f"data/{folder}/{dataset_name}/val_dl/val-dl_{dataset_name}_{folder.replace('_','-')}_{args.hist_len}h_{args.total_seq_len}s.pkl")
             estimates=None
             print("====="*10)
@@ -25,7 +25,7 @@ from collections import defaultdict
 from seq_queries.model import get_model
 from seq_queries.arguments import get_args, print_args
 from seq_queries.train import load_checkpoint
-from seq_queries.utils import write_pkl
+from seq_queries.results import save_results
 from seq_queries.sample import lm_proposal, uniform_proposal, beam_search_lower_bound, mc_estimate, beam_search_is_hybrid
 from seq_queries.experiments import sample_dynamic_target_token, prep_experiment
 
@@ -94,7 +94,7 @@ for dataset_name in datasets:
             # sys.exit(1)
 
             args.num_mc_samples = sub_estimates[-1]
-            write_pkl(estimates,
+            save_results(estimates,
                     f"data/{folder}/{dataset_name}/val_dl/val-dl_{dataset_name}_" +
                     f"{folder.replace('_','-')}_{args.hist_len}h_{args.total_seq_len}s_" +
                     f"{args.num_mc_samples}mc" +
@@ -12,8 +12,8 @@ from datetime import datetime
 
 from .utils import print_log, read_yaml
 from .sample import (
-    mc_estimate, beam_search_lower_bound,beam_search_is_hybrid, uniform_proposal, lm_proposal,
-    mc_pseudo_gt, geom_interp, lin_interp)
+    mc_estimate, beam_search_lower_bound,beam_search_is_hybrid, beam_search_is_hybrid_nr,
+    exact_enumeration, uniform_proposal, lm_proposal, mc_pseudo_gt, geom_interp, lin_interp)
 
 
 #######################################################################
@@ -21,11 +21,13 @@ from .sample import (
 #######################################################################
 
 def _str2estimate(estimate):
-    assert estimate in ["search","sample","search_sample"],\
-        "Estimate must be [search, sample, search_sample], got {}".format(estimate)
+    assert estimate in ["search","sample","search_sample","search_sample_nr","exact"],\
+        "Estimate must be [search, sample, search_sample, search_sample_nr, exact], got {}".format(estimate)
     roster = {"sample":mc_estimate,
               "search":beam_search_lower_bound,
               "search_sample":beam_search_is_hybrid,
+              "search_sample_nr":beam_search_is_hybrid_nr,
+              "exact":exact_enumeration,
               "sample_pseudo_gt":mc_pseudo_gt,
               }
     return roster[estimate]
@@ -116,6 +118,7 @@ def model_config_args(parser):
     group.add_argument("--hidden_size", type=int, default=32, help="Size of hidden state of RNN.")
     group.add_argument("--num_layers", type=int, default=3, help="Number of RNN layers.")
     group.add_argument("--dropout", type=float, default=0.2, help="Dropout rate to be applied to all supported layers during training.")
+    group.add_argument("--embedding_lookup", type=_str2bool, default=False, help="At inference, gather the RNN input weights by token instead of multiplying one-hot inputs on single token steps. Histories keep the fused one-hot kernel, outputs match it up to float rounding.")
 
 def training_args(parser):
     group = parser.add_argument_group("Training specification arguments.")
@@ -144,7 +147,7 @@ def sampling_args(parser):
     group.add_argument("--hist_len", type=int, default=10, help="Length of conditioning context for sequence")
     group.add_argument("--total_seq_len", type=int, default=15, help="List[int] or int for total sequence lengths")
     group.add_argument("--long_seq_ablation", type=_str2bool, default=False, help="Long sequences ablation")
-    group.add_argument("--estimate_type", type=_str2estimate,default="sample", help="Get estimate type")
+    group.add_argument("--estimate_type", type=_str2estimate,default="sample", help="Get estimate type [search, sample, search_sample, search_sample_nr, exact]. search_sample_nr samples without replacement and supports RNN models only")
     group.add_argument("--proposal_func",  type=_str2proposal,default="uniform", help="Get proposal distribution for sampling")
     group.add_argument("--interp_func",  type=_str2interp_func,default="linear", help="Get inpterpolation function for search coverage")
     group.add_argument("--query_2",  type=_str2bool,default="linear", help="Whether or not to restrict the vocabulary")
@@ -158,6 +161,10 @@ def sampling_args(parser):
     group.add_argument("--min_num_mc_samples", type=int, default=10000, help="Minimum number of samples for pseudo ground truth")
     group.add_argument("--max_num_mc_samples", type=int, default=100000, help="Maximum number of samples for pseudo ground truth")
     group.add_argument("--variance_epsilon", type=float, default=5e-6, help="Variance threshold to stop sampling for pseudo ground truth")
+    group.add_argument("--store_samples", type=_str2bool, default=False, help="Keep every sample's estimates for pseudo ground truth (otherwise only running moments)")
+    group.add_argument("--ci_half_width", type=float, default=0.0, help="Stop sampling a query once its empirical Bernstein CI half-width is below this (0 disables)")
+    group.add_argument("--ci_relative", type=_str2bool, default=False, help="Treat ci_half_width as relative to the estimate instead of absolute")
+    group.add_argument("--ci_delta", type=float, default=0.05, help="CI failure probability for the stopping rule, over all checks (guaranteed for the LM proposal only)")
     group.add_argument("--model_budget_filepath", type=str, default=None, help="Filepath to extract model budgets for another run (usually hybrid file for imp. samp.)")
     group.add_argument("--store_intermediate_lbs", type=_str2bool,default=True,help="Store intermediate lower bounds.")
     group.add_argument("--frequentist_test", type=_str2bool,default=False,help="Check frequentist statistics for flashy query")
@@ -171,6 +178,21 @@ def sampling_args(parser):
     group.add_argument("--hybrid_max_num_beams", type=int, default=1500, help="Maximum_number of beams the hybrid can hold at each step")
     group.add_argument("--num_beams", type=_int_or_float, default=10, help="Beam coverage (or number)")
     group.add_argument("--num_mc_samples", type=int, default=10, help="Number of MC samples")
+    group.add_argument("--share_hist_state", type=_str2bool, default=True, help="Encode each history once and share its hidden state across all sample batches")
+    group.add_argument("--resident", type=_str2bool, default=False, help="Keep logits and hidden states on the model device throughout sampling and search")
+    group.add_argument("--prefix_cache_mb", type=float, default=0, help="Memory cap (MB) for the trie of encoded history prefixes shared across queries (0 disables)")
+    group.add_argument("--prefix_cache_lengths", type=_str2list, default=[], help="Prefix lengths the trie keeps besides powers of two and full histories, e.g. every hist_len of a sweep")
+    group.add_argument("--query_batch_size", type=int, default=1, help="Number of queries sampled together in one packed batch (1 runs queries one at a time)")
+    group.add_argument("--dedup_prefixes", type=_str2bool, default=False, help="Run the LM proposal once per unique (prefix, token) pair while most sampled prefixes are duplicates")
+    group.add_argument("--dedup_threshold", type=float, default=0.5, help="Stop deduplicating prefixes once more than this fraction of the sample rows are unique")
+    group.add_argument("--query_workers", type=int, default=1, help="Number of forked cpu processes that estimate queries in parallel (1 runs them in this process). Workers run one thread each, so with --per_query_seed they match a serial run only at torch.set_num_threads(1)")
+    group.add_argument("--per_query_seed", type=_str2bool, default=False, help="Sample every query from its own RNG stream of (seed, dataset, query index, estimator), so results do not depend on query order (MC estimates need --query_batch_size 1)")
+    group.add_argument("--frontier_memory_mb", type=float, default=0, help="Memory budget (MB) for RNN beam search frontier states, larger frontiers spill to disk (0 disables)")
+    group.add_argument("--enumeration_chunk_size", type=int, default=8192, help="Nodes expanded per model call when enumerating every sequence exactly")
+    group.add_argument("--scratch_dir", type=str, default=None, help="Directory for spilled frontier states (defaults to the system temp directory)")
+    group.add_argument("--shard_dir", type=str, default=None, help="Write results batch by batch to shards in this directory and skip batches already finished there by an earlier run")
+    group.add_argument("--estimate_cache_dir", type=str, default=None, help="Directory of cached estimator outputs, keyed by model weights, history, query and estimator arguments")
+    group.add_argument("--estimate_cache_mb", type=float, default=1024, help="Size of the estimate cache on disk, least recently used entries are evicted past it")
     group.add_argument("--disable_tqdm", type=_str2bool,default=False,help="Disable tqdm monitoring runs for samplers")
 
 def print_args(args):
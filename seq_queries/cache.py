@@ -0,0 +1,364 @@
+#################################################################################
+#
+#             Project Title:  Hidden State Caches
+#             Date:           2022-06-02
+#
+#################################################################################
+
+
+#################################################################################
+#   Module Imports
+#################################################################################
+
+import os
+import json
+import hashlib
+import tempfile
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from .utils import _map_hidden_state, read_pkl, write_pkl
+
+#################################################################################
+#   Function-Class Declaration
+#################################################################################
+
+def _state_nbytes(state):
+    nbytes = []
+    _map_hidden_state(state, lambda s: nbytes.append(s.numel() * s.element_size()))
+    return sum(nbytes)
+
+
+class PrefixNode(object):
+
+    """Trie node for a single history token"""
+
+    __slots__ = ['token', 'parent', 'children', 'state', 'nbytes']
+
+    def __init__(self, token, parent):
+        self.token = token
+        self.parent = parent
+        self.children = {}
+        self.state = None
+        self.nbytes = 0
+
+
+class HistoryPrefixTrie(object):
+
+    """
+    In-memory prefix trie of encoded histories. Each node may hold the next token
+    logits and hidden state after its prefix, so a query only needs to encode the
+    part of its history past the deepest cached prefix. States are evicted least
+    recently used first once more than `max_bytes` are held.
+
+    Only some prefixes are kept: powers of two, full histories and the
+    `checkpoint_lengths` (e.g. every hist_len of a sweep, plus the lengths of the
+    histories seen so far). A history that shares a longer uncached prefix with
+    an earlier one re-encodes it, counted in `tokens_wasted`.
+    """
+
+    def __init__(self, max_bytes, checkpoint_lengths=()):
+        self.max_bytes = max_bytes
+        self.checkpoint_lengths = set(checkpoint_lengths)
+        self.root = PrefixNode(None, None)
+        self.lru = OrderedDict()
+        self.key = None
+        self.bytes_held = 0
+        self.hits, self.misses = 0, 0
+        self.tokens_reused, self.tokens_encoded, self.tokens_wasted = 0, 0, 0
+
+    def validate(self, key):
+        """States are only valid for one model configuration (e.g. temperature)"""
+        if key != self.key:
+            self.clear()
+            self.key = key
+
+    def clear(self):
+        self.root = PrefixNode(None, None)
+        self.lru = OrderedDict()
+        self.bytes_held = 0
+
+    def checkpoints(self, depth, length):
+        """Prefix lengths past `depth` to keep while encoding a history of `length`"""
+        lengths = {2**j for j in range(length.bit_length())} | self.checkpoint_lengths
+        return sorted([l for l in lengths if depth < l < length]) + ([length] if depth < length else [])
+
+    def lookup(self, hist):
+        """Returns the depth and a copy of the state of the deepest cached prefix
+        of `hist` (0 and None if nothing is cached). Copies keep in-place updates
+        of the returned state from reaching the trie."""
+        self.checkpoint_lengths.add(hist.shape[0])
+        node, depth, best, matched = self.root, 0, None, 0
+        for i, token in enumerate(hist.tolist()):
+            node = node.children.get(token)
+            if node is None:
+                break
+            matched = i + 1
+            if node.state is not None:
+                depth, best = i + 1, node
+        # Seen before but past the deepest kept prefix, so encoded again
+        self.tokens_wasted += matched - depth
+
+        if best is None:
+            self.misses += 1
+            return 0, None
+        self.hits += 1
+        self.tokens_reused += depth
+        self.lru.move_to_end(id(best))
+        return depth, {key: _map_hidden_state(value, lambda s: s.clone())
+                       for key, value in best.state.items()}
+
+    def insert(self, prefix, state, num_encoded=1):
+        node = self.root
+        for token in prefix.tolist():
+            if token not in node.children:
+                node.children[token] = PrefixNode(token, node)
+            node = node.children[token]
+
+        if node.state is not None:
+            self.bytes_held -= node.nbytes
+        node.state, node.nbytes = state, _state_nbytes(state)
+        self.bytes_held += node.nbytes
+        self.tokens_encoded += num_encoded
+        self.lru[id(node)] = node
+        self.lru.move_to_end(id(node))
+        while self.bytes_held > self.max_bytes and self.lru:
+            self._evict()
+
+    def _evict(self):
+        _, node = self.lru.popitem(last=False)
+        self.bytes_held -= node.nbytes
+        node.state, node.nbytes = None, 0
+        # Drop nodes that no longer lead to any cached state
+        while (node.parent is not None and node.state is None
+               and not node.children):
+            del node.parent.children[node.token]
+            node = node.parent
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "tokens_reused": self.tokens_reused,
+            "tokens_encoded": self.tokens_encoded,
+            "tokens_wasted": self.tokens_wasted,
+            "bytes_held": self.bytes_held,
+            "num_states": len(self.lru),
+        }
+
+
+def _remove_file(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class _SpillFile(object):
+
+    """Memory-mapped scratch array, deleted once nothing references it"""
+
+    def __init__(self, shape, dtype, scratch_dir=None):
+        fd, self.path = tempfile.mkstemp(suffix='.states', dir=scratch_dir)
+        os.close(fd)
+        self.array = np.memmap(self.path, dtype=dtype, mode='w+', shape=shape)
+        weakref.finalize(self, _remove_file, self.path)
+
+
+class SpilledStates(object):
+
+    """
+    RNN hidden state (tensor or tuple of tensors, each (layers, rows, hidden)) kept
+    in memory-mapped scratch files instead of RAM, stored row-major so that row
+    ranges are contiguous on disk. `select` only records row indices, rows are
+    read back a chunk at a time with `read` or `take`.
+    """
+
+    def __init__(self, files, is_tuple, rows=None):
+        self.files = files
+        self.is_tuple = is_tuple
+        self.rows = rows
+
+    @classmethod
+    def empty(cls, like, num_rows, scratch_dir=None):
+        """Unwritten states with `num_rows` rows, shaped and typed like `like`"""
+        states = like if isinstance(like, tuple) else (like,)
+        files = tuple([_SpillFile((num_rows, s.shape[0], s.shape[-1]),
+                                  torch.empty(0, dtype=s.dtype).numpy().dtype, scratch_dir)
+                       for s in states])
+        return cls(files, isinstance(like, tuple))
+
+    @classmethod
+    def from_states(cls, states, scratch_dir=None):
+        spilled = cls.empty(states, _num_rows(states), scratch_dir)
+        spilled.write(0, states)
+        return spilled
+
+    def __len__(self):
+        return self.files[0].array.shape[0] if self.rows is None else self.rows.shape[0]
+
+    @property
+    def row_nbytes(self):
+        return sum([f.array.itemsize * f.array.shape[1] * f.array.shape[2] for f in self.files])
+
+    def write(self, start, states):
+        assert self.rows is None, "Cannot write through a selection"
+        states = states if isinstance(states, tuple) else (states,)
+        for f, s in zip(self.files, states):
+            f.array[start:start + s.shape[1]] = s.detach().cpu().transpose(0, 1).numpy()
+
+    def _load(self, rows):
+        states = tuple([torch.from_numpy(np.ascontiguousarray(f.array[rows])).transpose(0, 1)
+                        for f in self.files])
+        return states if self.is_tuple else states[0]
+
+    def read(self, start, end):
+        """States of rows [start, end) in RAM"""
+        if self.rows is None:
+            return self._load(slice(start, end))
+        return self._load(self.rows[start:end])
+
+    def take(self, inds):
+        """States of rows `inds` in RAM"""
+        inds = torch.as_tensor(inds).cpu().numpy()
+        return self._load(inds if self.rows is None else self.rows[inds])
+
+    def select(self, inds):
+        """Lazy selection of rows `inds`, sharing the same scratch files"""
+        inds = torch.as_tensor(inds).cpu().numpy()
+        return SpilledStates(self.files, self.is_tuple, inds if self.rows is None else self.rows[inds])
+
+    def load(self):
+        return self.read(0, len(self))
+
+
+def _num_rows(states):
+    return states[0].shape[1] if isinstance(states, tuple) else states.shape[1]
+
+
+#######################################################################
+# On-disk estimate cache
+#######################################################################
+
+# Arguments that never change what an estimator returns
+_UNKEYED_ARGS = ['model', 'text_dict', 'prefix_cache', 'estimate_cache', 'generator', 'disable_tqdm',
+                 'dont_print_args', 'query_workers', 'shard_dir', 'scratch_dir', 'estimate_cache_dir',
+                 'estimate_cache_mb', 'max_num_queries', 'checkpoint_path', 'data_path']
+
+# Model attributes that change its outputs without being in the state_dict
+_KEYED_MODEL_ATTRS = ['temperature', 'embedding_lookup', 'training', 'max_sequence_len', 'min_seq_len']
+
+def _key_value(value):
+    """JSON form of an argument for a cache key. Values with no JSON form are
+    keyed by their repr, so differing arguments never share a key."""
+    if isinstance(value, torch.Tensor):
+        value = value.tolist()
+    elif isinstance(value, torch.device):
+        value = str(value)
+    elif callable(value) and hasattr(value, '__name__'):
+        value = value.__name__
+    try:
+        json.dumps(value)
+    except TypeError:
+        value = {"repr": repr(value)}
+    return value
+
+def model_description(model):
+    return dict({"class": type(model).__name__},
+                **{attr: _key_value(getattr(model, attr)) for attr in _KEYED_MODEL_ATTRS
+                   if hasattr(model, attr)})
+
+def model_weight_hash(model):
+    digest = hashlib.sha256()
+    for name, tensor in sorted(model.state_dict().items()):
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+
+class EstimateCache(object):
+
+    """
+    Content-addressed cache of estimator outputs in `cache_dir`, one pickle per
+    call. Keys hash the model weights and settings (e.g. temperature), the history
+    tokens, the query index (which seeds per-query streams) and the estimator with
+    its normalized arguments, so
+    entries carry over between sessions and sweeps. Files are evicted least
+    recently used first (by mtime, which hits refresh) once more than `max_bytes`
+    are held.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.lru = OrderedDict()
+        entries = [e for e in os.scandir(cache_dir) if e.name.endswith('.pkl')]
+        for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+            self.lru[entry.name[:-4]] = entry.stat().st_size
+        self.bytes_held = sum(self.lru.values())
+        self.model_hashes = {}
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def key(self, model, estimate_name, index, hist, kwargs):
+        if id(model) not in self.model_hashes:
+            self.model_hashes[id(model)] = model_weight_hash(model)
+        hist = torch.as_tensor(hist).cpu()
+        description = {
+            "model": self.model_hashes[id(model)],
+            "model_settings": model_description(model),
+            "estimate": estimate_name,
+            "index": index,
+            "hist": [list(hist.shape), hist.tolist()],
+            "kwargs": {k: _key_value(v) for k, v in kwargs.items() if k not in _UNKEYED_ARGS},
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pkl")
+
+    def get(self, key):
+        if key not in self.lru or not os.path.exists(self._path(key)):
+            self.misses += 1
+            return None
+        self.hits += 1
+        os.utime(self._path(key))
+        self.lru.move_to_end(key)
+        return read_pkl(self._path(key))
+
+    def put(self, key, output):
+        path = self._path(key)
+        write_pkl(output, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        self.bytes_held += os.path.getsize(path) - self.lru.pop(key, 0)
+        self.lru[key] = os.path.getsize(path)
+        while self.bytes_held > self.max_bytes and len(self.lru) > 1:
+            self._evict()
+
+    def _evict(self):
+        key, nbytes = self.lru.popitem(last=False)
+        _remove_file(self._path(key))
+        self.bytes_held -= nbytes
+        self.evictions += 1
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "evictions": self.evictions,
+            "bytes_held": self.bytes_held,
+            "num_entries": len(self.lru),
+        }
@@ -14,7 +14,6 @@ import os
 import sys
 import numpy as np
 from collections import defaultdict
-from itertools import product
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -29,6 +28,9 @@ from .sample import *
 from .data import *
 from .train import load_checkpoint, get_model
 from .utils import read_pkl, write_pkl, compute_num_beams_from_budget, set_random_seed
+from .parallel import query_job, imap_queries, QueryPool
+from .results import ShardStore, run_description, read_results
+from .cache import HistoryPrefixTrie, EstimateCache
 
 ROOT =os.path.abspath(os.path.join(__file__,"../../"))
 
@@ -171,6 +173,21 @@ def prep_experiment(
     }
 
 
+def _attach_estimate_cache(args, model):
+    # Held by the model like the prefix cache, so stats add up across a sweep
+    args.estimate_cache = None
+    if args.estimate_cache_dir:
+        cache = getattr(model, 'estimate_cache', None)
+        if cache is None or cache.cache_dir != args.estimate_cache_dir:
+            model.estimate_cache = EstimateCache(args.estimate_cache_dir, int(args.estimate_cache_mb * 2**20))
+        args.estimate_cache = model.estimate_cache
+
+def _detach_estimate_cache(args, output):
+    if args.estimate_cache is not None:
+        output['estimate_cache_stats'] = args.estimate_cache.stats()
+    args.estimate_cache = None
+
+
 def tau_ab_inf_horizon_query(
     args,
     dataloader,
@@ -184,9 +201,11 @@ def tau_ab_inf_horizon_query(
  ):
 
     args.model = model; print();
+    _attach_estimate_cache(args, model)
     output = {}
     artifact_store_roster = {
         "beam_search_lower_bound":search_artifacts,
+        "exact_enumeration":search_artifacts,
         "mc_estimate":sample_artifacts,
         "mc_pseudo_gt":sample_artifacts,
     }
@@ -212,23 +231,27 @@ def tau_ab_inf_horizon_query(
     artifacts = artifact_store_roster[args.estimate_type.__name__]
     artifacts += ['tau_a_estimates','tau_b_estimates']
     args.excluded_terms = args.tau_a_excl_terms + args.tau_b_excl_terms
-    for dbatch in tqdm(dataloader, disable=args.disable_tqdm):
+    shard_store = ShardStore(args.shard_dir, run_description(args)) if args.shard_dir else None
+    # Query workers are forked once and reused by every batch
+    query_pool = QueryPool(args, args.query_workers)
+    query_index = 0
+    for batch_index, dbatch in enumerate(tqdm(dataloader, disable=args.disable_tqdm)):
         data_list = []
         data_batch =[dbatch[i,:args.hist_len] for i in range(dbatch.shape[0])]
+        args.seq_len = 30
+        if shard_store is not None and shard_store.is_done(batch_index):
+            query_index += dbatch.shape[0]
+            continue
+        jobs = [query_job(query_index + i, data_batch[i]) for i in range(dbatch.shape[0])]
 
-        for i in range(dbatch.shape[0]):
+        for i, sample_output in enumerate(imap_queries(jobs, args, args.query_workers, query_pool)):
             if (args.use_gpt2 and
                 args.disable_tqdm):
                 print(f"[{datetime.now()}] - {i}",flush=True)
             elif i%10 == 0 and args.disable_tqdm:
                 print(".",end="",flush=True)
-            sample = data_batch[i]
-            args.seq_len = 30
-
-            kwargs = vars(args)
-            sample_output =args.estimate_type(sample,**kwargs)
             # (samples, seq_len, vocab)
-            if args.estimate_type.__name__ == 'beam_search_lower_bound':
+            if args.estimate_type.__name__ in ['beam_search_lower_bound', 'exact_enumeration']:
                 intermediate_query_probs = sample_output['intermediate_lbs']
             else:
                 intermediate_query_probs = sample_output['intermediate_query_probs'].squeeze(0)
@@ -242,17 +265,29 @@ def tau_ab_inf_horizon_query(
                 torch.tensor([args.tau_b_excl_terms]*(args.max_k+1))).squeeze().sum(dim=-1)
 
             data_list.append(sample_output)
+        query_index += dbatch.shape[0]
 
         print("",flush=True)
         assert args.estimate_type.__name__ in artifact_store_roster,\
             f"Estimate type {args.estimate_type.__name__} not found"
         artifacts = artifact_store_roster[args.estimate_type.__name__]
-        for art in artifacts:
-            _add_output(art,data_list)
+        if shard_store is not None:
+            shard_store.write(batch_index, range(query_index - dbatch.shape[0], query_index),
+                              [{art: db[art] for art in artifacts} for db in data_list])
+        else:
+            for art in artifacts:
+                _add_output(art,data_list)
+    query_pool.close()
+
+    if shard_store is not None:
+        for shard in shard_store.shards():
+            for art in artifacts:
+                _add_output(art,shard['data'])
 
     for art in artifacts:
         _consolidate_output(art)
 
+    _detach_estimate_cache(args, output)
     args.model = None
     output['metadata'] = vars(args)
     return output
@@ -281,10 +316,12 @@ def flashy_query(
 
     """
     args.model = model; print();
+    _attach_estimate_cache(args, model)
     output = {}
     artifact_store_roster = {
         "beam_search_is_hybrid": hybrid_artifacts,
         "beam_search_lower_bound":search_artifacts,
+        "exact_enumeration":search_artifacts,
         "mc_estimate":sample_artifacts,
         "mc_pseudo_gt":sample_artifacts,
     }
@@ -313,23 +350,25 @@ def flashy_query(
 
     all_excluded_terms = [];
     artifacts = artifact_store_roster[args.estimate_type.__name__]
-    data_list = []
-    for i,sample in tqdm(enumerate(args.text_dict['text']),
-                         disable=args.disable_tqdm):
+    data_list = []; jobs = []
+    args.seq_len = args.fixed_seq_len
+    for i,sample in enumerate(args.text_dict['text']):
         sample = torch.LongTensor(sample)
+        overrides = {}
         if args.dataset == "flashy_apps":
-            args.excluded_terms = list(set(range(args.vocab_size)) - set([sample[0].item()]))
-            all_excluded_terms.append(torch.LongTensor(args.excluded_terms))
+            overrides['excluded_terms'] = list(set(range(args.vocab_size)) - set([sample[0].item()]))
+            all_excluded_terms.append(torch.LongTensor(overrides['excluded_terms']))
+        jobs.append(query_job(i, sample, **overrides))
+    if jobs: args.__dict__.update(jobs[-1]['overrides'])
 
+    for i,sample_output in tqdm(enumerate(imap_queries(jobs, args, args.query_workers)),
+                                total=len(jobs), disable=args.disable_tqdm):
         if (args.use_gpt2 and
             args.disable_tqdm):
             print(f"[{datetime.now()}] - {i}",flush=True)
         elif i%10 == 0 and args.disable_tqdm:
             print(".",end="",flush=True)
-        args.seq_len = args.fixed_seq_len
 
-        kwargs = vars(args)
-        sample_output =args.estimate_type(sample,**kwargs)
         data_list.append(sample_output)
 
         print("",flush=True)
@@ -343,6 +382,7 @@ def flashy_query(
     for art in artifacts:
         _consolidate_output(art)
 
+    _detach_estimate_cache(args, output)
     args.model = None
     output['metadata'] = vars(args)
     output['excluded_terms'] = torch.LongTensor(args.excluded_terms)
@@ -361,7 +401,7 @@ def sample_dynamic_target_token(
     dataloader,
     model=None,
     sample_artifacts=["sample_estimates",'sample_estimate_var','sample_estimate_mean','entropy_probs',
-                      'model_iters','num_mc_samples','intermediate_query_probs'],
+                      'model_iters','num_mc_samples','intermediate_query_probs','samples_used'],
     hybrid_artifacts=["bs_lower_bound",'is_estimates','sample_estimates','model_iters',
                       'sample_estimate_var','sample_estimate_mean','num_beams','num_mc_samples'],
     search_artifacts=['true_coverage','restricted_coverage','num_beams', 'model_iters',
@@ -378,10 +418,13 @@ def sample_dynamic_target_token(
 
     """
     args.model = model; print();
+    _attach_estimate_cache(args, model)
     output = {}
     artifact_store_roster = {
         "beam_search_is_hybrid": hybrid_artifacts,
+        "beam_search_is_hybrid_nr": hybrid_artifacts,
         "beam_search_lower_bound":search_artifacts,
+        "exact_enumeration":search_artifacts,
         "mc_estimate":sample_artifacts,
         "mc_pseudo_gt":sample_artifacts,
     }
@@ -408,84 +451,154 @@ def sample_dynamic_target_token(
         elif len(output[key][0].shape) >= 1:
             output[key] = torch.cat(output[key])
 
+    batched_estimate_roster = {
+        "mc_estimate": mc_estimate_batched,
+        "beam_search_lower_bound": beam_search_lower_bound_batched,
+    }
+
+    # Prefix states live on the model so that they are shared across hist_len sweeps
+    args.prefix_cache = None
+    if args.prefix_cache_mb:
+        if getattr(model, 'prefix_cache', None) is None:
+            model.prefix_cache = HistoryPrefixTrie(int(args.prefix_cache_mb * 2**20))
+        model.prefix_cache.checkpoint_lengths.update(args.prefix_cache_lengths)
+        args.prefix_cache = model.prefix_cache
+
     model_budget = None; model_budget_name = ""; model_budget_i =0
     if args.frequentist_test:
         artifact_store_roster['mc_estimate'].append('frequentist_estimates')
     if args.model_budget_filepath:
-        model_budget_file = read_pkl(args.model_budget_filepath)
-        model_budget = model_budget_file['model_iters']
+        model_budget_file = read_results(args.model_budget_filepath)
+        model_budget = torch.as_tensor(np.array(model_budget_file['model_iters']))
     elif 'num_mc_samples' in hybrid_artifacts:
         hybrid_artifacts.remove('num_mc_samples')
 
+    def _long_seq_ablation(sample_output):
+        if args.long_seq_ablation:
+            # Ablation for importance sampling long sequences
+            intermediate_query_probs = sample_output['intermediate_query_probs']
+            intermediate_sub_estimates = intermediate_query_probs[...,args.intermediate_seqs,:]
+            sample_output['intermediate_query_probs'] = torch.stack([
+                intermediate_sub_estimates[:,:samp].mean(dim=1)
+                for samp in args.sub_estimates
+            ] + [intermediate_sub_estimates.mean(dim=1)],dim=1)
+            assert (sample_output['intermediate_query_probs'].shape[1] == len(args.sub_estimates)+1 and
+                    sample_output['intermediate_query_probs'].shape[2] == len(args.intermediate_seqs)),\
+                "Error: Expected {} sub estimates and {} intermediate sequences but got: sub estimates {} and seq {}".format(
+                    len(args.sub_estimates)+1, len(args.intermediate_seqs),
+                    sample_output['intermediate_query_probs'].shape[1],
+                    sample_output['intermediate_query_probs'].shape[2],
+                )
+        return sample_output
+
+    # Queries can be packed together when no per-query budget has to be matched
+    # (packed frontiers are never spilled, so a frontier memory budget also runs serially)
+    batched_estimate = batched_estimate_roster.get(args.estimate_type.__name__)
+    use_query_batches = (args.query_batch_size > 1 and batched_estimate is not None
+                         and not args.model_budget_filepath and not args.frontier_memory_mb)
+    # A packed MC batch draws every query's samples from one stream, so they would depend
+    # on the queries it is packed with and on when the stopping rule drops them
+    assert not (use_query_batches and args.per_query_seed and args.estimate_type.__name__ == 'mc_estimate'),\
+        "--per_query_seed needs --query_batch_size 1 for MC estimates, packed queries share one RNG stream"
+
+    # Prefix deduplication only applies to LM proposal sampling
+    dedup_artifacts = (['dedup_savings'] if args.dedup_prefixes and args.proposal_func.__name__ == 'lm_proposal'
+                       and args.estimate_type.__name__ in ['mc_estimate', 'mc_pseudo_gt'] else [])
     all_excluded_terms = [];
-    artifacts = artifact_store_roster[args.estimate_type.__name__]
-    for dbatch in tqdm(dataloader, disable=args.disable_tqdm):
+    artifacts = artifact_store_roster[args.estimate_type.__name__] + dedup_artifacts
+
+    # Batches finished by an earlier (crashed) run are read back from their shards
+    shard_store = None
+    if args.shard_dir:
+        shard_store = ShardStore(args.shard_dir, run_description(
+            args, exclude=['sub_estimates', 'num_mc_samples', 'num_beams'] if args.model_budget_filepath else []))
+    # Query workers are forked once and reused by every batch
+    query_pool = QueryPool(args, args.query_workers)
+    query_index = 0
+    for batch_index, dbatch in enumerate(tqdm(dataloader, disable=args.disable_tqdm)):
         data_list = []
         if not args.query_2:
             all_excluded_terms.append(dbatch[:,args.total_seq_len].cpu())
         data_batch =[dbatch[i,:args.hist_len] for i in range(dbatch.shape[0])]
 
-        for i in range(dbatch.shape[0]):
+        args.seq_len = args.total_seq_len - args.hist_len
+        if shard_store is not None and shard_store.is_done(batch_index):
+            model_budget_i += dbatch.shape[0]
+            query_index += dbatch.shape[0]
+            continue
+        jobs = []
+        if use_query_batches:
+            for start in range(0, dbatch.shape[0], args.query_batch_size):
+                end = min(start + args.query_batch_size, dbatch.shape[0])
+                batch_excluded_terms = [[dbatch[i,args.total_seq_len].cpu().item()] if not args.query_2 else []
+                                        for i in range(start, end)]
+                jobs.append(query_job(query_index + start, dbatch[start:end,:args.hist_len],
+                                      estimate=batched_estimate, excluded_terms=batch_excluded_terms))
+                model_budget_i += end - start
+        else:
+            for i in range(dbatch.shape[0]):
+                overrides = {"excluded_terms": [dbatch[i,args.total_seq_len].cpu().item()]
+                             if not args.query_2 else []}
+
+                if args.model_budget_filepath:
+                    if args.estimate_type.__name__ == "mc_estimate":
+                        overrides['sub_estimates'] = (torch.div(model_budget[model_budget_i],args.seq_len,
+                                                        rounding_mode="trunc").long() +
+                                            ((model_budget[model_budget_i]%args.seq_len > 0).long())).tolist()
+                        overrides['num_mc_samples'] = overrides['sub_estimates'][-1]
+                    elif args.estimate_type.__name__ == "beam_search_lower_bound":
+                        init_sub_estimates = (torch.div(model_budget[model_budget_i],args.seq_len,
+                                                        rounding_mode="trunc").long() +
+                                            ((model_budget[model_budget_i]%args.seq_len > 0).long())).tolist()
+                        overrides['sub_estimates'] = [
+                            compute_num_beams_from_budget(args.vocab_size,init_beam,args.seq_len,
+                                                          overrides['excluded_terms'])
+                            for init_beam in init_sub_estimates]
+                        overrides['num_beams'] = overrides['sub_estimates'][-1]
+                        assert isinstance(overrides['num_beams'],int),"Num beams for model budget has to be an int"
+
+                jobs.append(query_job(query_index + i, data_batch[i], **overrides))
+                model_budget_i += 1
+
+        for i, job_output in enumerate(imap_queries(jobs, args, args.query_workers, query_pool)):
             if (args.use_gpt2 and
                 args.disable_tqdm):
                 print(f"[{datetime.now()}] - {i}",flush=True)
-            elif i%10 == 0 and args.disable_tqdm:
+            elif (use_query_batches or i%10 == 0) and args.disable_tqdm:
                 print(".",end="",flush=True)
-            sample = data_batch[i]
-            args.seq_len = args.total_seq_len - args.hist_len
-            if not args.query_2:
-                args.excluded_terms = [dbatch[i,args.total_seq_len].cpu().item()]
-            else: args.excluded_terms = []
-
-            if args.model_budget_filepath:
-                if args.estimate_type.__name__ == "mc_estimate":
-                    args.sub_estimates = (torch.div(model_budget[model_budget_i],args.seq_len,
-                                                    rounding_mode="trunc").long() +
-                                        ((model_budget[model_budget_i]%args.seq_len > 0).long())).tolist()
-                    args.num_mc_samples = args.sub_estimates[-1]
-                elif args.estimate_type.__name__ == "beam_search_lower_bound":
-                    init_sub_estimates = (torch.div(model_budget[model_budget_i],args.seq_len,
-                                                    rounding_mode="trunc").long() +
-                                        ((model_budget[model_budget_i]%args.seq_len > 0).long())).tolist()
-                    args.sub_estimates = [
-                        compute_num_beams_from_budget(args.vocab_size,init_beam,args.seq_len,args.excluded_terms)
-                        for init_beam in init_sub_estimates]
-                    args.num_beams = args.sub_estimates[-1]
-                    assert isinstance(args.num_beams,int),"Num beams for model budget has to be an int"
-
-            kwargs = vars(args)
-            sample_output =args.estimate_type(sample,**kwargs)
-
-            if args.long_seq_ablation:
-                # Ablation for importance sampling long sequences
-                intermediate_query_probs = sample_output['intermediate_query_probs']
-                intermediate_sub_estimates = intermediate_query_probs[...,args.intermediate_seqs,:]
-                sample_output['intermediate_query_probs'] = torch.stack([
-                    intermediate_sub_estimates[:,:samp].mean(dim=1)
-                    for samp in args.sub_estimates
-                ] + [intermediate_sub_estimates.mean(dim=1)],dim=1)
-                assert (sample_output['intermediate_query_probs'].shape[1] == len(args.sub_estimates)+1 and
-                        sample_output['intermediate_query_probs'].shape[2] == len(args.intermediate_seqs)),\
-                    "Error: Expected {} sub estimates and {} intermediate sequences but got: sub estimates {} and seq {}".format(
-                        len(args.sub_estimates)+1, len(args.intermediate_seqs),
-                        sample_output['intermediate_query_probs'].shape[1],
-                        sample_output['intermediate_query_probs'].shape[2],
-                    )
-
-            data_list.append(sample_output)
-            model_budget_i += 1
+            job_outputs = job_output if use_query_batches else [job_output]
+            data_list += [_long_seq_ablation(sample_output) for sample_output in job_outputs]
+        # Keep the last query's settings on args, as serial runs left them in the metadata
+        args.__dict__.update(jobs[-1]['overrides'])
+        if use_query_batches: args.excluded_terms = args.excluded_terms[-1]
+        query_index += dbatch.shape[0]
 
         print("",flush=True)
         assert args.estimate_type.__name__ in artifact_store_roster,\
             f"Estimate type {args.estimate_type.__name__} not found"
-        artifacts = artifact_store_roster[args.estimate_type.__name__]
-        for art in artifacts:
-            _add_output(art,data_list)
+        artifacts = artifact_store_roster[args.estimate_type.__name__] + dedup_artifacts
+        if shard_store is not None:
+            shard_store.write(batch_index, range(query_index - dbatch.shape[0], query_index),
+                              [{art: db[art] for art in artifacts} for db in data_list],
+                              settings={k: getattr(args, k) for k in jobs[-1]['overrides']})
+        else:
+            for art in artifacts:
+                _add_output(art,data_list)
+    query_pool.close()
+
+    if shard_store is not None:
+        for shard in shard_store.shards():
+            for art in artifacts:
+                _add_output(art,shard['data'])
+            args.__dict__.update(shard['settings'])
 
     for art in artifacts:
         _consolidate_output(art)
 
-    args.model = None
+    if args.prefix_cache is not None:
+        output['prefix_cache_stats'] = args.prefix_cache.stats()
+    _detach_estimate_cache(args, output)
+    args.model = None; args.prefix_cache = None
     output['metadata'] = vars(args)
     if not args.query_2:
         output['excluded_terms'] = torch.cat(all_excluded_terms,dim=0).cpu()
@@ -530,43 +643,27 @@ def variance_ablation(
 
 def _get_joint_log_prob_of_all_seqs(
     hist, seq_len, model, interp_func,excluded_terms,
-    batch_size, device, vocab_size, **kwargs):
+    batch_size, device, vocab_size, enumeration_chunk_size=8192, **kwargs):
     """
     Examines the variance of the importance sampling estimate
     of the number of paths remaining before and after beam search.
-
+    Every sequence is enumerated (lexicographically) one token at a time
+    from its parent's hidden state.
     """
 
     assert len(excluded_terms) == 1,\
         "Ambiguous choice of excluded term to use"
     excluded_term = excluded_terms[0]
-    all_seqs = torch.LongTensor(
-        list(product(range(vocab_size),
-            repeat=seq_len))
-    )
-    all_seqs = torch.cat(
-        (all_seqs,
-         torch.ones((all_seqs.shape[0],1))*excluded_term
-        ), dim = 1
-    ).long()
-
-    hists=hist.unsqueeze(0).expand(all_seqs.shape[0], -1)
-    logits, hidden_state = model.get_next_probs(
-        torch.cat((hists,all_seqs), dim=-1),
-        return_forward_only=True,
-        rnn_args=None,
-        device=device,
-        max_batch_size=batch_size,
-        return_logits=True,
-    )
-
-    # All but the last probability q(x_1:k)
-    model_log_probs = torch.gather(torch.log_softmax(logits[...,-(seq_len+1):,:],dim=-1),
-                                   dim=-1, index=all_seqs.unsqueeze(-1)).squeeze(-1)
-    q_log_prob = model_log_probs[...,:-1].sum(dim=-1)
-    p_log_cond = model_log_probs[...,-1]
-
-    return q_log_prob, p_log_cond
+
+    # q(x_1:k) and p(excluded term | x_1:k) of every leaf
+    q_log_prob, p_log_cond = [], []
+    for block in enumerate_sequences(hist, seq_len, model, batch_size, device,
+                                     chunk_size=enumeration_chunk_size):
+        if block['depth'] == seq_len:
+            q_log_prob.append(block['log_probs'].cpu())
+            p_log_cond.append(block['next_log_probs'][:, excluded_term].cpu())
+
+    return torch.cat(q_log_prob), torch.cat(p_log_cond)
 
 
 
@@ -77,9 +77,10 @@ def load_GPT2_query_lm(device):
         temperature=1.0,
         max_batch_size=16, device='cpu',
         return_forward_only=False,
-        return_logits=True, **kwargs
+        return_logits=True, resident=False, **kwargs
  ):
         hidden_states = rnn_args
+        out_device = device if resident else 'cpu'
         self.model_iters += x.shape[0] * x.shape[1]
         if self.temperature is not None:
             temperature = self.temperature
@@ -108,10 +109,14 @@ def load_GPT2_query_lm(device):
             else: logits = step_output['logits']/temperature
             if not return_logits:
                 probs = torch.softmax(logits, dim=-1)
-                prob_outputs.append(probs.cpu())
+                prob_outputs.append(probs.to(out_device))
             else:
-                prob_outputs.append(logits.cpu())
-            step_outputs.append(_tup_cpu_gpt2(step_output['past_key_values']))
+                prob_outputs.append(logits.to(out_device))
+            step_outputs.append(_tup_gpu_gpt2(step_output['past_key_values'], out_device))
+
+        # Everything fit in one chunk, no need to concatenate
+        if len(step_outputs) == 1:
+            return prob_outputs[0], tuple(step_outputs[0])
 
         layer_hiddens = []
         for layer_data in zip(*step_outputs):
@@ -120,8 +125,8 @@ def load_GPT2_query_lm(device):
             # Then, compare the outputs
             layer_data= list(zip(*layer_data))
             layer_hiddens.append(
-                (torch.cat(layer_data[0],dim=0).cpu(),
-                 torch.cat(layer_data[1],dim=0).cpu())
+                (torch.cat(layer_data[0],dim=0),
+                 torch.cat(layer_data[1],dim=0))
             )
 
         return torch.cat(prob_outputs,dim = 0), tuple(layer_hiddens)
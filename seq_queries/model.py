@@ -19,7 +19,7 @@ import torch.nn.functional as F
 import random
 
 from abc import ABC, abstractmethod
-from .utils import _tup_cpu, accuracy_score
+from .utils import _tup_cpu, _map_hidden_state, accuracy_score
 from .gpt2_model import load_GPT2_query_lm
 
 #################################################################################
@@ -61,13 +61,20 @@ class CausalLM(LM, nn.Module):
         self.out_transform = nn.Linear(embed_dim, vocab_size, bias=True)
         self.loss_func = nn.CrossEntropyLoss()
         self.temperature = None
+        self.embedding_lookup = False
+        self._lookup_rnn = None
 
     def forward(self, src, rnn_args=None, **kwargs):
         """Takes in LongTensor `src` of size [batch_size, seq_len] and produces logits
         for next token prediction of size [batch_size, seq_len, vocab_size]."""
 
-        one_hot_src = F.one_hot(src, num_classes=self.vocab_size).float()
-        rnn_out, misc_out = self.rnn(one_hot_src, rnn_args)
+        if self.embedding_lookup and not self.training:
+            if self._lookup_rnn is None or self._lookup_rnn.is_stale(self.rnn):
+                self._lookup_rnn = OneHotLookupRNN(self.rnn)
+            rnn_out, misc_out = self._lookup_rnn(src, rnn_args)
+        else:
+            one_hot_src = F.one_hot(src, num_classes=self.vocab_size).float()
+            rnn_out, misc_out = self.rnn(one_hot_src, rnn_args)
         logits = self.out_transform(rnn_out)
 
         return {
@@ -104,59 +111,62 @@ class CausalLM(LM, nn.Module):
 
         return output
 
+    def _forward_next(self, x, rnn_args, temperature, device, return_forward_only):
+        if rnn_args is not None:
+            # Shared history states may be broadcast views, RNN kernels need them contiguous
+            rnn_args = _map_hidden_state(rnn_args, lambda s: s.to(device).contiguous())
+        step_output = self.forward(src=x.to(device), rnn_args=rnn_args)
+        if not return_forward_only:
+            logits = step_output["logits"][:, -1, :] / temperature # last position in the sequence
+        else: logits = step_output['logits']/temperature
+        return logits, step_output['misc_output']
+
     def get_next_probs(self, x, rnn_args=None, temperature=1.0,
                          max_batch_size=128, device='cpu',
-                       return_forward_only=False,return_logits=True, **kwargs):
+                       return_forward_only=False,return_logits=True,
+                       resident=False, **kwargs):
         """Computes the probability distribution over the vocabulary for the next
         term in a sequence. Returns this and resulting hidden state. Can specify a
         temperature to divide the logits by prior to performing a softmax to change
-        how 'peaked' or 'flat' the distribution is."""
+        how 'peaked' or 'flat' the distribution is. If `resident` is set, the outputs
+        stay on `device` instead of being copied back to the host."""
 
         # Model temperature always defaults to 1, must set to None to overwrite
         self.model_iters += x.shape[0] * x.shape[1]
         if self.temperature is not None:
             temperature = self.temperature
-        xs = torch.split(x,max_batch_size)
-        if rnn_args is not None:
-            if isinstance(rnn_args,tuple):
-                # Need to split up hidden states
-                assert x.shape[0] == rnn_args[0].shape[1] == rnn_args[1].shape[1],\
-                    f"Sizes were x: {x.shape}, rnn1 {rnn_args[0].shape}, rnn2 {rnn_args[1].shape}"
-                rnn_args = list(zip(*(torch.split(rnn_args[0], max_batch_size, dim =1),
-                                torch.split(rnn_args[1],max_batch_size, dim =1))))
-            else: rnn_args = torch.split(rnn_args,max_batch_size)
-        else: rnn_args = [None]*len(xs)
-
-        prob_outputs = []
-        step_outputs = []
-        for x, rnn_arg, in zip(xs, rnn_args):
-            if isinstance(rnn_arg,tuple):
-                rnn_arg_cuda = (rnn_arg[0].to(device),rnn_arg[1].to(device))
-                assert x.shape[0] == rnn_arg[0].shape[1] == rnn_arg[1].shape[1],\
-                    f"Sizes were x: {x.shape[0]}, rnn1 {rnn_arg[0].shape[1]}, rnn2 {rnn_arg[1].shape[1]}"
-            elif rnn_arg is not None: rnn_arg.to(device)
-            step_output = self.forward(src=x.to(device), rnn_args=rnn_arg_cuda if rnn_arg else None)
-            if not return_forward_only:
-                logits = step_output["logits"][:, -1, :] / temperature # last position in the sequence
-            else: logits = step_output['logits']/temperature
+        if isinstance(rnn_args,tuple):
+            assert x.shape[0] == rnn_args[0].shape[1] == rnn_args[1].shape[1],\
+                f"Sizes were x: {x.shape}, rnn1 {rnn_args[0].shape}, rnn2 {rnn_args[1].shape}"
+
+        num_rows = x.shape[0]
+        out_device = device if resident else 'cpu'
+        prob_output, step_output = None, None
+        for start in range(0, num_rows, max_batch_size):
+            end = min(start + max_batch_size, num_rows)
+            rnn_arg = (None if rnn_args is None else
+                       _map_hidden_state(rnn_args, lambda s: s[:, start:end]))
+            logits, states = self._forward_next(x[start:end], rnn_arg, temperature,
+                                                device, return_forward_only)
             if not return_logits:
-                probs = torch.softmax(logits, dim=-1)
-                prob_outputs.append(probs.cpu())
-            else:
-                prob_outputs.append(logits.cpu())
-            step_outputs.append(_tup_cpu(step_output['misc_output']))
-
-        # If we have a LSTM
-        if isinstance(step_outputs[0], tuple):
-            hidden, context = zip(*step_outputs)
-            hidden = torch.cat(hidden, dim = 1)
-            context = torch.cat(context, dim = 1)
-            step_output = (hidden, context)
-        # If we just have a single hidden state
-        else:
-            step_output = torch.cat(step_outputs,dim = 1)
+                logits = torch.softmax(logits, dim=-1)
 
-        return torch.cat(prob_outputs,dim = 0), step_output
+            # Everything fits in one chunk, no need to split or concatenate
+            if end == num_rows and start == 0:
+                return logits.to(out_device), _map_hidden_state(states, lambda s: s.to(out_device))
+
+            # Otherwise write each chunk into a single preallocated output
+            if prob_output is None:
+                prob_output = logits.new_empty((num_rows,) + logits.shape[1:], device=out_device)
+                step_output = _map_hidden_state(states, lambda s: s.new_empty(
+                    (s.shape[0], num_rows) + s.shape[2:], device=out_device))
+            prob_output[start:end] = logits
+            if isinstance(states, tuple):
+                for out_state, state in zip(step_output, states):
+                    out_state[:, start:end] = state
+            else: step_output[:, start:end] = states
+
+        return prob_output, step_output
 
     @torch.no_grad()
     def sample(
@@ -202,6 +212,93 @@ class CausalLM(LM, nn.Module):
         return output
 
 
+class OneHotLookupRNN(object):
+    """Inference view of a batch first RNN, GRU or LSTM that was trained on one-hot
+    inputs. Multiplying a one-hot vector by `weight_ih_l0` just selects a column, so
+    on single token steps (sampling and beam search) the first layer gathers those
+    columns instead of building a (batch x vocab) input. Later layers reuse the
+    original parameters, so nothing is copied and the state dict of the wrapped
+    model is unchanged.
+
+    Multi-token inputs (history encoding) go through the wrapped RNN on one-hot
+    inputs, so they keep the fused (cuDNN) kernel. Outputs match the one-hot path up
+    to float rounding, not bit for bit. See scripts/benchmark_embedding_lookup.py."""
+
+    def __init__(self, rnn):
+        assert rnn.batch_first and not rnn.bidirectional,\
+            "Only batch first, unidirectional RNNs are supported"
+        self.rnn, self.mode = rnn, rnn.mode
+        self.params = list(rnn.parameters())
+        self.tail = None
+        if rnn.num_layers > 1:
+            extra_args = {'nonlinearity': rnn.nonlinearity} if isinstance(rnn, nn.RNN) else {}
+            self.tail = type(rnn)(
+                input_size=rnn.hidden_size,
+                hidden_size=rnn.hidden_size,
+                num_layers=rnn.num_layers - 1,
+                bias=rnn.bias,
+                batch_first=True,
+                **extra_args,
+            ).eval()
+            param_names = ['weight_ih', 'weight_hh'] + (['bias_ih', 'bias_hh'] if rnn.bias else [])
+            for layer in range(1, rnn.num_layers):
+                for name in param_names:
+                    setattr(self.tail, f"{name}_l{layer-1}", getattr(rnn, f"{name}_l{layer}"))
+
+    def is_stale(self, rnn):
+        # A different RNN, or parameters swapped out (e.g. load_state_dict(assign=True))
+        params = list(rnn.parameters())
+        return rnn is not self.rnn or len(params) != len(self.params) or\
+            any(p is not q for p, q in zip(params, self.params))
+
+    def _cell(self, x_proj, h, c):
+        # Same gate layout as the ATen cells, matches the one-hot path up to float rounding
+        rnn = self.rnn
+        h_proj = F.linear(h, rnn.weight_hh_l0, rnn.bias_hh_l0 if rnn.bias else None)
+        if self.mode == 'LSTM':
+            ingate, forgetgate, cellgate, outgate = (h_proj + x_proj).chunk(4, dim=-1)
+            c = (forgetgate.sigmoid() * c) + (ingate.sigmoid() * cellgate.tanh())
+            return outgate.sigmoid() * c.tanh(), c
+        elif self.mode == 'GRU':
+            x_r, x_z, x_n = x_proj.chunk(3, dim=-1)
+            h_r, h_z, h_n = h_proj.chunk(3, dim=-1)
+            reset_gate, input_gate = (h_r + x_r).sigmoid(), (h_z + x_z).sigmoid()
+            new_gate = (x_n + h_n * reset_gate).tanh()
+            return (h - new_gate) * input_gate + new_gate, None
+        elif self.mode == 'RNN_RELU':
+            return (h_proj + x_proj).relu(), None
+        return (h_proj + x_proj).tanh(), None
+
+    def __call__(self, src, rnn_args=None):
+        rnn = self.rnn
+        is_lstm = self.mode == 'LSTM'
+        if src.shape[1] > 1:
+            return rnn(F.one_hot(src, num_classes=rnn.input_size).float(), rnn_args)
+        # (batch, seq_len, gates * hidden) columns of the first layer's input weights
+        x_proj = F.embedding(src, rnn.weight_ih_l0.t())
+        if rnn.bias: x_proj = x_proj + rnn.bias_ih_l0
+
+        if rnn_args is None:
+            h_0 = x_proj.new_zeros((rnn.num_layers, src.shape[0], rnn.hidden_size))
+            rnn_args = (h_0, torch.zeros_like(h_0)) if is_lstm else h_0
+        h, c = (rnn_args[0][0], rnn_args[1][0]) if is_lstm else (rnn_args[0], None)
+
+        outputs = []
+        for t in range(src.shape[1]):
+            h, c = self._cell(x_proj[:, t], h, c)
+            outputs.append(h)
+        rnn_out = torch.stack(outputs, dim=1)
+
+        if self.tail is None:
+            return rnn_out, ((h.unsqueeze(0), c.unsqueeze(0)) if is_lstm else h.unsqueeze(0))
+        if is_lstm:
+            rnn_out, (h_n, c_n) = self.tail(rnn_out, (rnn_args[0][1:].contiguous(),
+                                                      rnn_args[1][1:].contiguous()))
+            return rnn_out, (torch.cat((h.unsqueeze(0), h_n)), torch.cat((c.unsqueeze(0), c_n)))
+        rnn_out, h_n = self.tail(rnn_out, rnn_args[1:].contiguous())
+        return rnn_out, torch.cat((h.unsqueeze(0), h_n))
+
+
 class MaskedLM(LM, nn.Module):
 
     def __init__(
@@ -261,6 +358,7 @@ def get_model(args):
             embed_dim=args.hidden_size,
             rnn=rnn,
         )
+        model.embedding_lookup = args.embedding_lookup
 
     model.to(args.device)
     model.eval()
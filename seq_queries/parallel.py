@@ -0,0 +1,132 @@
+#################################################################################
+#
+#             Project Title:  Query-level Parallelism
+#             Date:           2022-06-10
+#
+#################################################################################
+
+
+#################################################################################
+#   Module Imports
+#################################################################################
+
+import multiprocessing as mp
+
+import torch
+
+from .utils import query_generator
+
+#################################################################################
+#   Function-Class Declaration
+#################################################################################
+
+# Inherited by forked workers, so the model and args are never pickled
+_WORKER_STATE = {}
+
+def query_job(index, hist, estimate=None, **overrides):
+    """
+    A single estimator call: `hist` (or a batch of histories for batched
+    estimators) of query `index`, run with vars(args) updated by `overrides`.
+    `estimate` defaults to args.estimate_type.
+    """
+    return {
+        "index": index,
+        "hist": hist,
+        "estimate": estimate,
+        "overrides": overrides,
+    }
+
+def _job_kwargs(job, args):
+    return dict(vars(args), **job['overrides'])
+
+def run_query_job(job, args=None):
+    args = _WORKER_STATE['args'] if args is None else args
+    kwargs = _job_kwargs(job, args)
+    estimate = job['estimate'] or args.estimate_type
+    if args.per_query_seed:
+        # Packed MC batches are rejected with per_query_seed, packed beam search draws nothing
+        kwargs['generator'] = query_generator(args.seed, getattr(args, 'dataset', None),
+                                              job['index'], estimate.__name__, device=args.device)
+    return estimate(job['hist'], **kwargs)
+
+class QueryPool(object):
+
+    """
+    Pool of forked query workers for one run. Workers are forked on first use, so they
+    see args as set up for the first batch, and every later batch reuses them. They
+    share the parent's model (weights are moved to shared memory) and run at one
+    thread each.
+    """
+
+    def __init__(self, args, num_workers):
+        self.args = args
+        self.num_workers = num_workers
+        self.pool = None
+
+    def imap(self, jobs):
+        if self.pool is None:
+            assert self.args.per_query_seed,\
+                "Query workers need --per_query_seed, otherwise samples depend on query order"
+            assert str(self.args.device) == 'cpu',\
+                f"Query workers only run on cpu, got device {self.args.device}"
+            self.args.model.share_memory()
+            _WORKER_STATE['args'] = self.args
+            self.pool = mp.get_context('fork').Pool(self.num_workers, initializer=torch.set_num_threads,
+                                                    initargs=(1,))
+        chunksize = max(1, len(jobs) // (4 * self.num_workers))
+        return self.pool.imap(run_query_job, jobs, chunksize=chunksize)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        _WORKER_STATE.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.pool is not None and exc[0] is not None:
+            self.pool.terminate()
+        self.close()
+
+
+def imap_queries(jobs, args, num_workers=1, pool=None):
+    """
+    Yields the output of every job, in order. With more than one worker, jobs are
+    handed out in shards to a pool of forked processes (`pool`, or one just for
+    these jobs) which stream their outputs back. With --per_query_seed, outputs
+    match a serial run that also uses one thread (torch.set_num_threads(1)),
+    otherwise they only agree up to float rounding.
+
+    With an estimate cache on args, cached jobs are read back in the parent and
+    only the misses are run (and then stored).
+    """
+    cache = getattr(args, 'estimate_cache', None)
+    if cache is None:
+        yield from _imap_jobs(jobs, args, num_workers, pool)
+        return
+
+    keys = [cache.key(args.model, (job['estimate'] or args.estimate_type).__name__,
+                      job['index'], job['hist'], _job_kwargs(job, args))
+            for job in jobs]
+    cached = [cache.get(key) for key in keys]
+    computed = _imap_jobs([job for job, output in zip(jobs, cached) if output is None],
+                          args, num_workers, pool)
+    for key, output in zip(keys, cached):
+        if output is None:
+            output = next(computed)
+            cache.put(key, output)
+        yield output
+
+def _imap_jobs(jobs, args, num_workers, pool=None):
+    if num_workers <= 1 or not jobs:
+        for job in jobs:
+            yield run_query_job(job, args)
+        return
+    if pool is not None:
+        yield from pool.imap(jobs)
+        return
+    with QueryPool(args, num_workers) as pool:
+        yield from pool.imap(jobs)
@@ -0,0 +1,221 @@
+#################################################################################
+#
+#             Project Title:  Experiment Result Storage
+#             Date:           2022-06-11
+#
+#################################################################################
+
+
+#################################################################################
+#   Module Imports
+#################################################################################
+
+import os
+import json
+import hashlib
+
+import numpy as np
+import torch
+
+from .utils import read_pkl, write_pkl, read_json, write_json
+
+#################################################################################
+#   Function-Class Declaration
+#################################################################################
+
+# Set while a run is going, so they do not identify it
+_RUNTIME_ARGS = ['model', 'text_dict', 'prefix_cache', 'estimate_cache', 'generator', 'excluded_terms',
+                 'seq_len', 'disable_tqdm', 'query_workers', 'shard_dir', 'scratch_dir',
+                 'estimate_cache_dir', 'estimate_cache_mb']
+
+def _json_safe(items, exclude=()):
+    """JSON-safe entries of a dict, with functions by name. Anything else
+    that cannot be serialized is dropped."""
+    safe = {}
+    for key, value in sorted(items.items()):
+        if key in exclude:
+            continue
+        if callable(value) and hasattr(value, '__name__'):
+            value = value.__name__
+        try:
+            json.dumps(value)
+        except TypeError:
+            continue
+        safe[key] = value
+    return safe
+
+def run_description(args, exclude=()):
+    """JSON-safe view of the arguments that identify a run"""
+    return _json_safe(vars(args), exclude=list(_RUNTIME_ARGS) + list(exclude))
+
+
+def _replace(write_func, data, path):
+    # Write then rename, so a crash never leaves a half written shard or manifest
+    write_func(data, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+class ShardStore(object):
+
+    """
+    Per-batch result shards of one run, with a JSON manifest of the completed
+    batches and their query indices. Runs are kept apart by a hash of their
+    arguments under `shard_dir`, so sweeps can share one directory. A restarted
+    run skips the batches in the manifest, and `shards` reads everything back
+    in batch order for consolidation, one shard at a time.
+    """
+
+    def __init__(self, shard_dir, description):
+        key = hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()[:16]
+        self.run_dir = os.path.join(shard_dir, key)
+        self.manifest_path = os.path.join(self.run_dir, 'manifest.json')
+        os.makedirs(self.run_dir, exist_ok=True)
+        if os.path.exists(self.manifest_path):
+            self.manifest = read_json(self.manifest_path)
+        else:
+            self.manifest = {"args": description, "shards": {}}
+
+    def is_done(self, batch_index):
+        return str(batch_index) in self.manifest['shards']
+
+    def write(self, batch_index, query_indices, data, settings=None):
+        """Stores the outputs of one batch (a list of per-query dicts) and the
+        settings it left on args"""
+        filename = f"shard_{batch_index:05d}.pkl"
+        _replace(write_pkl, {"data": data, "settings": settings or {}},
+                 os.path.join(self.run_dir, filename))
+        self.manifest['shards'][str(batch_index)] = {
+            "file": filename,
+            "queries": list(query_indices),
+        }
+        _replace(write_json, self.manifest, self.manifest_path)
+
+    def read(self, batch_index):
+        return read_pkl(os.path.join(self.run_dir, self.manifest['shards'][str(batch_index)]['file']))
+
+    def completed_queries(self):
+        return sorted([q for shard in self.manifest['shards'].values() for q in shard['queries']])
+
+    def shards(self):
+        for batch_index in sorted(self.manifest['shards'], key=int):
+            yield self.read(batch_index)
+
+
+#######################################################################
+# Columnar result store
+#######################################################################
+
+MANIFEST = 'manifest.json'
+
+def _as_array(value):
+    if isinstance(value, torch.Tensor):
+        return value.detach().cpu().numpy()
+    if isinstance(value, np.ndarray):
+        return value
+    if isinstance(value, (list, tuple)) and len(value):
+        value = [v.detach().cpu().numpy() if isinstance(v, torch.Tensor) else v for v in value]
+        try:
+            array = np.asarray(value)
+        except (ValueError, TypeError):
+            # Ragged lists raise on recent numpy instead of giving an object array
+            return None
+        if array.dtype != object:
+            return array
+    return None
+
+def write_columnar(output, path):
+    """
+    Writes an estimates dict as a directory with one .npy file per array
+    artifact and a JSON manifest holding their shapes, the metadata and any
+    other JSON-safe entries (e.g. prefix cache stats). Anything else (e.g.
+    ragged lists of tensors) is pickled on its own. The manifest is written
+    last, so a directory without one is incomplete.
+    """
+    os.makedirs(path, exist_ok=True)
+    manifest = {"artifacts": {}, "metadata": {}, "extra": {}, "pickled": {}}
+    for key, value in output.items():
+        if key == 'metadata':
+            manifest['metadata'] = _json_safe(value)
+            continue
+        array = _as_array(value)
+        if array is None:
+            if _json_safe({key: value}):
+                manifest['extra'][key] = _json_safe({key: value})[key]
+            else:
+                write_pkl(value, os.path.join(path, f"{key}.pkl"))
+                manifest['pickled'][key] = f"{key}.pkl"
+            continue
+        np.save(os.path.join(path, f"{key}.npy"), array)
+        manifest['artifacts'][key] = {
+            "file": f"{key}.npy",
+            "shape": list(array.shape),
+            "dtype": str(array.dtype),
+        }
+    write_json(manifest, os.path.join(path, MANIFEST))
+
+
+class ColumnarResults(object):
+
+    """
+    Read-only view of a columnar result directory. Artifacts are memory-mapped
+    on first access, so only the slices that are indexed are ever read from disk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest = read_json(os.path.join(path, MANIFEST))
+        self.arrays = {}
+
+    def keys(self):
+        return (list(self.manifest['artifacts']) + list(self.manifest['extra']) +
+                list(self.manifest.get('pickled', {})) + ['metadata'])
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __getitem__(self, key):
+        if key == 'metadata':
+            return self.manifest['metadata']
+        if key in self.manifest['extra']:
+            return self.manifest['extra'][key]
+        if key in self.manifest.get('pickled', {}):
+            return read_pkl(os.path.join(self.path, self.manifest['pickled'][key]))
+        if key not in self.arrays:
+            artifact = self.manifest['artifacts'][key]
+            self.arrays[key] = np.load(os.path.join(self.path, artifact['file']), mmap_mode='r')
+        return self.arrays[key]
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+
+def _columnar_path(path):
+    # Result paths keep their .pkl names, the columnar directory drops the suffix
+    return path[:-len('.pkl')] if path.endswith('.pkl') else path
+
+def save_results(output, path):
+    """Writes the estimates of a run in the columnar format, at `path` without .pkl"""
+    path = _columnar_path(path)
+    write_columnar(output, path)
+    return path
+
+def results_exist(path):
+    return os.path.exists(os.path.join(_columnar_path(path), MANIFEST)) or os.path.isfile(path)
+
+def read_results(path):
+    """Columnar results for a result path (with or without .pkl). Legacy pickled
+    estimates are loaded whole, with their tensors as numpy arrays, so callers
+    can treat both alike."""
+    if os.path.exists(os.path.join(_columnar_path(path), MANIFEST)):
+        return ColumnarResults(_columnar_path(path))
+    data = read_pkl(path)
+    if not isinstance(data, dict):
+        return data
+    return {key: (value.detach().cpu().numpy() if isinstance(value, torch.Tensor) else value)
+            for key, value in data.items()}
+
+def convert_pkl(pkl_path, path=None):
+    """Converts a legacy pickled estimates file to a columnar directory next to it"""
+    path = path or _columnar_path(pkl_path)
+    write_columnar(read_pkl(pkl_path), path)
+    return path
@@ -23,31 +23,112 @@ import torch.nn as nn
 
 from tqdm import tqdm
 from .model import CausalLM, MaskedLM
-from .utils import top_k_top_p_filtering, min_variance_top_k, _set_random_seed
+from .utils import (top_k_top_p_filtering, min_variance_top_k, select_frontier, sample_categorical, _set_random_seed, _expand_rows,
+                    _expand_hidden_state, _map_hidden_state, _cat_hidden_states, _index_hidden_state)
 from .tree import BeamSearchSampleTree
+from .stats import RunningMoments, get_stopping_rule
+from .cache import SpilledStates, _state_nbytes, _num_rows
 
 #################################################################################
 #   Function-Class Declaration
 #################################################################################
 
+@torch.no_grad()
+def encode_hist(hists, model, batch_size=128, device='cpu', resident=False, prefix_cache=None, **kwargs):
+    """Runs a history (or stacked histories) through the model a single time.
+    The resulting next token logits and hidden state can then be expanded to every
+    sample batch instead of re-encoding the history. Not counted in model iterations.
+    With a `prefix_cache`, each history starts from its deepest cached prefix."""
+    if len(hists.shape) == 1: hists = hists.unsqueeze(0)
+    model_iters = model.model_iters
+    if prefix_cache is None:
+        logits, rnn_args = model.get_next_probs(hists, max_batch_size=batch_size, device=device,
+                                                return_logits=True, resident=resident)
+    else:
+        prefix_cache.validate((id(model), model.temperature))
+        encoded = [_encode_hist_from_prefix(hist, model, batch_size, device, resident, prefix_cache)
+                   for hist in hists]
+        logits = torch.cat([e[0] for e in encoded], dim=0)
+        rnn_args = _cat_hidden_states([e[1] for e in encoded])
+    model.model_iters = model_iters
+    return {
+        "logits": logits,
+        "rnn_args": rnn_args,
+    }
+
+def _encode_hist_from_prefix(hist, model, batch_size, device, resident, prefix_cache):
+    depth, state = prefix_cache.lookup(hist)
+    logits, rnn_args = (None, None) if state is None else (state['logits'], state['rnn_args'])
+    # The uncached suffix is encoded a chunk at a time, each chunk in one call. Only the
+    # full history and the trie's checkpoint lengths are kept, not every prefix length
+    # (a GPT-2 state holds the cache of its whole prefix).
+    for end in prefix_cache.checkpoints(depth, hist.shape[0]):
+        logits, rnn_args = model.get_next_probs(hist[depth:end].unsqueeze(0), rnn_args=rnn_args,
+                                                max_batch_size=batch_size, device=device,
+                                                return_logits=True, resident=resident)
+        prefix_cache.insert(hist[:end], {"logits": logits, "rnn_args": rnn_args},
+                            num_encoded=end - depth)
+        depth = end
+    return logits, rnn_args
+
+def _index_hist_cache(hist_cache, inds):
+    return {
+        "logits": hist_cache['logits'][inds.to(hist_cache['logits'].device)],
+        "rnn_args": _index_hidden_state(hist_cache['rnn_args'], inds),
+    }
+
+def _expand_hist_cache(hist_cache, num_rows):
+    return (_expand_rows(hist_cache['logits'], num_rows, 0),
+            _expand_hidden_state(hist_cache['rnn_args'], num_rows))
+
+def _per_row_excluded(excluded_terms):
+    # Batched estimators pass one row of excluded terms per history: (num_rows, num_excluded)
+    return torch.is_tensor(excluded_terms) and len(excluded_terms.shape) == 2
+
+def _exclude_terms(logits, excluded_terms):
+    if _per_row_excluded(excluded_terms):
+        if not excluded_terms.shape[-1]:
+            return logits
+        index = excluded_terms.to(logits.device).view(-1, *[1]*(len(logits.shape)-2), excluded_terms.shape[-1])
+        return logits.scatter(-1, index.expand(*logits.shape[:-1], -1), -float('inf'))
+    logits = logits.clone()
+    logits[..., excluded_terms] = -float('inf')
+    return logits
+
 def uniform_proposal(hists, seq_len, model, vocab_size, excluded_terms,
-                     batch_size, device='cpu', **kwargs):
+                     batch_size, device='cpu', hist_cache=None, resident=False, generator=None, **kwargs):
     assert(len(hists.shape) == 2)
 
     # Uniformly sample across the restricted vocabulary indices
-    samples = torch.randint(low=0, high=vocab_size-len(excluded_terms), size=(hists.shape[0], seq_len), device=hists.device)
-    for item in sorted(excluded_terms):
-        samples[samples>=item] += 1
+    num_excluded = excluded_terms.shape[-1] if _per_row_excluded(excluded_terms) else len(excluded_terms)
+    samples = torch.randint(low=0, high=vocab_size-num_excluded, size=(hists.shape[0], seq_len), generator=generator,
+                            device=hists.device if generator is None else generator.device).to(hists.device)
+    if _per_row_excluded(excluded_terms):
+        excluded_terms = excluded_terms.sort(dim=-1).values.to(hists.device)
+        for j in range(num_excluded):
+            samples += (samples >= excluded_terms[:, j:j+1]).long()
+    else:
+        for item in sorted(excluded_terms):
+            samples[samples>=item] += 1
     assert(samples.max() < vocab_size)
 
-    logits,hidden_states = model.get_next_probs(torch.cat((hists, samples), dim=-1), return_forward_only=True,
-                                                device=device, return_logits=True, max_batch_size=batch_size)  #, device=device)
-    model.model_iters -= hists.shape[0]*hists.shape[1]
+    if hist_cache is not None:
+        # Only the samples need to be run, the history logits predict the first sample
+        hist_logits, rnn_args = _expand_hist_cache(hist_cache, hists.shape[0])
+        logits,hidden_states = model.get_next_probs(samples, rnn_args=rnn_args, return_forward_only=True,
+                                                    device=device, return_logits=True, max_batch_size=batch_size,
+                                                    resident=resident)
+        logits = torch.cat((hist_logits.unsqueeze(1), logits), dim=1)
+    else:
+        logits,hidden_states = model.get_next_probs(torch.cat((hists, samples), dim=-1), return_forward_only=True,
+                                                    device=device, return_logits=True, max_batch_size=batch_size,
+                                                    resident=resident)
+        model.model_iters -= hists.shape[0]*hists.shape[1]
     model_log_prob = torch.log_softmax(logits, dim=-1)[..., -(seq_len+1):-1, :]
-    model_log_prob = torch.gather(model_log_prob, dim=-1, index=samples.unsqueeze(-1)).squeeze(-1).sum(dim=-1)  # grab specific log probabilities
+    model_log_prob = torch.gather(model_log_prob, dim=-1, index=samples.to(logits.device).unsqueeze(-1)).squeeze(-1).sum(dim=-1)  # grab specific log probabilities
 
     return {
-        "proposal_log_prob": -seq_len * np.log(vocab_size - len(excluded_terms)),
+        "proposal_log_prob": -seq_len * np.log(vocab_size - num_excluded),
         "model_log_prob": model_log_prob.unsqueeze(-1),
         "samples": samples,
         "logits": logits,
@@ -56,51 +137,98 @@ def uniform_proposal(hists, seq_len, model, vocab_size, excluded_terms,
         "next_log_dist": torch.log_softmax(logits, dim=-1)[..., -1, :],
     }
 
+def _prefix_groups(hists, dedup_threshold):
+    """Index of every row among the unique histories, and one row of each unique
+    history. (None, None) if more than dedup_threshold of the rows are unique."""
+    _, groups = torch.unique(hists, dim=0, return_inverse=True)
+    num_groups = groups.max().item() + 1
+    if num_groups > dedup_threshold * hists.shape[0]:
+        return None, None
+    reps = torch.empty(num_groups, dtype=torch.long, device=hists.device)
+    reps.scatter_(0, groups, torch.arange(hists.shape[0], device=hists.device))
+    return groups, reps
+
 def lm_proposal(hists, seq_len, model, vocab_size, excluded_terms,
-                batch_size=128,device='cpu',top_k=0, top_p=1.0, temperature=1.0,  **kwargs):
+                batch_size=128,device='cpu',top_k=0, top_p=1.0, temperature=1.0,
+                hist_cache=None, resident=False, dedup_prefixes=False, dedup_threshold=0.5, generator=None, **kwargs):
     assert(len(hists.shape) == 2)
 
     proposal_log_prob, model_log_prob = 0.0, 0.0
     intermediate_query_probs = []; entropy_probs = []
     samples = []; all_logits = []; started = False
     last_sample, rnn_args = hists, None
-    for _ in range(seq_len):
+
+    # With dedup_prefixes, rows with the same prefix share one model row: `groups` maps
+    # every sample to its row of the hidden state, until the prefixes are mostly unique
+    groups, dedup_savings = None, []
+    def _next_step(last_sample, rnn_args, groups):
+        if groups is not None:
+            keys = groups.to(last_sample.device) * vocab_size + last_sample.squeeze(-1)
+            unique_keys, inverse = torch.unique(keys, return_inverse=True)
+            if unique_keys.shape[0] <= dedup_threshold * keys.shape[0]:
+                parents = torch.div(unique_keys, vocab_size, rounding_mode='trunc')
+                logits, rnn_args = model.get_next_probs(
+                    (unique_keys % vocab_size).unsqueeze(-1),
+                    rnn_args=_index_hidden_state(rnn_args, parents.to(_state_device(rnn_args))),
+                    max_batch_size=batch_size, device=device, return_logits=True, resident=resident)
+                return (logits[inverse.to(logits.device)], rnn_args, inverse,
+                        1 - unique_keys.shape[0] / keys.shape[0])
+            # Mostly unique by now, fan the states back out and stop deduplicating
+            rnn_args = _index_hidden_state(rnn_args, groups.to(_state_device(rnn_args)))
         logits, rnn_args = model.get_next_probs(last_sample, rnn_args=rnn_args, max_batch_size=batch_size,
-                                                device=device, return_logits=True)
+                                                device=device, return_logits=True, resident=resident)
+        return logits, rnn_args, None, 0.0
+
+    for i in range(seq_len):
+        if i == 0:
+            groups, reps = _prefix_groups(hists, dedup_threshold) if dedup_prefixes else (None, None)
+            if hist_cache is not None:
+                logits, rnn_args = _expand_hist_cache(hist_cache, hists.shape[0])
+                if groups is not None:
+                    rnn_args = _index_hidden_state(rnn_args, reps.to(_state_device(rnn_args)))
+                dedup_savings.append(0.0)
+            else:
+                logits, rnn_args = model.get_next_probs(hists if groups is None else hists[reps], rnn_args=None,
+                                                        max_batch_size=batch_size, device=device,
+                                                        return_logits=True, resident=resident)
+                if groups is not None: logits = logits[groups.to(logits.device)]
+                dedup_savings.append(0.0 if groups is None else 1 - reps.shape[0] / hists.shape[0])
+        else:
+            logits, rnn_args, groups, saving = _next_step(last_sample, rnn_args, groups)
+            dedup_savings.append(saving)
         if not started: model.model_iters = 0; started= True
         all_logits.append(logits)
 
-        proposal_logits = logits.clone()
-        proposal_logits[..., excluded_terms] = -float('inf')
+        proposal_logits = _exclude_terms(logits, excluded_terms)
         proposal_logits = torch.log_softmax(top_k_top_p_filtering(proposal_logits/temperature, top_k=top_k, top_p=top_p), dim=-1)
         logits = torch.log_softmax(logits, dim=-1)
 
         if isinstance(model_log_prob,float) and isinstance(proposal_log_prob,float):
             intermediate_query_probs.append(logits.exp())
         else: intermediate_query_probs.append((logits + model_log_prob.unsqueeze(-1)
-                                               - proposal_log_prob.unsqueeze(-1)).exp().cpu())
+                                               - proposal_log_prob.unsqueeze(-1)).exp())
 
-        last_sample = torch.distributions.Categorical(logits=proposal_logits).sample().unsqueeze(-1)
+        last_sample = sample_categorical(proposal_logits, generator)
         proposal_log_prob += torch.gather(proposal_logits, dim=-1, index=last_sample).squeeze()
         model_log_prob += torch.gather(logits, dim=-1, index=last_sample).squeeze()
 
         entropy_probs.append(-proposal_log_prob)
         samples.append(last_sample)
 
-    logits, _ = model.get_next_probs(last_sample, rnn_args=rnn_args, device=device,
-                                     max_batch_size=batch_size,return_logits=True)  # get last subsequent distribution
+    logits, _, _, saving = _next_step(last_sample, rnn_args, groups)  # get last subsequent distribution
+    dedup_savings.append(saving)
     all_logits.append(logits)
     logits = torch.log_softmax(logits, dim=-1)
 
     # Use this for frequentist statistics
-    last_sample = torch.distributions.Categorical(logits=logits).sample().unsqueeze(-1)
+    last_sample = sample_categorical(logits, generator)
     # batch (batch_size) (1 if in excluded terms else 0)
     proposal_log_prob += torch.gather(logits, dim=-1, index=last_sample).squeeze(-1)
     model_log_prob += torch.gather(logits, dim=-1, index=last_sample).squeeze(-1)
     entropy_probs.append(-proposal_log_prob)
 
     samples = torch.cat(samples, dim=-1)
-    return {
+    out_dict = {
         "proposal_log_prob": proposal_log_prob.unsqueeze(-1),
         "model_log_prob": model_log_prob.unsqueeze(-1),
         "samples": samples,
@@ -110,6 +238,10 @@ def lm_proposal(hists, seq_len, model, vocab_size, excluded_terms,
         "intermediate_query_probs": torch.stack(intermediate_query_probs,dim=1),
         "entropy_probs": torch.stack(entropy_probs,dim=-1),
     }
+    if dedup_prefixes:
+        # Fraction of forward rows saved at each model step
+        out_dict['dedup_savings'] = torch.Tensor(dedup_savings)
+    return out_dict
 
 
 @torch.no_grad()
@@ -117,7 +249,13 @@ def mc_pseudo_gt(hist, num_mc_samples, seq_len, model, excluded_terms, proposal_
                  min_num_mc_samples, max_num_mc_samples, variance_epsilon, vocab_size,
                  var_check_interval=1000, batch_size=128,temperature=1, top_k=0, top_p=0.0,
                  device='cpu', cat_list = ['sample_estimates', 'intermediate_query_probs'],
-                sub_estimates=None,**kwargs):
+                sub_estimates=None,share_hist_state=True,resident=False,prefix_cache=None,
+                store_samples=False,ci_half_width=0.0,ci_relative=False,ci_delta=0.05,
+                dedup_prefixes=False,dedup_threshold=0.5,generator=None,**kwargs):
+    """Samples until the variance of every estimate drops below variance_epsilon
+    (or, with a stopping rule, until every confidence interval is tight enough).
+    Only running moments are kept (each variance check is O(seq_len x vocab)), unless
+    store_samples asks for the full (samples x seq_len+1 x vocab) tensor as well."""
 
     # _set_random_seed(int(time.time()) %2**32)
     model.model_iters = 0
@@ -125,14 +263,20 @@ def mc_pseudo_gt(hist, num_mc_samples, seq_len, model, excluded_terms, proposal_
     assert(len(excluded_terms) == 0) # For most experiments, this will be 1. For Q2 it is zero
     temp_out_dict = defaultdict(list)
     out_dict = defaultdict(list)
+    moments = {item: RunningMoments() for item in cat_list}
+    stopping_rule = get_stopping_rule(ci_half_width, ci_relative, ci_delta, _estimate_range(proposal_func, temperature))
     samp_est_var = 1.0 # Some general seeding
+    converged = False
     total_samples = 0
     remaining_samples = min_num_mc_samples
     model_iters = 0
-    while ((samp_est_var > variance_epsilon) and
+    hist_cache = (encode_hist(hist, model, batch_size, device, resident, prefix_cache)
+                  if share_hist_state else None)
+    while ((not converged) and
            (total_samples < max_num_mc_samples)):
-        out_dict = defaultdict(list)
         total_samples += remaining_samples
+        # Moments of this interval, merged into the totals at the check
+        interval_moments = {item: RunningMoments() for item in cat_list}
         while remaining_samples > 0:
             sample_out = proposal_func(
                 hists=hist.unsqueeze(0).expand(min(remaining_samples, batch_size), -1),
@@ -145,41 +289,170 @@ def mc_pseudo_gt(hist, num_mc_samples, seq_len, model, excluded_terms, proposal_
                 device=device,
                 batch_size=batch_size,
                 temperature=temperature,
+                hist_cache=hist_cache,
+                resident=resident,
+                dedup_prefixes=dedup_prefixes,
+                dedup_threshold=dedup_threshold,
+                generator=generator,
             )
 
             remaining_samples -= batch_size
             term_log_prob = sample_out["next_log_dist"] + sample_out["model_log_prob"] - sample_out["proposal_log_prob"]
 
-            temp_out_dict['sample_estimates'].append(term_log_prob.exp().cpu())
-            temp_out_dict['intermediate_query_probs'].append(sample_out['intermediate_query_probs'].cpu())
+            batch_out = {
+                'sample_estimates': term_log_prob.exp().cpu(),
+                'intermediate_query_probs': sample_out['intermediate_query_probs'].cpu(),
+            }
+            for item in cat_list:
+                interval_moments[item].update(batch_out[item])
+                if store_samples:
+                    temp_out_dict[item].append(batch_out[item])
+            if 'dedup_savings' in sample_out:
+                temp_out_dict['dedup_savings'].append(sample_out['dedup_savings'])
 
             model_iters += model.model_iters
 
         for item in cat_list:
-            out_dict[item] = torch.cat(temp_out_dict[item],dim=0)
+            moments[item].merge(interval_moments[item])
 
-        samp_est_var = max(out_dict['sample_estimates'].var(dim=0).max(),
-                           out_dict['intermediate_query_probs'].var(dim=0).max(dim=0).values.max())
+        if stopping_rule is not None:
+            converged = _ci_done(stopping_rule, moments, excluded_terms)
+        else:
+            samp_est_var = max(moments['sample_estimates'].variance.max(),
+                               moments['intermediate_query_probs'].variance.max(dim=0).values.max())
+            converged = not (samp_est_var > variance_epsilon)
         remaining_samples = var_check_interval
 
-    out_dict['num_mc_samples'] = torch.LongTensor([total_samples]*out_dict['intermediate_query_probs'].shape[-2])
+    intermediate_query_probs = moments['intermediate_query_probs'].mean.float()
+    out_dict['num_mc_samples'] = torch.LongTensor([total_samples]*intermediate_query_probs.shape[-2])
+    out_dict['samples_used'] = torch.LongTensor([moments['sample_estimates'].count])
     out_dict['model_iters'] = torch.LongTensor([model_iters])
-    out_dict['sample_estimate_var'] =torch.var(out_dict['sample_estimates'],dim=0)
-    out_dict['intermediate_query_probs'] = torch.cat((out_dict['intermediate_query_probs'],
-                                                      out_dict['sample_estimates'].unsqueeze(1))
-                                                     ,dim=1).unsqueeze(0)
-    out_dict['sample_estimates'] =out_dict['sample_estimates'].mean(dim=0)
+    if temp_out_dict['dedup_savings']:
+        out_dict['dedup_savings'] = torch.stack(temp_out_dict['dedup_savings']).mean(dim=0)
+    out_dict['sample_estimate_var'] = moments['sample_estimates'].variance
+    out_dict['sample_estimates'] = moments['sample_estimates'].mean.float()
+    if store_samples:
+        for item in cat_list:
+            out_dict[item] = torch.cat(temp_out_dict[item],dim=0)
+        out_dict['intermediate_query_probs'] = torch.cat((out_dict['intermediate_query_probs'],
+                                                          out_dict['sample_estimates'].unsqueeze(1))
+                                                         ,dim=1).unsqueeze(0)
+        out_dict['sample_estimates'] = moments['sample_estimates'].mean.float()
+    else:
+        # (1, seq_len+1, vocab), averaged over samples
+        out_dict['intermediate_query_probs'] = torch.cat((intermediate_query_probs,
+                                                          out_dict['sample_estimates'].unsqueeze(0))
+                                                         ,dim=0).unsqueeze(0)
     return out_dict
 
 #######################################################################
 # Hybrid no replacement
 #######################################################################
 
+def _mc_moments(sub_estimates=None):
+    # Running moments in place of the per-sample (samples x ...) tensors
+    return {
+        'sample_estimates': RunningMoments(sub_estimates),
+        'intermediate_query_probs': RunningMoments(),
+        'excluded_mass': RunningMoments(),
+        'entropy_probs': RunningMoments(),
+    }
+
+def _add_mc_sample_out(out_dict, moments, sample_out, sample_estimates, excluded_terms,
+                       target_terms=None, store_samples=False):
+    intermediate_query_probs = sample_out['intermediate_query_probs'].cpu()
+    if intermediate_query_probs.numel():
+        intermediate_query_probs = torch.cat((intermediate_query_probs, sample_estimates.unsqueeze(1)), dim=1)
+    else: intermediate_query_probs = sample_estimates.unsqueeze(1)
+    moments['sample_estimates'].update(sample_estimates)
+    moments['intermediate_query_probs'].update(intermediate_query_probs)
+    moments['excluded_mass'].update(intermediate_query_probs[...,excluded_terms].sum(dim=-1))
+    if sample_out['entropy_probs'].numel():
+        moments['entropy_probs'].update(sample_out['entropy_probs'].cpu())
+    out_dict['last_sample'] = sample_out.get('last_sample',torch.Tensor([])).cpu()
+    if 'dedup_savings' in sample_out:
+        out_dict.setdefault('dedup_savings', []).append(sample_out['dedup_savings'])
+    if store_samples:
+        out_dict['samples'].append(sample_out['samples'].cpu())
+
+    if target_terms is not None:
+        samples = sample_out['samples']
+        last_sample = sample_out['last_sample']
+        if 'sample_counts' not in out_dict:
+            out_dict['sample_counts'] = []
+        new_cnts = [samples==i for i in target_terms]
+        last_cnts = [last_sample==i for i in target_terms]
+        new_cnts = torch.stack(new_cnts,dim=0).any(dim=0).any(dim=-1).long()
+        last_cnts =torch.stack(last_cnts,dim=0).any(dim=0).squeeze().long()
+        positive_samples = ((new_cnts == 0) & (last_cnts.sum() == 1)).float()
+        out_dict['sample_counts'].append(positive_samples.cpu())
+
+def _estimate_range(proposal_func, temperature=1):
+    # The untempered LM proposal renormalizes p over the allowed (and top-k/p filtered)
+    # tokens, so every weight p/q is at most 1 and a per-sample estimate (weight times a
+    # probability, or a sum of them over excluded terms) lies in [0, 1]. Tempered or
+    # uniform proposal weights have no useful a-priori range.
+    return 1.0 if proposal_func.__name__ == 'lm_proposal' and temperature == 1 else None
+
+def _ci_done(stopping_rule, moments, excluded_terms):
+    # The query estimate is the excluded-term mass at the last position,
+    # or the whole next token distribution when nothing is excluded
+    if len(excluded_terms):
+        return stopping_rule.done(moments['excluded_mass'], index=-1)
+    return stopping_rule.done(moments['sample_estimates'])
+
+def _finalize_mc_estimate(out_dict, moments, seq_len, model_iters,
+                          frequentist_test=False, sub_estimates=None):
+    out_dict['samples_used'] = torch.LongTensor([moments['sample_estimates'].count])
+    if 'dedup_savings' in out_dict:
+        out_dict['dedup_savings'] = torch.stack(out_dict['dedup_savings']).mean(dim=0)
+    if frequentist_test:
+        out_dict['frequentist_estimates'] = torch.cat(out_dict['sample_counts'],dim=0)
+    entropy_probs = moments['entropy_probs']
+    out_dict['entropy_probs'] = (entropy_probs.mean.float() if entropy_probs.count
+                                 else torch.tensor(float('nan')))
+    out_dict['sample_estimate_var'] = moments['excluded_mass'].variance
+    out_dict['intermediate_query_probs'] = moments['intermediate_query_probs'].mean.float().unsqueeze(0)
+    if sub_estimates:
+        # (sub-estimates x vocab)
+        out_dict['sample_estimates'] = moments['sample_estimates'].checkpoint_means().squeeze()
+        out_dict['sample_estimate_var'] = torch.stack(
+            # (vocab)
+            [out_dict['sample_estimates'][:s].var(dim=0).flatten()
+             for s in sorted(sub_estimates)
+        ]).squeeze()
+        if frequentist_test:
+            out_dict['frequentist_estimates'] = torch.stack(
+                # (vocab)
+                [out_dict['frequentist_estimates'][:s].mean(dim=0).flatten()
+                for s in sorted(sub_estimates)
+            ]).squeeze()
+
+            out_dict['sample_estimate_var'] = torch.stack(
+                # (vocab)
+                [out_dict['frequentist_estimates'][:s].var(dim=0).flatten()
+                for s in sorted(sub_estimates)
+            ]).squeeze()
+        out_dict['model_iters'] = torch.LongTensor(
+            [min(sub_est, out_dict['samples_used'].item()) * seq_len for sub_est in sorted(sub_estimates)]
+        )
+
+    else:
+        out_dict['sample_estimates'] = moments['sample_estimates'].mean.float().flatten()
+        out_dict['model_iters'] = torch.LongTensor([model_iters])
+        out_dict['sample_estimate_var'] =torch.var(out_dict['sample_estimates'],dim=0)
+        if frequentist_test:
+            out_dict['sample_estimate_var'] =torch.var(out_dict['frequentist_estimates'],dim=0)
+        out_dict['sample_estimate_mean'] =out_dict['sample_estimates'].mean(dim=0)
+    return out_dict
+
 @torch.no_grad()
 def mc_estimate(hist, num_mc_samples, seq_len, model, excluded_terms, proposal_func,
                 vocab_size, batch_size=128,temperature=1, top_k=0, top_p=0.0, device='cpu',
                 cat_list = ['sample_estimates','entropy_probs', 'intermediate_query_probs'],
-                flashy =False,frequentist_test=False,sub_estimates=None,**kwargs):
+                flashy =False,frequentist_test=False,sub_estimates=None,share_hist_state=True,
+                resident=False,prefix_cache=None,ci_half_width=0.0,ci_relative=False,ci_delta=0.05,
+                dedup_prefixes=False,dedup_threshold=0.5,generator=None,**kwargs):
     model.model_iters = 0
     model_iters = 0
     if frequentist_test:
@@ -187,7 +460,11 @@ def mc_estimate(hist, num_mc_samples, seq_len, model, excluded_terms, proposal_f
         excluded_terms = []
     assert(len(hist.shape) == 1)  # (hist_seq_len), Only conditions on a single history
     out_dict = defaultdict(list)
+    moments = _mc_moments(sub_estimates)
+    stopping_rule = get_stopping_rule(ci_half_width, ci_relative, ci_delta, _estimate_range(proposal_func, temperature))
     remaining_samples = num_mc_samples
+    hist_cache = (encode_hist(hist, model, batch_size, device, resident, prefix_cache)
+                  if share_hist_state else None)
     while remaining_samples > 0:
         sample_out = proposal_func(
             hists=hist.unsqueeze(0).expand(min(max(2,remaining_samples),
@@ -201,79 +478,107 @@ def mc_estimate(hist, num_mc_samples, seq_len, model, excluded_terms, proposal_f
             device=device,
             batch_size=batch_size,
             temperature=temperature,
+            hist_cache=hist_cache,
+            resident=resident,
+            dedup_prefixes=dedup_prefixes,
+            dedup_threshold=dedup_threshold,
+            generator=generator,
         )
         remaining_samples -= batch_size
         term_log_prob = sample_out["next_log_dist"] + sample_out["model_log_prob"] - sample_out["proposal_log_prob"]
 
         # Running estimate - accumulating value in list
-        out_dict['sample_estimates'].append(term_log_prob.exp().cpu())
-        out_dict['entropy_probs'].append(sample_out['entropy_probs'].cpu())
-        out_dict['samples'].append(sample_out['samples'].cpu())
-        out_dict['last_sample'] = sample_out.get('last_sample',torch.Tensor([])).cpu()
-        out_dict['intermediate_query_probs'].append(sample_out['intermediate_query_probs'].cpu())
-        out_dict['num_mc_samples'] = torch.LongTensor(sub_estimates)
+        _add_mc_sample_out(out_dict, moments, sample_out, term_log_prob.exp().cpu(), excluded_terms,
+                           target_terms if frequentist_test else None, store_samples=flashy)
+        model_iters += model.model_iters
+        if stopping_rule is not None and _ci_done(stopping_rule, moments, excluded_terms):
+            break
 
-        if frequentist_test:
-            samples = sample_out['samples']
-            last_sample = sample_out['last_sample']
-            if 'sample_counts' not in out_dict:
-                out_dict['sample_counts'] = []
-            new_cnts = [samples==i for i in target_terms]
-            last_cnts = [last_sample==i for i in target_terms]
-            new_cnts = torch.stack(new_cnts,dim=0).any(dim=0).any(dim=-1).long()
-            last_cnts =torch.stack(last_cnts,dim=0).any(dim=0).squeeze().long()
-            positive_samples = ((new_cnts == 0) & (last_cnts.sum() == 1)).float()
-            out_dict['sample_counts'].append(positive_samples)
+    out_dict['num_mc_samples'] = torch.LongTensor(sub_estimates)
+    return _finalize_mc_estimate(out_dict, moments, seq_len, model_iters,
+                                 frequentist_test, sub_estimates)
 
-        model_iters += model.model_iters
+def _slice_sample_out(sample_out, rows):
+    # Dedup savings are per step of the whole packed batch, not per row
+    return {k: (v[rows] if torch.is_tensor(v) and v.numel() and k != 'dedup_savings' else v)
+            for k, v in sample_out.items()}
 
-    for item in cat_list:
-        out_dict[item] = torch.cat(out_dict[item],dim=0)
+@torch.no_grad()
+def mc_estimate_batched(hists, num_mc_samples, seq_len, model, excluded_terms, proposal_func,
+                        vocab_size, batch_size=128,temperature=1, top_k=0, top_p=0.0, device='cpu',
+                        cat_list = ['sample_estimates','entropy_probs', 'intermediate_query_probs'],
+                        flashy =False,frequentist_test=False,sub_estimates=None,share_hist_state=True,
+                        resident=False,prefix_cache=None,ci_half_width=0.0,ci_relative=False,ci_delta=0.05,
+                        dedup_prefixes=False,dedup_threshold=0.5,generator=None,**kwargs):
+    """mc_estimate over several histories (num_queries, hist_len) at once, with one list
+    of excluded terms per query. Every query's samples are drawn in the same packed
+    batch (query-major rows), and a list of per-query mc_estimate outputs is returned.
+    With a stopping rule, queries leave the batch as soon as their interval is tight enough.
+    All queries draw from the one `generator`, so samples depend on how queries are packed."""
+    assert(len(hists.shape) == 2)  # (num_queries, hist_seq_len)
+    num_queries = hists.shape[0]
+    excluded_terms = [list(terms) for terms in excluded_terms]
+    assert(len(excluded_terms) == num_queries)
+    # Per-row exclusions are packed into a single tensor, so they must all be the same size
+    assert(len(set(len(terms) for terms in excluded_terms)) == 1)
     if frequentist_test:
-        out_dict['frequentist_estimates'] = torch.cat(out_dict['sample_counts'],dim=0)
-    out_dict['entropy_probs'] = out_dict['entropy_probs'].mean(dim=0)
-    out_dict['intermediate_query_probs'] = torch.cat((out_dict['intermediate_query_probs'],
-                                                      out_dict['sample_estimates'].unsqueeze(1))
-                                                     ,dim=1)
-    out_dict['sample_estimate_var'] = out_dict['intermediate_query_probs'][...,excluded_terms].sum(dim=-1).var(dim=0)
-    out_dict['intermediate_query_probs'] = out_dict['intermediate_query_probs'].mean(dim=0).unsqueeze(0)
-    if sub_estimates:
-        # (samples x vocab) -> (sub-estimates x vocab)
-        out_dict['sample_estimates'] = torch.stack(
-            # (vocab)
-            [out_dict['sample_estimates'][:s].mean(dim=0).flatten()
-             for s in sorted(sub_estimates)
-        ]).squeeze()
-        out_dict['sample_estimate_var'] = torch.stack(
-            # (vocab)
-            [out_dict['sample_estimates'][:s].var(dim=0).flatten()
-             for s in sorted(sub_estimates)
-        ]).squeeze()
-        if frequentist_test:
-            out_dict['frequentist_estimates'] = torch.stack(
-                # (vocab)
-                [out_dict['frequentist_estimates'][:s].mean(dim=0).flatten()
-                for s in sorted(sub_estimates)
-            ]).squeeze()
-
-            out_dict['sample_estimate_var'] = torch.stack(
-                # (vocab)
-                [out_dict['frequentist_estimates'][:s].var(dim=0).flatten()
-                for s in sorted(sub_estimates)
-            ]).squeeze()
-        out_dict['model_iters'] = torch.LongTensor(
-            [sub_est * seq_len for sub_est in sorted(sub_estimates)]
+        target_terms = excluded_terms
+        excluded_terms = [[] for _ in excluded_terms]
+    model.model_iters = 0
+    model_iters = [0]*num_queries
+    out_dicts = [defaultdict(list) for _ in range(num_queries)]
+    moments = [_mc_moments(sub_estimates) for _ in range(num_queries)]
+    stopping_rule = get_stopping_rule(ci_half_width, ci_relative, ci_delta, _estimate_range(proposal_func, temperature))
+    # Explicit shape, hitting time queries exclude nothing and (n, 0) cannot be inferred
+    excluded_rows = torch.tensor(excluded_terms, dtype=torch.long).view(num_queries, len(excluded_terms[0]))
+    remaining_samples = num_mc_samples
+    active = torch.arange(num_queries)
+    all_hist_cache = (encode_hist(hists, model, batch_size, device, resident, prefix_cache)
+                      if share_hist_state else None)
+    hist_cache = all_hist_cache
+    while remaining_samples > 0 and active.shape[0]:
+        num_samples = min(max(2,remaining_samples), batch_size)
+        sample_out = proposal_func(
+            hists=hists[active.to(hists.device)].repeat_interleave(num_samples, dim=0),
+            seq_len=seq_len,
+            model=model,
+            vocab_size=vocab_size,
+            excluded_terms=excluded_rows[active].repeat_interleave(num_samples, dim=0),
+            top_k=top_k,
+            top_p=top_p,
+            device=device,
+            batch_size=batch_size,
+            temperature=temperature,
+            hist_cache=hist_cache,
+            resident=resident,
+            dedup_prefixes=dedup_prefixes,
+            dedup_threshold=dedup_threshold,
+            generator=generator,
         )
-
-    else:
-        out_dict['sample_estimates'] = out_dict['sample_estimates'].mean(dim=0).flatten()
-        out_dict['model_iters'] = torch.LongTensor([model_iters])
-        out_dict['sample_estimate_var'] =torch.var(out_dict['sample_estimates'],dim=0)
-        if frequentist_test:
-            out_dict['sample_estimate_var'] =torch.var(out_dict['frequentist_estimates'],dim=0)
-        out_dict['sample_estimate_mean'] =out_dict['sample_estimates'].mean(dim=0)
-    return out_dict
-
+        remaining_samples -= batch_size
+        term_log_prob = sample_out["next_log_dist"] + sample_out["model_log_prob"] - sample_out["proposal_log_prob"]
+        sample_estimates = term_log_prob.exp().cpu()
+
+        for j, q in enumerate(active.tolist()):
+            rows = slice(j*num_samples, (j+1)*num_samples)
+            _add_mc_sample_out(out_dicts[q], moments[q], _slice_sample_out(sample_out, rows),
+                               sample_estimates[rows], excluded_terms[q],
+                               target_terms[q] if frequentist_test else None, store_samples=flashy)
+            # Each query is charged its own rows, one model step per sampled token
+            model_iters[q] += num_samples * seq_len
+
+        if stopping_rule is not None:
+            active = torch.LongTensor([q for q in active.tolist()
+                                       if not _ci_done(stopping_rule, moments[q], excluded_terms[q])])
+            if hist_cache is not None and active.shape[0]:
+                hist_cache = _index_hist_cache(all_hist_cache, active)
+
+    outputs = []
+    for q in range(num_queries):
+        out_dicts[q]['num_mc_samples'] = torch.LongTensor(sub_estimates)
+        outputs.append(_finalize_mc_estimate(out_dicts[q], moments[q], seq_len, model_iters[q],
+                                             frequentist_test, sub_estimates))
+    return outputs
 
 #######################################################################
 # With replacement
@@ -330,49 +635,65 @@ def tree_is_estimate_attn(
     device,
     flashy=False,
     sub_estimates=None,
+    resident=False,
+    generator=None,
     **kwargs,
  ):
-    # Sample each sequence individually from tree
-    dist_estimates = []
-    total_model_iters = model.model_iters; model_iters = []
-    for i in tqdm(range(num_mc_samples),disable=not flashy and kwargs['disable_tqdm']):
-        log_p, log_q, rnn_args, depth_reached, last_token, _ = tree.sample_sequence(seq_len)
-        total_model_iters += seq_len - depth_reached
-        if sub_estimates and (i+1) in sub_estimates:
-            model_iters.append(total_model_iters)
-        for _ in range(depth_reached,seq_len+1):
-
+    # Sample all sequences from tree at once, enough for the largest sub estimate
+    num_samples = max([num_mc_samples] + (list(sub_estimates) if sub_estimates else []))
+    draws = tree.sample_sequences(num_samples, seq_len, generator)
+    log_p_totals, log_q_totals = draws['log_p'].clone(), draws['log_q'].clone()
+    depths = draws['depths']
+    next_log_dists = [None]*num_samples
+    # Search cost so far, completion cost is added per sample below
+    base_iters = model.model_iters
+
+    # Sequences leaving the tree at the same depth have caches of the same length,
+    # so they are completed together, batch_size at a time
+    groups = [(depths == depth).nonzero().squeeze(-1) for depth in depths.unique().tolist()]
+    chunks = [chunk for group in groups for chunk in group.split(batch_size)]
+    for chunk in tqdm(chunks,disable=not flashy and kwargs['disable_tqdm']):
+        depth_reached = depths[chunk[0]].item()
+        rnn_args = tree.path_hidden_states(draws['paths'][chunk, :depth_reached])
+        last_token = draws['last_tokens'][chunk].unsqueeze(-1)  # need to have a sequence length of 1
+        log_p, log_q = log_p_totals[chunk], log_q_totals[chunk]
+        for _ in range(depth_reached,seq_len):
             logits, rnn_args = model.get_next_probs(
-                # Unsqueeze 2x since a single token [1,1]
-                last_token.unsqueeze(-1).unsqueeze(-1),
+                last_token,
                 rnn_args=rnn_args,
                 max_batch_size=batch_size,
                 device=device,
                 return_logits=True,
+                resident=resident,
             )
 
-            proposal_logits = logits.clone()
-            proposal_logits[..., excluded_terms] = -float('inf')
+            proposal_logits = _exclude_terms(logits, excluded_terms)
             logits, proposal_logits = torch.log_softmax(logits, dim=-1), torch.log_softmax(proposal_logits, dim=-1)
-            last_token = torch.distributions.Categorical(logits=proposal_logits).sample()
+            last_token = sample_categorical(proposal_logits, generator)
 
-            log_q += proposal_logits[...,last_token].squeeze()
-            log_p += logits[...,last_token].squeeze()
+            log_q += torch.gather(proposal_logits, dim=-1, index=last_token).squeeze(-1).cpu()
+            log_p += torch.gather(logits, dim=-1, index=last_token).squeeze(-1).cpu()
 
         # Compute final distributions for estimate
         next_log_dist, _ = model.get_next_probs(
-            last_token.unsqueeze(-1).unsqueeze(-1),
+            last_token,
             rnn_args,
             max_batch_size=batch_size,
             device=device,
             return_logits=True,
+            resident=resident,
         )
+        log_p_totals[chunk], log_q_totals[chunk] = log_p, log_q
+        for row, dist in zip(chunk.tolist(), torch.log_softmax(next_log_dist, dim=-1).cpu()):
+            next_log_dists[row] = dist
 
-        next_log_dist = torch.log_softmax(next_log_dist, dim=-1)
-        dist_estimate = next_log_dist + log_p - log_q
-        dist_estimates.append(dist_estimate.squeeze())
+    next_log_dist = torch.stack(next_log_dists, dim=0)  # (num_seqs, vocab_size)
+    dist_estimate = (next_log_dist + log_p_totals.unsqueeze(dim=-1) - log_q_totals.unsqueeze(dim=-1)).exp()
 
-    dist_estimate = torch.stack(dist_estimates,dim=0).exp().cpu()
+    # Model iterations after each sample, in sampling order
+    total_model_iters = base_iters + torch.cumsum(seq_len - depths, dim=0)
+    model_iters = ([total_model_iters[s-1].item() for s in sorted(sub_estimates)]
+                   if sub_estimates else [total_model_iters[-1].item()])
     dist_est_var = dist_estimate.var(dim=0)
 
     if sub_estimates:
@@ -402,6 +723,76 @@ def tree_is_estimate_attn(
     }
 
 
+@torch.no_grad()
+def complete_sequences_rnn(
+    model,
+    hidden_states,
+    last_tokens,
+    num_remaining_steps,
+    log_p_totals,
+    log_q_totals,
+    excluded_terms,
+    batch_size,
+    device,
+    resident=False,
+    step_log=None,
+    generator=None,
+ ):
+    """
+    Samples the remaining `num_remaining_steps` tokens of every sequence from the
+    model and returns the final next token log distributions along with the
+    accumulated log p and log q, all in the original order.
+
+    Sequences are sorted by remaining length once, so the unfinished ones are
+    always a contiguous prefix and every step only touches the active rows.
+    If given, `step_log` gets (active sequences, seconds) for every step.
+    """
+    state_device = last_tokens.device
+    order = torch.argsort(num_remaining_steps.cpu(), descending=True, stable=True)
+    inverse = torch.empty_like(order); inverse[order] = torch.arange(order.shape[0])
+    order, inverse = order.to(state_device), inverse.to(state_device)
+    hidden_states = _index_hidden_state(hidden_states, order)
+    last_tokens = last_tokens[order]
+    log_p_totals, log_q_totals = log_p_totals[order], log_q_totals[order]
+
+    # Number of sequences still active before each step
+    remaining = num_remaining_steps[order].cpu()
+    max_steps = remaining[0].item() if remaining.shape[0] else 0
+    num_active = (remaining.unsqueeze(0) > torch.arange(max_steps).unsqueeze(1)).sum(dim=-1).tolist()
+
+    for n in num_active:
+        start = time.perf_counter()
+        logits, rnn_args = model.get_next_probs(
+            last_tokens[:n],
+            rnn_args=_map_hidden_state(hidden_states, lambda h: h[:, :n]),
+            max_batch_size=batch_size,
+            device=device,
+            return_logits=True,
+            resident=resident,
+        )
+
+        proposal_logits = _exclude_terms(logits, excluded_terms)
+        logits, proposal_logits = torch.log_softmax(logits, dim=-1), torch.log_softmax(proposal_logits, dim=-1)
+        last_sample = sample_categorical(proposal_logits, generator)
+        log_q_totals[:n] += torch.gather(proposal_logits, dim=-1, index=last_sample).squeeze(-1).to(state_device)
+        log_p_totals[:n] += torch.gather(logits, dim=-1, index=last_sample).squeeze(-1).to(state_device)
+        _set_hidden_rows(hidden_states, slice(0, n), _map_hidden_state(rnn_args, lambda h: h.to(state_device)))
+        last_tokens[:n] = last_sample.to(state_device)
+        if step_log is not None:
+            step_log.append((n, time.perf_counter() - start))
+
+    # Compute final distributions for estimate
+    next_log_dist, _ = model.get_next_probs(
+        last_tokens,
+        hidden_states,
+        max_batch_size=batch_size,
+        device=device,
+        return_logits=True,
+        resident=resident,
+    )
+    next_log_dist = torch.log_softmax(next_log_dist, dim=-1)  # (num_seqs, vocab_size)
+    return next_log_dist[inverse.to(next_log_dist.device)], log_p_totals[inverse], log_q_totals[inverse]
+
 @torch.no_grad()
 def tree_is_estimate_rnn(
     tree,
@@ -413,35 +804,24 @@ def tree_is_estimate_rnn(
     batch_size,
     device,
     sub_estimates=None,
+    resident=False,
+    generator=None,
     **kwargs,
  ):
-    # Sample each sequence individually from tree
-    log_p_totals, log_q_totals = [], []
-    hidden_states, num_remaining_steps = [], []
-    last_tokens = []
-
-    for _ in range(num_mc_samples):
-        log_p, log_q, hs, depth_reached, last_token, _ = tree.sample_sequence(seq_len)
-        log_p_totals.append(log_p)
-        log_q_totals.append(log_q)
-        hidden_states.append(hs)
-        num_remaining_steps.append(seq_len - depth_reached)
-        last_tokens.append(last_token)
-
-    log_p_totals = torch.stack(log_p_totals, dim=0)
-    log_q_totals = torch.stack(log_q_totals, dim=0)
-    if isinstance(hs, tuple):
-        hidden_states = (
-            torch.stack([h[0] for h in hidden_states], dim=1),
-            torch.stack([h[1] for h in hidden_states], dim=1),
-        )
-    else:
-        hidden_states = torch.stack(hidden_states, dim=1)
-    num_remaining_steps = torch.tensor(num_remaining_steps, dtype=torch.int32, device=log_p_totals.device)
-    last_tokens = torch.stack(last_tokens, dim=0).unsqueeze(1)  # need to have a sequence length of 1
+    # Sample all sequences from tree at once
+    draws = tree.sample_sequences(num_mc_samples, seq_len, generator)
+    log_p_totals, log_q_totals = draws['log_p'], draws['log_q']
+    hidden_states = draws['hidden_states']
+    num_remaining_steps = (seq_len - draws['depths']).int()
+    last_tokens = draws['last_tokens'].unsqueeze(1)  # need to have a sequence length of 1
+    if resident:
+        # Keep the completion state on the model device for the whole loop
+        hidden_states = _map_hidden_state(hidden_states, lambda s: s.to(device))
+        log_p_totals, log_q_totals = log_p_totals.to(device), log_q_totals.to(device)
+        num_remaining_steps, last_tokens = num_remaining_steps.to(device), last_tokens.to(device)
 
     # Finish sampling incomplete sequences from model
-    model_iters = [model.model_iters + num_remaining_steps.sum()]
+    model_iters = [model.model_iters + num_remaining_steps.sum().item()]
 
     if sub_estimates:
         model_iters = []
@@ -462,49 +842,16 @@ def tree_is_estimate_rnn(
                     model_iters.append(total_cost)
                     break
 
-    while (num_remaining_steps > 0).any():
-        to_update = num_remaining_steps > 0
-        if isinstance(hidden_states, tuple):
-            rnn_args = (hidden_states[0][..., to_update, :], hidden_states[1][..., to_update, :])
-        else:
-            rnn_args = hidden_states[..., to_update, :]
-        logits, rnn_args = model.get_next_probs(
-            last_tokens[to_update, :],
-            rnn_args=rnn_args,
-            max_batch_size=batch_size,
-            device=device,
-            return_logits=True,
-        )
-
-        proposal_logits = logits.clone()
-        proposal_logits[..., excluded_terms] = -float('inf')
-        logits, proposal_logits = torch.log_softmax(logits, dim=-1), torch.log_softmax(proposal_logits, dim=-1)
-        last_sample = torch.distributions.Categorical(logits=proposal_logits).sample().unsqueeze(-1)
-        log_q_totals[to_update] += torch.gather(proposal_logits, dim=-1, index=last_sample).squeeze(-1)
-        log_p_totals[to_update] += torch.gather(logits, dim=-1, index=last_sample).squeeze(-1)
-        if isinstance(hidden_states, tuple):
-            hidden_states[0][..., to_update, :] = rnn_args[0]
-            hidden_states[1][..., to_update, :] = rnn_args[1]
-        else:
-            hidden_states[..., to_update, :] = rnn_args
-        num_remaining_steps[to_update] -= 1
-        last_tokens[to_update, :] = last_sample
-
-    # Compute final distributions for estimate
-    next_log_dist, _ = model.get_next_probs(
-        last_tokens,
-        hidden_states,
-        max_batch_size=batch_size,
-        device=device,
-        return_logits=True,
+    next_log_dist, log_p_totals, log_q_totals = complete_sequences_rnn(
+        model, hidden_states, last_tokens, num_remaining_steps, log_p_totals, log_q_totals,
+        excluded_terms, batch_size, device, resident=resident, generator=generator,
     )
-    next_log_dist = torch.log_softmax(next_log_dist, dim=-1)  # (num_seqs, vocab_size)
     dist_estimate = next_log_dist + log_p_totals.unsqueeze(dim=-1) - log_q_totals.unsqueeze(dim=-1)
     dist_estimate = dist_estimate.exp().cpu()
     dist_est_var = dist_estimate.var(dim=0)
-    model_iters = [model_iter + sub_est for model_iter, sub_est in zip(model_iters,sub_estimates)]
 
     if sub_estimates:
+        model_iters = [model_iter + sub_est for model_iter, sub_est in zip(model_iters,sub_estimates)]
         # (samples x vocab) -> (sub-estimates x vocab)
         dist_estimate = torch.stack(
             # (vocab)
@@ -535,23 +882,132 @@ def lin_interp(target_pct, n_current, n_end):
     t = n_current / (n_end - 1)
     return a * (1 - t) + b * t
 
+def _select_beams(next_restricted_log_probs, num_beams, n_cur, seq_len, interp_func,
+                  min_variance=False, min_var_reduction=0.0, max_num_tree_beams=None):
+    """Ascending indices of the flattened (beams x vocab) candidates kept for the next step"""
+    if min_variance:
+        next_restricted_log_probs = min_variance_top_k(next_restricted_log_probs, min_var_reduction=min_var_reduction,
+                                                       max_num_tree_beams=max_num_tree_beams,is_log_prob=True)
+        return (next_restricted_log_probs != -float('inf')).nonzero().squeeze(-1)
+    elif isinstance(num_beams, int):
+        return select_frontier(next_restricted_log_probs, top_k=num_beams, is_log_prob=True)
+    else:  # isinstance(num_beams, float)
+        num_beams_cur = interp_func(num_beams, n_cur, seq_len)
+        return select_frontier(next_restricted_log_probs, top_p=num_beams_cur, is_log_prob=True)
+
+def _select_beam_states(states, seq_inds, use_gpt2=False):
+    if use_gpt2:
+        # (layers, 2, (samp, attn, seq_len, h))
+        return tuple(
+            [(h1[seq_inds], h2[seq_inds]) for
+             (h1, h2) in states])
+    elif isinstance(states, tuple):
+        return states[0][..., seq_inds, :], states[1][..., seq_inds, :]
+    return states[..., seq_inds, :]
+
+def _next_probs_spilled(model, beams, rnn_args, batch_size, device, resident=False, scratch_dir=None):
+    """get_next_probs over a spilled frontier. Rows are read and run batch_size at a
+    time, and the new states are written straight to another scratch file."""
+    logits, states = [], None
+    for start in range(0, beams.shape[0], batch_size):
+        end = min(start + batch_size, beams.shape[0])
+        chunk_logits, chunk_states = model.get_next_probs(beams[start:end], rnn_args=rnn_args.read(start, end),
+                                                          return_logits=True, max_batch_size=batch_size,
+                                                          device=device, resident=resident)
+        if states is None:
+            states = SpilledStates.empty(chunk_states, beams.shape[0], scratch_dir)
+        states.write(start, chunk_states)
+        logits.append(chunk_logits)
+    return torch.cat(logits, dim=0), states
+
+def _select_frontier_states(states, seq_inds, max_bytes, held_bytes=0, scratch_dir=None):
+    """RNN states of the next frontier. If they would not fit in `max_bytes` on top of
+    `held_bytes`, they are spilled to scratch files and only selected lazily."""
+    if isinstance(states, SpilledStates): row_nbytes = states.row_nbytes
+    else: row_nbytes = _state_nbytes(states) / _num_rows(states)
+    if held_bytes + seq_inds.shape[0] * row_nbytes > max_bytes:
+        if not isinstance(states, SpilledStates):
+            states = SpilledStates.from_states(states, scratch_dir)
+        return states.select(seq_inds)
+    if isinstance(states, SpilledStates):
+        return states.take(seq_inds)
+    return _select_beam_states(states, seq_inds)
+
+def _beam_search_out_dict(cur_log_probs, cur_restricted_log_probs, final_log_probs, num_beams_over_time,
+                          model_iters, intermediate_lbs, excluded_terms, vocab_size, seq_len,
+                          sub_estimates=None, store_intermediate_lbs=False, bs_tree=None):
+    next_log_probs = cur_log_probs.unsqueeze(-1) + final_log_probs
+    out_dict = {
+        "tree": bs_tree,
+        "bs_lower_bound": next_log_probs.exp(),
+        "true_coverage": cur_log_probs.exp(),
+        "restricted_coverage": cur_restricted_log_probs.exp(),
+        "num_beams": torch.LongTensor(num_beams_over_time),
+        "num_beams_over_time": torch.LongTensor(num_beams_over_time),
+        "model_iters": torch.LongTensor([model_iters]),
+        "intermediate_lbs": (torch.Tensor([]) if not store_intermediate_lbs
+                else torch.cat((torch.stack(intermediate_lbs),
+                next_log_probs.exp().sum(dim=0).unsqueeze(0).cpu()),axis=0)),
+    }
+
+    # (samples x vocab) -> (sub-estimates x vocab)
+    to_accumulate = ['true_coverage', 'restricted_coverage']
+    if sub_estimates:
+        _, lb_inds = torch.sort(out_dict['bs_lower_bound'][:,excluded_terms[0]],dim=0,
+                                                descending=True)
+        # How much we have left over at each estimate
+        model_breakout = torch.LongTensor(
+            [[min(sub_est,(vocab_size - len(excluded_terms))**(i+1))
+                  for i in range(seq_len)]
+             for sub_est in sub_estimates])
+        out_dict['model_iters'] = model_breakout.sum(dim=-1)
+        out_dict['num_beams'] = torch.LongTensor(sub_estimates)
+        out_dict['bs_lower_bound'] = torch.stack(
+                # (vocab)
+                [out_dict['bs_lower_bound'][lb_inds][:s].sum(dim=0).flatten()
+                for s in sub_estimates]).squeeze().cpu()
+        for term in to_accumulate:
+            out_dict[term] = out_dict[term][lb_inds]
+            out_dict[term] = torch.stack(
+                # (vocab)
+                [out_dict[term][:s].sum().flatten()
+                for s in sub_estimates
+            ]).squeeze().cpu()
+    else:
+        out_dict['bs_lower_bound'] = out_dict['bs_lower_bound'].sum(dim=0).cpu()
+        for term in to_accumulate:
+            out_dict[term] = out_dict[term].sum().cpu()
+
+    return out_dict
+
 @torch.no_grad()
 def beam_search_lower_bound(hist, num_beams, seq_len, model, excluded_terms,
                             interp_func, batch_size, device, vocab_size, use_gpt2=False,
                             bs_tree=None, store_intermediate_lbs=False, sub_estimates=None,
                             min_variance=False,min_var_reduction=0.0,bs_ablation=False,
-                            bs_ablation_max_beams=10000,max_num_tree_beams=None, **kwargs):
+                            bs_ablation_max_beams=10000,max_num_tree_beams=None, resident=False,
+                            prefix_cache=None, frontier_memory_mb=0, scratch_dir=None, **kwargs):
     assert(isinstance(num_beams, (int, float)))
     assert(len(hist.shape) == 1)
 
+    # Frontier states past the memory budget spill to scratch files (RNN states only)
+    max_frontier_bytes = frontier_memory_mb * 2**20 if frontier_memory_mb and not use_gpt2 else None
+    held_bytes = 0  # RAM held by the tree's states, counted against the budget
     model.model_iters = 0; started = False; intermediate_lbs = []
     beams, rnn_args = hist.unsqueeze(0), None  # beams only represents what needs to be processed by the model in the next step
-    cur_log_probs = torch.zeros((1,), dtype=torch.float32)  # (num of current beams,)
+    cur_log_probs = torch.zeros((1,), dtype=torch.float32,
+                                device=device if resident else 'cpu')  # (num of current beams,)
     cur_restricted_log_probs = cur_log_probs.clone()  # sum of restricted probabilities
     num_beams_over_time = []
     for n_cur in range(seq_len):
-        logits, states = model.get_next_probs(beams, rnn_args=rnn_args, return_logits = True,
-                                            max_batch_size=batch_size,device=device)
+        if n_cur == 0 and prefix_cache is not None:
+            hist_cache = encode_hist(hist, model, batch_size, device, resident, prefix_cache)
+            logits, states = hist_cache['logits'], hist_cache['rnn_args']
+        elif isinstance(rnn_args, SpilledStates):
+            logits, states = _next_probs_spilled(model, beams, rnn_args, batch_size, device, resident, scratch_dir)
+        else:
+            logits, states = model.get_next_probs(beams, rnn_args=rnn_args, return_logits = True,
+                                                max_batch_size=batch_size,device=device,resident=resident)
         if not started: model.model_iters = 0; started= True
         next_log_probs = torch.log_softmax(logits, dim=-1)  # (num of current beams, vocab_size)
         # If we need to store intermediate results
@@ -572,16 +1028,10 @@ def beam_search_lower_bound(hist, num_beams, seq_len, model, excluded_terms,
         next_restricted_log_probs = cur_restricted_log_probs.unsqueeze(-1) + next_restricted_log_probs
         next_restricted_log_probs = next_restricted_log_probs.view(-1)
 
-        if min_variance:
-                next_restricted_log_probs = min_variance_top_k(next_restricted_log_probs, min_var_reduction=min_var_reduction,
-                                                               max_num_tree_beams=max_num_tree_beams,is_log_prob=True)
-        elif isinstance(num_beams, int):
-                next_restricted_log_probs = top_k_top_p_filtering(next_restricted_log_probs, top_k=num_beams, is_log_prob=True)
-        else:  # isinstance(num_beams, float)
-            num_beams_cur = interp_func(num_beams, n_cur, seq_len)
-            next_restricted_log_probs = top_k_top_p_filtering(next_restricted_log_probs, top_p=num_beams_cur, is_log_prob=True)
-
-        next_log_probs = next_log_probs.masked_fill(next_restricted_log_probs == -float('inf'), -float('inf'))
+        # (beams x 1)
+        indices = _select_beams(next_restricted_log_probs, num_beams, n_cur, seq_len, interp_func,
+                                min_variance, min_var_reduction, max_num_tree_beams)
+        indices = indices[next_log_probs[indices] != -float('inf')]
         if bs_tree is not None:
             if n_cur == 0: # Add root node
                 parents = bs_tree.add_root_node(
@@ -600,32 +1050,25 @@ def beam_search_lower_bound(hist, num_beams, seq_len, model, excluded_terms,
                     depth=n_cur,
                 )
 
-        # (beams x 1)
-        indices = torch.arange(0, next_log_probs.shape[0], device=beams.device)[next_log_probs != -float('inf')]
-        if n_cur ==0 and bs_tree is not None: parents = parents * indices.shape[0]
         # Sequence indices we will need for next piece
         seq_inds = torch.div(indices, vocab_size, rounding_mode='trunc')  # equivalent to: indices // args.vocab_size
         beams = (indices % vocab_size).unsqueeze(-1)
         cur_log_probs = next_log_probs[indices]
         cur_restricted_log_probs = next_restricted_log_probs[indices]
-        rnn_args = states
-        if use_gpt2:
-            # (layers, 2, (samp, attn, seq_len, h))
-            rnn_args = tuple(
-                [(h1[seq_inds], h2[seq_inds]) for
-                 (h1, h2) in rnn_args])
-        else:
-            if isinstance(rnn_args, tuple):
-                rnn_args = rnn_args[0][..., seq_inds, :], rnn_args[1][..., seq_inds, :]
-            else:
-                rnn_args = rnn_args[..., seq_inds, :]
+        if max_frontier_bytes:
+            if bs_tree is not None and not isinstance(states, SpilledStates):
+                held_bytes += _state_nbytes(states)
+            rnn_args = _select_frontier_states(states, seq_inds, max_frontier_bytes, held_bytes, scratch_dir)
+        else: rnn_args = _select_beam_states(states, seq_inds, use_gpt2)
 
         num_beams_over_time.append(cur_log_probs.shape[0])
 
-    logits, states = model.get_next_probs(beams, rnn_args=rnn_args, device=device, return_logits=True,
-                                        max_batch_size=batch_size)
+    if isinstance(rnn_args, SpilledStates):
+        logits, states = _next_probs_spilled(model, beams, rnn_args, batch_size, device, resident, scratch_dir)
+    else:
+        logits, states = model.get_next_probs(beams, rnn_args=rnn_args, device=device, return_logits=True,
+                                            max_batch_size=batch_size, resident=resident)
     final_log_probs = torch.log_softmax(logits,dim=-1)
-    next_log_probs = cur_log_probs.unsqueeze(-1) + final_log_probs
     if bs_tree is not None:
         bs_tree.add_child_nodes(
                     beams,parents,
@@ -634,48 +1077,111 @@ def beam_search_lower_bound(hist, num_beams, seq_len, model, excluded_terms,
                     states, seq_inds,
                     depth=n_cur+1)
 
-    out_dict = {
-        "tree": bs_tree,
-        "bs_lower_bound": next_log_probs.exp(),
-        "true_coverage": cur_log_probs.exp(),
-        "restricted_coverage": cur_restricted_log_probs.exp(),
-        "num_beams": torch.LongTensor(num_beams_over_time),
-        "num_beams_over_time": torch.LongTensor(num_beams_over_time),
-        "model_iters": torch.LongTensor([model.model_iters]),
-        "intermediate_lbs": (torch.Tensor([]) if not store_intermediate_lbs
-                else torch.cat((torch.stack(intermediate_lbs),
-                next_log_probs.exp().sum(dim=0).unsqueeze(0)),axis=0)),
-    }
+    return _beam_search_out_dict(
+        cur_log_probs, cur_restricted_log_probs, final_log_probs, num_beams_over_time,
+        model.model_iters, intermediate_lbs, excluded_terms, vocab_size, seq_len,
+        sub_estimates=sub_estimates, store_intermediate_lbs=store_intermediate_lbs, bs_tree=bs_tree)
 
-    # (samples x vocab) -> (sub-estimates x vocab)
-    to_accumulate = ['true_coverage', 'restricted_coverage']
-    if sub_estimates:
-        _, lb_inds = torch.sort(out_dict['bs_lower_bound'][:,excluded_terms[0]],dim=0,
-                                                descending=True)
-        # How much we have left over at each estimate
-        model_breakout = torch.LongTensor(
-            [[min(sub_est,(vocab_size - len(excluded_terms))**(i+1))
-                  for i in range(seq_len)]
-             for sub_est in sub_estimates])
-        out_dict['model_iters'] = model_breakout.sum(dim=-1)
-        out_dict['num_beams'] = torch.LongTensor(sub_estimates)
-        out_dict['bs_lower_bound'] = torch.stack(
-                # (vocab)
-                [out_dict['bs_lower_bound'][lb_inds][:s].sum(dim=0).flatten()
-                for s in sub_estimates]).squeeze().cpu()
-        for term in to_accumulate:
-            out_dict[term] = out_dict[term][lb_inds]
-            out_dict[term] = torch.stack(
-                # (vocab)
-                [out_dict[term][:s].sum().flatten()
-                for s in sub_estimates
-            ]).squeeze().cpu()
-    else:
-        out_dict['bs_lower_bound'] = out_dict['bs_lower_bound'].sum(dim=0)
-        for term in to_accumulate:
-            out_dict[term] = out_dict[term].sum()
+@torch.no_grad()
+def beam_search_lower_bound_batched(hists, num_beams, seq_len, model, excluded_terms,
+                                    interp_func, batch_size, device, vocab_size, use_gpt2=False,
+                                    store_intermediate_lbs=False, sub_estimates=None,
+                                    min_variance=False,min_var_reduction=0.0,max_num_tree_beams=None,
+                                    resident=False,prefix_cache=None, **kwargs):
+    """beam_search_lower_bound over several histories (num_queries, hist_len) at once.
+    The frontiers of all queries are kept together (grouped by query) so that each step
+    is a single model call, while beams are still selected per query. Returns a list with
+    one beam_search_lower_bound output dict per query (no sample tree)."""
+    assert(isinstance(num_beams, (int, float)))
+    assert(len(hists.shape) == 2)  # (num_queries, hist_seq_len)
+    num_queries = hists.shape[0]
+    assert(len(excluded_terms) == num_queries)
+    excluded_terms = [list(terms) for terms in excluded_terms]
+    prob_device = device if resident else 'cpu'
+
+    model.model_iters = 0; started = False
+    intermediate_lbs = [[] for _ in range(num_queries)]
+    num_beams_over_time = [[] for _ in range(num_queries)]
+    beams, rnn_args = hists, None
+    beam_counts = [1]*num_queries  # Frontier rows are grouped by query, in query order
+    cur_log_probs = torch.zeros((num_queries,), dtype=torch.float32, device=prob_device)
+    cur_restricted_log_probs = cur_log_probs.clone()
+    for n_cur in range(seq_len):
+        if n_cur == 0 and prefix_cache is not None:
+            hist_cache = encode_hist(hists, model, batch_size, device, resident, prefix_cache)
+            logits, states = hist_cache['logits'], hist_cache['rnn_args']
+        else:
+            logits, states = model.get_next_probs(beams, rnn_args=rnn_args, return_logits = True,
+                                                max_batch_size=batch_size,device=device,resident=resident)
+        if not started: model.model_iters = 0; started= True
+        all_log_probs = torch.log_softmax(logits, dim=-1)  # (num of current beams, vocab_size)
+
+        offset = 0; seq_inds, next_beams, next_counts = [], [], []
+        next_cur_log_probs, next_cur_restricted_log_probs = [], []
+        query_log_probs, query_restricted_log_probs, query_indices = [], [], []
+        for q in range(num_queries):
+            rows = slice(offset, offset + beam_counts[q])
+            next_log_probs = all_log_probs[rows].clone()
+            if store_intermediate_lbs:
+                intermediate_lbs[q].append((cur_log_probs[rows].unsqueeze(-1) +
+                                            next_log_probs).exp().sum(dim=0).cpu())
+
+            next_log_probs[..., excluded_terms[q]] = -float('inf')
+            next_restricted_log_probs = torch.log_softmax(next_log_probs, dim=-1)
+            next_log_probs = (cur_log_probs[rows].unsqueeze(-1) + next_log_probs).view(-1)
+            next_restricted_log_probs = (cur_restricted_log_probs[rows].unsqueeze(-1) +
+                                         next_restricted_log_probs).view(-1)
+            query_log_probs.append(next_log_probs)
+            query_restricted_log_probs.append(next_restricted_log_probs)
+            if not min_variance:
+                query_indices.append(_select_beams(next_restricted_log_probs, num_beams, n_cur, seq_len, interp_func))
+            offset += beam_counts[q]
 
-    return out_dict
+        if min_variance:
+            # Pad the flattened frontiers of all queries and select their beams at once
+            lengths = [r.shape[0] for r in query_restricted_log_probs]
+            padded = torch.nn.utils.rnn.pad_sequence(query_restricted_log_probs, batch_first=True,
+                                                     padding_value=-float('inf'))
+            padded = min_variance_top_k(padded, min_var_reduction=min_var_reduction, is_log_prob=True,
+                                        max_num_tree_beams=max_num_tree_beams, lengths=lengths)
+            query_indices = [(padded[q, :lengths[q]] != -float('inf')).nonzero().squeeze(-1)
+                             for q in range(num_queries)]
+
+        offset = 0
+        for q in range(num_queries):
+            next_log_probs, next_restricted_log_probs = query_log_probs[q], query_restricted_log_probs[q]
+            indices = query_indices[q]
+            indices = indices[next_log_probs[indices] != -float('inf')]
+            seq_inds.append(offset + torch.div(indices, vocab_size, rounding_mode='trunc'))
+            next_beams.append((indices % vocab_size).unsqueeze(-1))
+            next_cur_log_probs.append(next_log_probs[indices])
+            next_cur_restricted_log_probs.append(next_restricted_log_probs[indices])
+            next_counts.append(indices.shape[0])
+            num_beams_over_time[q].append(indices.shape[0])
+            offset += beam_counts[q]
+
+        seq_inds = torch.cat(seq_inds)
+        beams = torch.cat(next_beams)
+        cur_log_probs = torch.cat(next_cur_log_probs)
+        cur_restricted_log_probs = torch.cat(next_cur_restricted_log_probs)
+        beam_counts = next_counts
+        rnn_args = _select_beam_states(states, seq_inds, use_gpt2)
+
+    logits, states = model.get_next_probs(beams, rnn_args=rnn_args, device=device, return_logits=True,
+                                        max_batch_size=batch_size, resident=resident)
+    final_log_probs = torch.log_softmax(logits,dim=-1)
+
+    outputs = []; offset = 0
+    for q in range(num_queries):
+        rows = slice(offset, offset + beam_counts[q])
+        # Each beam is one model iteration at every step past the history
+        outputs.append(_beam_search_out_dict(
+            cur_log_probs[rows], cur_restricted_log_probs[rows], final_log_probs[rows],
+            num_beams_over_time[q], sum(num_beams_over_time[q]), intermediate_lbs[q],
+            excluded_terms[q], vocab_size, seq_len, sub_estimates=sub_estimates,
+            store_intermediate_lbs=store_intermediate_lbs))
+        offset += beam_counts[q]
+    return outputs
 
 
 #######################################################################
@@ -684,15 +1190,17 @@ def beam_search_lower_bound(hist, num_beams, seq_len, model, excluded_terms,
 
 @torch.no_grad()
 def beam_search_is_hybrid_nr(hist, num_beams,num_mc_samples, seq_len, model, excluded_terms, interp_func,
-                          batch_size, device, vocab_size,
-                          beam_search_outputs=['num_beams','true_coverage','restricted_coverage'],
-                          min_variance=False,min_var_reduction=0.0, flashy=False,
+                          batch_size, device, vocab_size,use_gpt2=False,
+                          beam_search_outputs=['num_beams','true_coverage','restricted_coverage','num_beams_over_time'],
+                          min_variance=False,min_var_reduction=0.0,max_num_tree_beams=None, flashy=False,
                           text_dict=None, **kwargs):
+    assert not use_gpt2, "Sampling without replacement is only supported for recurrent models"
     model.model_iters = 0
     beam_search_output =beam_search_lower_bound(
         hist, num_beams, seq_len, model, excluded_terms, interp_func,
         batch_size, device, vocab_size, bs_tree=BeamSearchSampleTree(text_dict),
-        min_variance=min_variance,min_var_reduction=min_var_reduction, **kwargs)
+        min_variance=min_variance,min_var_reduction=min_var_reduction,
+        max_num_tree_beams=max_num_tree_beams, **kwargs)
     tree = beam_search_output['tree']
     tree.prune()
 
@@ -709,6 +1217,24 @@ def beam_search_is_hybrid_nr(hist, num_beams,num_mc_samples, seq_len, model, exc
 
     return hybrid_estimate
 
+def _gumbel_like(t, generator=None):
+    # Drawn where the generator lives (the search itself runs on the host)
+    device = t.device if generator is None else generator.device
+    return -torch.empty(t.shape, dtype=t.dtype, device=device).exponential_(generator=generator).log().to(t.device)
+
+def _conditional_gumbels(parent_gumbels, phi):
+    """Gumbels of the children (phi = log q + Gumbel) conditioned on their maximum being
+    the parent's perturbed log probability. Numerically stable form of Kool et al. (2019)."""
+    max_phi = phi.max(dim=-1, keepdim=True).values
+    v = parent_gumbels.unsqueeze(-1) - phi + torch.log(-torch.expm1(phi - max_phi))
+    v = torch.where(v.isnan(), torch.full_like(v, float('inf')), v)  # children of beams without mass
+    return parent_gumbels.unsqueeze(-1) - v.clamp(min=0) - torch.log1p(torch.exp(-v.abs()))
+
+def _set_hidden_rows(state, rows, values):
+    if isinstance(state, tuple):
+        for s, v in zip(state, values): s[:, rows] = v
+    else: state[:, rows] = values
+
 @torch.no_grad()
 def tree_is_estimate_nr(
     tree,
@@ -720,106 +1246,114 @@ def tree_is_estimate_nr(
     batch_size,
     device,
     sub_estimates=None,
+    generator=None,
     **kwargs,
  ):
-    # Sample each sequence individually from tree
-    log_p_totals, log_q_totals = [], []
-    hidden_states, num_remaining_steps = [], []
-    last_tokens = []
-
-    for _ in range(num_mc_samples):
-        log_p, log_q, hs, depth_reached, last_token, _ = tree.sample_sequence(seq_len)
-        if depth_reached < seq_len:
-            pass
-        log_p_totals.append(log_p)
-        log_q_total.append(log_q)
-
-        num_remaining_steps.append(seq_len - depth_reached)
-        last_tokens.append(last_token)
-
-    else:
-        hidden_states = torch.stack(hidden_states, dim=1)
-    num_remaining_steps = torch.tensor(num_remaining_steps, dtype=torch.int32, device=log_p_totals.device)
-    last_tokens = torch.stack(last_tokens, dim=0).unsqueeze(1)  # need to have a sequence length of 1
-
-    # Finish sampling incomplete sequences from model
-    model_iters = [model.model_iters + num_remaining_steps.sum()]
-
-    # Information for model iterations
-    # Skip this detail for now
-    if sub_estimates:
-        model_iters = []
-        samples_per_effort = [
-            (num_remaining_steps == i).sum().item() for i in range(num_remaining_steps.max()+1)
-        ];
-        j = 0
-        for i in range(len(sub_estimates)):
-            total_samp = 0; total_cost = model.model_iters
-            curr_model_iters = model.model_iters
-            for j in range(len(samples_per_effort)):
-                if total_samp < sub_estimates[i]:
-                    samp_left = min(sub_estimates[i] - total_samp,
-                                    samples_per_effort[j])
-                    total_samp += samples_per_effort[j]
-                    total_cost += j*samp_left
-                if (total_samp >= sub_estimates[i]):
-                    model_iters.append(total_cost)
-                    break
-
-    while (num_remaining_steps > 0).any():
-        to_update = num_remaining_steps > 0
-        if isinstance(hidden_states, tuple):
-            rnn_args = (hidden_states[0][..., to_update, :], hidden_states[1][..., to_update, :])
-        else:
-            rnn_args = hidden_states[..., to_update, :]
-        logits, rnn_args = model.get_next_probs(
-            last_tokens[to_update, :],
-            rnn_args=rnn_args,
-            max_batch_size=batch_size,
-            device=device,
-            return_logits=True,
-        )
-
-        proposal_logits = logits.clone()
-        proposal_logits[..., excluded_terms] = -float('inf')
-        logits, proposal_logits = torch.log_softmax(logits, dim=-1), torch.log_softmax(proposal_logits, dim=-1)
-        last_sample = torch.distributions.Categorical(logits=proposal_logits).sample().unsqueeze(-1)
-        log_q_totals[to_update] += torch.gather(proposal_logits, dim=-1, index=last_sample).squeeze(-1)
-        log_p_totals[to_update] += torch.gather(logits, dim=-1, index=last_sample).squeeze(-1)
-        if isinstance(hidden_states, tuple):
-            hidden_states[0][..., to_update, :] = rnn_args[0]
-            hidden_states[1][..., to_update, :] = rnn_args[1]
-        else:
-            hidden_states[..., to_update, :] = rnn_args
-        num_remaining_steps[to_update] -= 1
-        last_tokens[to_update, :] = last_sample
-
+    """
+    Stochastic beam search (Gumbel top-k) over the sequences left out of the pruned
+    tree: tree conditionals are used while a beam is inside the tree, the (restricted)
+    model after it leaves. The top num_mc_samples+1 perturbed sequences are exact
+    samples without replacement from q. The (k+1)-th perturbed value is the threshold
+    kappa, giving the unbiased Horvitz-Thompson estimate sum p(y) f(y) / pi(y) with
+    pi(y) = 1 - exp(-exp(log q(y) - kappa)). Every sub estimate s reuses the top s+1.
+
+    A child's perturbed value never exceeds its parent's, so the top s+1 beams at each
+    depth are exactly the beams of a run with s samples. Each sub estimate is charged
+    the model rows its own beams used (plus the search), not the cost of the full run.
+    """
+    num_samples = max([num_mc_samples] + (list(sub_estimates) if sub_estimates else []))
+    vocab_size = tree.cdf_tables[0].shape[-1]
+    states_template = tree.hidden_states[0]
+    base_iters = model.model_iters
+    model_ranks = []  # Ranks of the beams run through the model, per depth
+
+    # Beams (rows): inside the tree at `nodes` (or -1), else the pending token and the state before it
+    nodes = torch.zeros(1, dtype=torch.long)
+    pending = torch.zeros(1, dtype=torch.long)
+    prev_states = None
+    log_q = torch.zeros(1, dtype=torch.float64); log_p = torch.zeros(1, dtype=torch.float64)
+    gumbels = _gumbel_like(log_q, generator)  # Perturbed log probability of the root, Gumbel(log 1)
+    for depth in range(seq_len):
+        num_beams = nodes.shape[0]
+        in_tree = nodes >= 0
+        cond_log_q = torch.empty(num_beams, vocab_size, dtype=torch.float64)
+        cond_log_p = torch.empty_like(cond_log_q)
+        states = _map_hidden_state(states_template,
+                                   lambda s: s.new_empty(s.shape[0], num_beams, s.shape[-1]))
+        if in_tree.any():
+            rows = in_tree.nonzero().squeeze(-1)
+            cond_log_q[rows] = tree.log_q_rows(depth, nodes[rows])
+            cond_log_p[rows] = tree.log_p_conditionals[depth][nodes[rows]].double()
+            _set_hidden_rows(states, rows, tree._gather_hidden_states(
+                torch.full_like(rows, depth), nodes[rows]))
+        if (~in_tree).any():
+            rows = (~in_tree).nonzero().squeeze(-1)
+            model_ranks.append(rows)
+            logits, rnn_args = model.get_next_probs(
+                pending[rows].unsqueeze(-1),
+                rnn_args=_index_hidden_state(prev_states, rows),
+                max_batch_size=batch_size,
+                device=device,
+                return_logits=True,
+            )
+            cond_log_p[rows] = torch.log_softmax(logits, dim=-1).double()
+            cond_log_q[rows] = torch.log_softmax(_exclude_terms(logits, excluded_terms), dim=-1).double()
+            _set_hidden_rows(states, rows, rnn_args)
+
+        # Expand every beam to every symbol and keep the top k+1 perturbed children
+        child_log_q = log_q.unsqueeze(-1) + cond_log_q
+        child_gumbels = _conditional_gumbels(gumbels, child_log_q + _gumbel_like(child_log_q, generator)).view(-1)
+        top = torch.topk(child_gumbels, min(num_samples + 1, child_gumbels.shape[0]))
+        keep = top.values > -float('inf')
+        indices, gumbels = top.indices[keep], top.values[keep]
+        parents = torch.div(indices, vocab_size, rounding_mode='trunc')
+        symbols = indices % vocab_size
+
+        log_q = child_log_q.view(-1)[indices]
+        log_p = log_p[parents] + cond_log_p[parents, symbols]
+        parent_nodes = nodes[parents]
+        nodes = torch.full_like(parents, -1)
+        from_tree = parent_nodes >= 0
+        nodes[from_tree] = tree.child_index(depth, parent_nodes[from_tree], symbols[from_tree])
+        pending, prev_states = symbols, _index_hidden_state(states, parents)
+
+    assert (nodes < 0).all(), "Pruned tree should not reach the full sequence length"
     # Compute final distributions for estimate
     next_log_dist, _ = model.get_next_probs(
-        last_tokens,
-        hidden_states,
+        pending.unsqueeze(-1),
+        prev_states,
         max_batch_size=batch_size,
         device=device,
         return_logits=True,
     )
-    next_log_dist = torch.log_softmax(next_log_dist, dim=-1)  # (num_seqs, vocab_size)
-    dist_estimate = next_log_dist + log_p_totals.unsqueeze(dim=-1) - log_q_totals.unsqueeze(dim=-1)
-    dist_estimate = dist_estimate.exp().cpu()
-    dist_est_var = dist_estimate.var(dim=0)
-    model_iters = [model_iter + sub_est for model_iter, sub_est in zip(model_iters,sub_estimates)]
+    next_log_dist = torch.log_softmax(next_log_dist, dim=-1).double().cpu()  # (num_seqs, vocab_size)
+
+    def _model_iters(k):
+        # Search, then the top k+1 beams at every depth and in the final call
+        return (base_iters + sum([(ranks <= k).sum().item() for ranks in model_ranks]) +
+                min(k + 1, pending.shape[0]))
+
+    def _ht_estimate(k):
+        # Beams are sorted by perturbed value, the (k+1)-th is the threshold
+        kappa = gumbels[k] if gumbels.shape[0] > k else torch.tensor(-float('inf'), dtype=gumbels.dtype)
+        log_exclusion = -torch.exp(log_q[:k] - kappa)  # log(1 - pi)
+        log_inclusion = torch.log(-torch.expm1(log_exclusion))
+        terms = (next_log_dist[:k] + (log_p[:k] - log_inclusion).unsqueeze(-1)).exp()
+        # Inclusions are independent given kappa, so sum of terms^2 (1 - pi) is an unbiased
+        # estimate of the HT variance (Duffield et al., 2007). Scaled by k to be comparable
+        # with the per-sample variance reported by with replacement estimators.
+        ht_var = (terms**2 * log_exclusion.exp().unsqueeze(-1)).sum(dim=0)
+        return terms.sum(dim=0).float(), (k * ht_var).float()
 
-    if sub_estimates is not None and len(sub_estimates) > 0:
-        # (samples x vocab) -> (sub-estimates x vocab)
-        dist_estimate = torch.stack(
-            # (vocab)
-            [dist_estimate[:s].mean(dim=0).flatten()
-             for s in sorted(sub_estimates)
-        ]).squeeze()
-        dist_est_var = torch.stack(
-            # (vocab)
-            [dist_estimate[:s].var(dim=0).flatten()
-             for s in sorted(sub_estimates)
-        ]).squeeze()
+    if sub_estimates:
+        # (sub-estimates x vocab)
+        estimates = [_ht_estimate(s) for s in sorted(sub_estimates)]
+        dist_estimate = torch.stack([e[0] for e in estimates]).squeeze()
+        dist_est_var = torch.stack([e[1] for e in estimates]).squeeze()
+        model_iters = [_model_iters(s) for s in sorted(sub_estimates)]
+    else:
+        dist_estimate, dist_est_var = _ht_estimate(num_mc_samples)
+        model_iters = [_model_iters(num_mc_samples)]
 
     return {
         'bs_lower_bound':bs_lower_bound,
@@ -829,3 +1363,103 @@ def tree_is_estimate_nr(
         'sample_estimate_mean':(bs_lower_bound + dist_estimate).mean(dim=0) if not sub_estimates else torch.Tensor([]),
         'model_iters': torch.LongTensor(model_iters),
     }
+
+#######################################################################
+# Exact enumeration
+#######################################################################
+
+@torch.no_grad()
+def enumerate_sequences(hist, seq_len, model, batch_size, device, excluded_terms=(),
+                        chunk_size=8192, resident=False, prefix_cache=None, **kwargs):
+    """
+    Exhaustively expands every continuation of `hist` up to `seq_len` tokens that
+    avoids `excluded_terms`, depth first in blocks of at most `chunk_size` nodes.
+    Each block is a single model step from its parents' hidden states, so every
+    node costs one token and memory is bounded by seq_len blocks.
+
+    Yields one dict per block with its 'depth', the 'sequences' (nodes x depth),
+    their joint 'log_probs' and the 'next_log_probs' (nodes x vocab) after them.
+    Blocks at depth seq_len are the leaves, in lexicographic order.
+    """
+    hist_cache = encode_hist(hist, model, batch_size, device, resident, prefix_cache)
+    prob_device = device if resident else 'cpu'
+    vocab_size = hist_cache['logits'].shape[-1]
+    allowed = torch.ones(vocab_size, dtype=torch.bool)
+    allowed[list(excluded_terms)] = False
+    allowed = allowed.nonzero().squeeze(-1).to(prob_device)
+
+    def _expand(depth, sequences, log_probs, logits, states):
+        next_log_probs = torch.log_softmax(logits, dim=-1)
+        yield {
+            "depth": depth,
+            "sequences": sequences,
+            "log_probs": log_probs,
+            "next_log_probs": next_log_probs,
+        }
+        if depth == seq_len:
+            return
+
+        # Children are parent-major and token-minor, so leaves come out lexicographically
+        num_children = sequences.shape[0] * allowed.shape[0]
+        for start in range(0, num_children, chunk_size):
+            children = torch.arange(start, min(start + chunk_size, num_children), device=prob_device)
+            parents = torch.div(children, allowed.shape[0], rounding_mode='trunc')
+            tokens = allowed[children % allowed.shape[0]].unsqueeze(-1)
+            child_logits, child_states = model.get_next_probs(
+                tokens, rnn_args=_index_hidden_state(states, parents.to(_state_device(states))),
+                return_logits=True, max_batch_size=batch_size, device=device, resident=resident)
+            yield from _expand(depth + 1,
+                               torch.cat((sequences[parents], tokens), dim=-1),
+                               log_probs[parents] + next_log_probs[parents, tokens.squeeze(-1)],
+                               child_logits, child_states)
+
+    yield from _expand(0, torch.zeros((1, 0), dtype=torch.long, device=prob_device),
+                       torch.zeros((1,), device=prob_device),
+                       hist_cache['logits'], hist_cache['rnn_args'])
+
+def _state_device(state):
+    while isinstance(state, tuple):
+        state = state[0]
+    return state.device
+
+@torch.no_grad()
+def exact_enumeration(hist, seq_len, model, excluded_terms, batch_size, device, vocab_size,
+                      store_intermediate_lbs=False, enumeration_chunk_size=8192,
+                      resident=False, prefix_cache=None, **kwargs):
+    """
+    Exact probability of avoiding `excluded_terms` for seq_len steps (and of each
+    next token after that), by enumerating every sequence with enumerate_sequences.
+    Outputs match beam_search_lower_bound with full coverage, so bs_lower_bound
+    is the exact answer.
+    """
+    assert(len(hist.shape) == 1)
+    model.model_iters = 0
+    num_allowed = vocab_size - len(set(excluded_terms))
+    lower_bound = torch.zeros(vocab_size, dtype=torch.float64)
+    intermediate_lbs = torch.zeros((seq_len + 1, vocab_size), dtype=torch.float64)
+    true_coverage = 0.0
+    num_beams_over_time = [0]*seq_len  # Nodes actually expanded at each depth
+    for block in enumerate_sequences(hist, seq_len, model, batch_size, device, excluded_terms,
+                                     chunk_size=enumeration_chunk_size, resident=resident,
+                                     prefix_cache=prefix_cache):
+        log_probs = block['log_probs'].double().cpu()
+        joint = (log_probs.unsqueeze(-1) + block['next_log_probs'].double().cpu()).exp().sum(dim=0)
+        intermediate_lbs[block['depth']] += joint
+        if block['depth']:
+            num_beams_over_time[block['depth'] - 1] += block['sequences'].shape[0]
+        if block['depth'] == seq_len:
+            lower_bound += joint
+            true_coverage += log_probs.exp().sum().item()
+
+    # Every allowed sequence is kept, so the restricted (renormalized) mass is all of it
+    restricted_coverage = 1.0 if num_allowed > 0 else 0.0
+    return {
+        "tree": None,
+        "bs_lower_bound": lower_bound.float(),
+        "true_coverage": torch.tensor(true_coverage).float(),
+        "restricted_coverage": torch.tensor(restricted_coverage).float(),
+        "num_beams": torch.LongTensor(num_beams_over_time),
+        "num_beams_over_time": torch.LongTensor(num_beams_over_time),
+        "model_iters": torch.LongTensor([model.model_iters]),
+        "intermediate_lbs": intermediate_lbs.float() if store_intermediate_lbs else torch.Tensor([]),
+    }
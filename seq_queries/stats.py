@@ -0,0 +1,154 @@
+#################################################################################
+#
+#             Project Title:  Streaming Estimator Statistics
+#             Date:           2022-06-06
+#
+#################################################################################
+
+
+#################################################################################
+#   Module Imports
+#################################################################################
+
+import math
+
+import torch
+
+#################################################################################
+#   Function-Class Declaration
+#################################################################################
+
+class RunningMoments(object):
+
+    """
+    Streaming mean and (unbiased) variance over the first dimension of every
+    update, combined batch by batch with the parallel update of Chan et al.
+    Memory is that of a single sample regardless of how many are seen.
+
+    With `checkpoints`, the running mean is also snapshotted once exactly
+    that many samples have been seen (batches are split at the boundaries),
+    which matches slicing the first s samples of the full tensor.
+    """
+
+    def __init__(self, checkpoints=None):
+        self.count = 0
+        self.mean, self.m2 = None, None
+        self.min, self.max = None, None
+        self.checkpoints = sorted(checkpoints) if checkpoints else []
+        self.snapshots = []
+
+    def update(self, x):
+        start = 0
+        while True:
+            self._take_snapshots()
+            if start >= x.shape[0]:
+                break
+            end = x.shape[0]
+            if len(self.snapshots) < len(self.checkpoints):
+                end = min(end, start + max(1, self.checkpoints[len(self.snapshots)] - self.count))
+            self._merge(end - start, *self._moments(x[start:end]))
+            start = end
+        return self
+
+    def merge(self, other):
+        """Combines the moments of another accumulator (without checkpoints)"""
+        if other.count:
+            self._merge(other.count, other.mean, other.m2, other.min, other.max)
+            self._take_snapshots()
+        return self
+
+    @staticmethod
+    def _moments(x):
+        x = x.double()
+        mean = x.mean(dim=0)
+        return mean, ((x - mean)**2).sum(dim=0), x.min(dim=0).values, x.max(dim=0).values
+
+    def _merge(self, count, mean, m2, minimum, maximum):
+        if not self.count:
+            self.count, self.mean, self.m2 = count, mean.clone(), m2.clone()
+            self.min, self.max = minimum.clone(), maximum.clone()
+            return
+        self.min, self.max = torch.minimum(self.min, minimum), torch.maximum(self.max, maximum)
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * (count / total)
+        self.m2 += m2 + delta**2 * (self.count * count / total)
+        self.count = total
+
+    def _take_snapshots(self):
+        while (self.count and len(self.snapshots) < len(self.checkpoints) and
+               self.count >= self.checkpoints[len(self.snapshots)]):
+            self.snapshots.append(self.mean.float())
+
+    @property
+    def variance(self):
+        if self.count < 2:
+            return torch.full_like(self.mean, float('nan')).float()
+        return (self.m2 / (self.count - 1)).float()
+
+    @property
+    def std(self):
+        return self.variance.sqrt()
+
+    def checkpoint_means(self):
+        """Means at every checkpoint, (checkpoints x ...). Checkpoints past the
+        number of samples seen get the overall mean."""
+        return torch.stack(self.snapshots + [self.mean.float()]*(len(self.checkpoints) - len(self.snapshots)))
+
+
+def empirical_bernstein_half_width(moments, delta, value_range=None):
+    """
+    Two-sided empirical Bernstein confidence half-width (Maurer & Pontil, 2009,
+    Thm. 4) of the mean of a fixed number of samples lying in an interval of
+    length `value_range`, holding with probability 1 - delta. Without a known
+    range the observed one stands in, which is a heuristic with no guarantee.
+    """
+    if moments.count < 2:
+        return torch.full_like(moments.mean, float('inf'))
+    n, log_term = moments.count, math.log(4 / delta)
+    if value_range is None:
+        value_range = moments.max - moments.min
+    return ((2 * moments.variance.double() * log_term / n).sqrt() +
+            7 * value_range * log_term / (3 * (n - 1)))
+
+
+class StoppingRule(object):
+
+    """
+    Stops sampling once the confidence interval of every monitored estimate is
+    within an absolute (or relative to the mean) half-width. The rule is checked
+    after every batch and stops at the first success, so as in EBStop (Mnih et
+    al., 2008) the interval at n samples gets failure probability
+    delta (p-1)/p / n^p, and all of them hold at once with probability 1 - delta.
+
+    Per-sample estimates are assumed to lie in an interval of length
+    `value_range` (see _estimate_range in sample.py). With None, the observed
+    range is used and the coverage no longer holds.
+    """
+
+    def __init__(self, half_width, relative=False, delta=0.05, value_range=None, p=1.1):
+        self.half_width = half_width
+        self.relative = relative
+        self.delta = delta
+        self.value_range = value_range
+        self.p = p
+
+    def delta_at(self, n):
+        # Sums to at most delta over n >= 1, since zeta(p) <= p / (p-1)
+        return self.delta * (self.p - 1) / self.p / n**self.p
+
+    def done(self, moments, index=None):
+        if not moments.count:
+            return False
+        half_width = empirical_bernstein_half_width(moments, self.delta_at(moments.count),
+                                                    self.value_range)
+        target = self.half_width * moments.mean.abs() if self.relative else torch.full_like(half_width, self.half_width)
+        if index is not None:
+            half_width, target = half_width[index], target[index]
+        return bool((half_width <= target).all())
+
+
+def get_stopping_rule(ci_half_width=0.0, ci_relative=False, ci_delta=0.05, value_range=None, **kwargs):
+    if not ci_half_width:
+        return None
+    return StoppingRule(ci_half_width, relative=ci_relative, delta=ci_delta, value_range=value_range)
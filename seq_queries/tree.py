@@ -18,68 +18,23 @@ import torch
 import torch.nn as nn
 from collections import defaultdict
 
-from .utils import top_k_top_p_filtering, _tup_cpu, _hidden_state_select
+from .utils import top_k_top_p_filtering, _hidden_state_select, _map_hidden_state, _index_hidden_state
+from .cache import SpilledStates
 
 #################################################################################
 #   Function-Class Declaration
 #################################################################################
 
-class BSNode(object):
-
-    """Beam Search sample node"""
-
-    def __init__(
-        self,
-        symbol,
-        parent,
-        log_q_conditionals,
-        log_p_conditionals,
-        hidden_state,
-        tree,
-        depth,
-    ):
-        """TODO: to be defined.
-
-        :: TODO
-
-        """
-        self.symbol = symbol
-        self.parent = parent
-        self.depth = depth
-        self.tree = tree
-        # Send in marginals, don't transform here
-        self.q_conditionals = log_q_conditionals.exp().flatten().cpu()
-        self.p_conditionals = log_p_conditionals.exp().flatten().cpu()
-        self.hidden_state = _tup_cpu(hidden_state, force=False)
-        self.children = defaultdict(dict)
-        self.total_mass = 1.0
-
-    @property
-    def lineage(self):
-        lineage = [self.symbol]
-        tracker = self.parent
-        while tracker is not None:
-            lineage.append(tracker.symbol)
-            tracker = tracker.parent
-        return list(reversed(lineage))
-
-    def __str__(self):
-        return "Node({})".format(
-            "".join([self.tree.id_to_char.get(s) for s in self.lineage]))
-
-    def __unicode__(self):
-        return u"Node({})".format(
-            "".join([self.tree.id_to_char.get(s) for s in self.lineage]))
-
-    def __repr__(self):
-        return "Node({})".format(
-            "".join([self.tree.id_to_char.get(s) for s in self.lineage]))
-
 class BeamSearchSampleTree(object):
 
     """
     Tree data structure for sampling leftover (non-searched)
-    sequences to estimate lost probability coverage
+    sequences to estimate lost probability coverage.
+
+    Nodes are stored depth by depth as flat arrays: row i of depth d has its
+    (vocab) conditionals, symbol, parent row at depth d-1, and hidden state
+    at index i of that depth's tensors. Children are found through the sorted
+    keys (parent * vocab_size + symbol) of the next depth.
     """
 
     def __init__(
@@ -98,25 +53,38 @@ class BeamSearchSampleTree(object):
         self.vocab_size = len(self.char_to_id) if self.char_to_id else default_size
         self.BOS = self.char_to_id['<BOS>'] if self.char_to_id else 0
         self.depth_sizes = [0]
-        self.depth_dict = defaultdict(list)
         self.uses_attention=uses_attention
 
+        # Per depth arrays, (nodes x vocab) or (nodes,)
+        self.q_conditionals, self.p_conditionals = [], []
+        self.symbols, self.parents = [], []
+        self.total_mass, self.hidden_states = [], []
+        # Sorted child keys of each depth and the node rows they belong to
+        self.child_keys, self.child_rows = [], []
+        # Sampling tables, filled in once the tree is pruned
+        self.finalized = False
+        self.log_p_conditionals = []
+        self.cdf_tables = []
+
+    @property
+    def num_depths(self):
+        return len(self.symbols)
+
     def add_root_node(
         self,
         log_q_conditionals,
         log_p_conditionals,
         hidden_state,
     ):
-        self.root = BSNode(self.BOS,None,
-            log_q_conditionals,
-            log_p_conditionals,
-            _hidden_state_select(hidden_state,0,
-                                is_root=True,
-                                uses_attention=self.uses_attention),
-            tree=self,
-            depth=0)
-        self._add_depth(0,self.root)
-        return [self.root]
+        self._add_depth(
+            0,
+            torch.LongTensor([self.BOS]),
+            torch.LongTensor([-1]),
+            log_q_conditionals.view(1,-1),
+            log_p_conditionals.view(1,-1),
+            _map_hidden_state(hidden_state, lambda s: s.cpu()),
+        )
+        return torch.arange(1)
 
     def add_child_nodes(
         self, symbols, parents,
@@ -126,85 +94,88 @@ class BeamSearchSampleTree(object):
         parent_ids,depth,
     ):
         #(beams x vocab)
-        new_parents = []
-        # Not right, should not be parents
+        symbols, parent_ids = symbols.flatten().cpu(), parent_ids.flatten().cpu()
         assert torch.max(parent_ids) < len(parents),\
             "Parent list of length {}, got index {}".format(len(parents),torch.max(parent_ids))
         assert parent_ids.shape[0] == symbols.shape[0] == log_q_conditionals.shape[0] == log_p_conditionals.shape[0],\
-            "Parent ids were of shape {} but symbols were of shape {} and q was of shape {} and p was of shape {} and h_state was of shape {}"\
-            .format(parent_ids.shape,symbols.shape, log_q_conditionals.shape, log_p_conditionals.shape,hidden_states[0].shape)
-
-        for i in range(symbols.shape[0]):
-            s,pid,q,p,h = (symbols[i],parent_ids[i],log_q_conditionals[i],
-                            log_p_conditionals[i],_hidden_state_select(hidden_states,i,
-                                                        uses_attention=self.uses_attention),
-                    )
-            new_parents.append(self._add_child_node(s.item(),parents[pid],q,p,h,depth))
-
-        return new_parents
-
-    def _add_child_node(
-        self, symbol, parent,
-        log_q_conditional,
-        log_p_conditional,
-        hidden_state, depth,
-    ):
-        assert 0 <= symbol <= self.vocab_size,\
-            f"Invalid symbol: {symbol}, vocab size = {self.vocab_size}"
-        child_node = BSNode(symbol,parent,
-                            log_q_conditional,
-                            log_p_conditional,
-                            hidden_state,self,depth)
-        parent.children[symbol] = child_node
-        self._add_depth(depth, child_node)
-        return child_node
+            "Parent ids were of shape {} but symbols were of shape {} and q was of shape {} and p was of shape {}"\
+            .format(parent_ids.shape,symbols.shape, log_q_conditionals.shape, log_p_conditionals.shape)
+        assert (0 <= symbols).all() and (symbols < self.vocab_size).all(),\
+            f"Invalid symbols, vocab size = {self.vocab_size}"
+
+        if self.uses_attention:
+            # Only the newest position is kept, the rest is shared with the ancestors
+            hidden_states = tuple(
+                [(h1[...,-1:,:].cpu(), h2[...,-1:,:].cpu())
+                 for (h1,h2) in hidden_states])
+        elif not isinstance(hidden_states, SpilledStates):
+            hidden_states = _map_hidden_state(hidden_states, lambda s: s.cpu())
+        self._add_depth(depth, symbols, parents[parent_ids],
+                        log_q_conditionals, log_p_conditionals, hidden_states)
+        return torch.arange(symbols.shape[0])
 
     def _add_depth(
-        self,
-        depth,
-        node,
+        self, depth, symbols, parents,
+        log_q_conditionals,
+        log_p_conditionals,
+        hidden_states,
     ):
+        assert not self.finalized, "Cannot add nodes to a pruned tree"
+        assert depth == self.num_depths,\
+            f"Expected depth {self.num_depths}, got {depth}"
         if len(self.depth_sizes) <= depth:
             self.depth_sizes.append(0)
-        self.depth_sizes[depth] += 1
-        self.depth_dict[depth].append(node)
+        self.depth_sizes[depth] += symbols.shape[0]
+        self.symbols.append(symbols)
+        self.parents.append(parents)
+        self.q_conditionals.append(log_q_conditionals.exp().cpu())
+        self.p_conditionals.append(log_p_conditionals.exp().cpu())
+        self.total_mass.append(torch.ones(symbols.shape[0]))
+        self.hidden_states.append(hidden_states)
+
+        keys = parents * self.vocab_size + symbols
+        keys, rows = torch.sort(keys)
+        self.child_keys.append(keys)
+        self.child_rows.append(rows)
+
+    def child_index(self, depth, nodes, symbols):
+        """Rows at depth+1 of the children (nodes, symbols) of depth,
+        -1 where the child is not in the tree"""
+        if depth + 1 >= len(self.child_keys) or not self.child_keys[depth+1].shape[0]:
+            return torch.full_like(nodes, -1)
+        keys, rows = self.child_keys[depth+1], self.child_rows[depth+1]
+        query = nodes * self.vocab_size + symbols
+        pos = torch.searchsorted(keys, query).clamp(max=keys.shape[0]-1)
+        return torch.where(keys[pos] == query, rows[pos], torch.full_like(query, -1))
+
+    def lineage(self, depth, node):
+        lineage = []
+        for d in reversed(range(depth+1)):
+            lineage.append(self.symbols[d][node].item())
+            node = self.parents[d][node].item()
+        return list(reversed(lineage))
 
     def _respect_bs_support(
         self,
-        node
+        depth
     ):
-        child_symbols = torch.LongTensor([c.symbol for c in node.children.values()])
-        node.q_conditionals[child_symbols] *= 0
-        node.total_mass = node.q_conditionals.sum()
-        node.q_conditionals = node.q_conditionals / node.total_mass
-
-    def _adjust_marginal_probabilities_by_node(self,node):
-        child_symbols = torch.LongTensor([c.symbol for c in node.children.values()])
-        child_mass = torch.Tensor([c.total_mass for c in node.children.values()])
-        adjusted_mass = torch.ones(self.vocab_size)
-        adjusted_mass[child_symbols] = child_mass
-        assert adjusted_mass.shape[0] == node.q_conditionals.shape[0],\
-            "Adjusted mass shape {} | Q conditional shape {}"\
-            .format(adjusted_mass.shape,
-                    node.q_conditionals.shape)
-
-        node.q_conditionals *= adjusted_mass
-        node.total_mass = node.q_conditionals.sum()
-        node.q_conditionals = node.q_conditionals / node.total_mass
+        q_conditionals = self.q_conditionals[depth]
+        q_conditionals[self.parents[depth+1], self.symbols[depth+1]] = 0
+        self.total_mass[depth] = q_conditionals.sum(dim=-1)
+        self.q_conditionals[depth] = q_conditionals / self.total_mass[depth].unsqueeze(-1)
 
     def _adjust_marginal_probabilities_by_depth(self,depth):
-
-        nodes_to_adjust = self.depth_dict[depth]
-        for node in nodes_to_adjust:
-            self._adjust_marginal_probabilities_by_node(node)
+        q_conditionals = self.q_conditionals[depth]
+        adjusted_mass = torch.ones_like(q_conditionals)
+        adjusted_mass[self.parents[depth+1], self.symbols[depth+1]] = self.total_mass[depth+1]
+        q_conditionals = q_conditionals * adjusted_mass
+        self.total_mass[depth] = q_conditionals.sum(dim=-1)
+        self.q_conditionals[depth] = q_conditionals / self.total_mass[depth].unsqueeze(-1)
 
     def _remove_terminal_depth(self):
-        terminal_depth =len(self.depth_sizes)-1
-        leaf_nodes = self.depth_dict[terminal_depth]
-        del self.depth_dict[terminal_depth]
-        for ln in leaf_nodes:
-            parent = ln.parent
-            del parent.children[ln.symbol]
+        for arrays in (self.q_conditionals, self.p_conditionals, self.symbols, self.parents,
+                       self.total_mass, self.hidden_states, self.child_keys, self.child_rows):
+            arrays.pop()
 
     def prune(self):
         """
@@ -213,39 +184,135 @@ class BeamSearchSampleTree(object):
         (and also restructure probabilities)
         """
         leaf_parent_depth = len(self.depth_sizes)-2
-        leaf_parents = self.depth_dict[leaf_parent_depth]
-        for lp in leaf_parents:
-            self._respect_bs_support(lp)
+        self._respect_bs_support(leaf_parent_depth)
         for i in reversed(range(leaf_parent_depth)):
             self._adjust_marginal_probabilities_by_depth(i)
         self._remove_terminal_depth()
+        self._finalize()
 
-    def sample_sequence(self, seq_len):
-        cur_node = self.root
-        depth = 0
-        log_p_total, log_q_total = 0.0, 0.0
-        sample = []; attns = []
-        while depth < seq_len:
-            next_step = torch.distributions.Categorical(probs=cur_node.q_conditionals).sample()
-            sample.append(next_step.item())
-            if self.uses_attention: attns.append(cur_node.hidden_state)
-            log_p_total += cur_node.p_conditionals.log()[next_step]
-            log_q_total += cur_node.q_conditionals.log()[next_step]
-            depth += 1
-            if next_step.item() in cur_node.children:
-                cur_node = cur_node.children[next_step.item()]
-            else:
-                break
-
+    def _finalize(self):
+        """
+        Conditionals are fixed after pruning, so each depth is turned into a cumulative
+        table of q (for inverse CDF draws) and a float32 table of log p. The raw
+        conditionals are released, the tables replace them.
+
+        The table stays in float64 (a float32 step of ~6e-8 is wider than many GPT-2
+        token probabilities). Log q is not stored, it is taken from the table's
+        differences when needed, so that the importance weights use exactly the
+        probability each token is drawn with.
+        """
+        for q_conditionals, p_conditionals in zip(self.q_conditionals, self.p_conditionals):
+            cdf = q_conditionals.double().cumsum(dim=-1)
+            cdf = (cdf / cdf[:, -1:]).nan_to_num(0.0)
+            cdf[:, -1] = 1.0
+            self.cdf_tables.append(cdf)
+            self.log_p_conditionals.append(p_conditionals.float().log())
+        self.q_conditionals, self.p_conditionals = None, None
+        self.finalized = True
+
+    def path_hidden_states(self, paths):
+        """Attention states along paths of node rows (samples, depths), concatenated over sequence.
+        All paths must have the same length."""
+        # (num_layers, (2, (samples, heads, seq, dim)))
+        layer_hiddens = []
+        for l in range(len(self.hidden_states[0])):
+            layer_hiddens.append(tuple(
+                torch.cat([self.hidden_states[d][l][k][paths[:, d]] for d in range(paths.shape[1])], dim=-2)
+                for k in range(2)))
+        return tuple(layer_hiddens)
+
+    def _gather_hidden_states(self, node_depths, nodes):
+        """RNN states (layers, samples, hidden) of the given (depth, row) nodes"""
+        gathered, is_tuple = None, False
+        for d in node_depths.unique().tolist():
+            rows = (node_depths == d).nonzero().squeeze(-1)
+            if isinstance(self.hidden_states[d], SpilledStates):
+                states = self.hidden_states[d].take(nodes[rows])
+            else: states = _index_hidden_state(self.hidden_states[d], nodes[rows])
+            is_tuple = isinstance(states, tuple)
+            states = states if is_tuple else (states,)
+            if gathered is None:
+                gathered = tuple([s.new_empty(*s.shape[:-2], nodes.shape[0], s.shape[-1]) for s in states])
+            for g, s in zip(gathered, states):
+                g[..., rows, :] = s
+        return gathered if is_tuple else gathered[0]
+
+    def _draw(self, depth, nodes, generator=None):
+        # Inverse CDF draws for many nodes at once. Each distinct node's cdf is offset
+        # by its row so a single searchsorted over the flattened table covers all of them.
+        unique_nodes, inverse = torch.unique(nodes, return_inverse=True)
+        if self.finalized:
+            cdf = self.cdf_tables[depth][unique_nodes]
+        else:
+            cdf = self.q_conditionals[depth][unique_nodes].double().cumsum(dim=-1)
+            cdf = cdf / cdf[:, -1:]
+        row_size = cdf.shape[-1]
+        cdf = (cdf + torch.arange(unique_nodes.shape[0], dtype=cdf.dtype).unsqueeze(-1)).flatten()
+        # The tables live on the host, a device generator draws on its device first
+        u = torch.rand(nodes.shape[0], dtype=cdf.dtype, generator=generator,
+                       device=None if generator is None else generator.device).cpu() + inverse
+        tokens = torch.searchsorted(cdf, u, right=True) - inverse * row_size
+        return tokens.clamp(max=row_size-1)
+
+    def log_q_rows(self, depth, nodes):
+        """Log q conditionals (nodes x vocab) of a pruned tree, in float64"""
+        cdf = self.cdf_tables[depth][nodes]
+        return torch.diff(cdf, dim=-1, prepend=cdf.new_zeros(cdf.shape[0], 1)).log()
+
+    def _log_conditionals(self, depth, nodes, symbols, p=False):
+        if self.finalized:
+            if p:
+                return self.log_p_conditionals[depth][nodes, symbols]
+            cdf = self.cdf_tables[depth]
+            lower = torch.where(symbols > 0, cdf[nodes, (symbols - 1).clamp(min=0)], cdf.new_zeros(()))
+            return (cdf[nodes, symbols] - lower).log().float()
+        table = self.p_conditionals if p else self.q_conditionals
+        return table[depth][nodes, symbols].log()
+
+    def sample_sequences(self, num_samples, seq_len, generator=None):
+        """Draws num_samples root-to-exit paths at once, one depth at a time.
+        Attention states differ in length by exit depth, so they are not gathered here
+        (see path_hidden_states with the returned paths)."""
+        nodes = torch.zeros(num_samples, dtype=torch.long)
+        node_depths = torch.zeros(num_samples, dtype=torch.long)
+        log_p = torch.zeros(num_samples); log_q = torch.zeros(num_samples)
+        depths = torch.zeros(num_samples, dtype=torch.long)
+        last_tokens = torch.zeros(num_samples, dtype=torch.long)
+        samples = torch.full((num_samples, seq_len), -1, dtype=torch.long)
+        paths = torch.full((num_samples, seq_len), -1, dtype=torch.long)
+        walking = torch.arange(num_samples)
+        for depth in range(min(seq_len, self.num_depths)):
+            if not walking.shape[0]: break
+            cur = nodes[walking]
+            next_step = self._draw(depth, cur, generator)
+            samples[walking, depth] = next_step; paths[walking, depth] = cur
+            log_p[walking] += self._log_conditionals(depth, cur, next_step, p=True)
+            log_q[walking] += self._log_conditionals(depth, cur, next_step)
+            depths[walking] = depth + 1
+            last_tokens[walking] = next_step
+
+            child = self.child_index(depth, cur, next_step)
+            found = child >= 0
+            walking = walking[found]
+            nodes[walking] = child[found]
+            node_depths[walking] = depth + 1
+
+        return {
+            "log_p": log_p,
+            "log_q": log_q,
+            "depths": depths,
+            "last_tokens": last_tokens,
+            "samples": samples,
+            "paths": paths,
+            "hidden_states": (None if self.uses_attention
+                              else self._gather_hidden_states(node_depths, nodes)),
+        }
+
+    def sample_sequence(self, seq_len, generator=None):
+        draws = self.sample_sequences(1, seq_len, generator)
+        depth = draws['depths'][0].item()
         if self.uses_attention:
-            # (seq_len, (num_layers, (2, (samps, heads, seq, shape))))
-            layer_hiddens = []
-            for seq_data in zip(*attns):
-                layer_data= list(zip(*seq_data))
-                layer_hiddens.append(
-                    (torch.cat(layer_data[0],dim=-2),
-                    torch.cat(layer_data[1],dim=-2)))
-
-            hidden_state = tuple(layer_hiddens)
-        else: hidden_state = cur_node.hidden_state
-        return log_p_total, log_q_total, hidden_state, depth, next_step, sample
+            hidden_state = self.path_hidden_states(draws['paths'][:, :depth])
+        else: hidden_state = _hidden_state_select(draws['hidden_states'], 0)
+        return (draws['log_p'][0], draws['log_q'][0], hidden_state, depth,
+                draws['last_tokens'][0], draws['samples'][0, :depth].tolist())
@@ -8,6 +8,7 @@ import yaml
 import pickle as pkl
 import json
 import ast
+import hashlib
 
 from datetime import datetime
 import torch.nn.functional as F
@@ -36,6 +37,52 @@ def _hidden_state_select(state,i,
             state = state[...,i,:]
     return state
 
+def _expand_rows(t, num_rows, dim):
+    # A single row is broadcast as a view, multiple rows are repeated in order
+    if t.shape[dim] == 1:
+        sizes = [-1]*t.dim(); sizes[dim] = num_rows
+        return t.expand(*sizes)
+    assert num_rows % t.shape[dim] == 0,\
+        f"Cannot expand {t.shape[dim]} rows to {num_rows} rows"
+    return t.repeat_interleave(num_rows // t.shape[dim], dim=dim)
+
+def _expand_hidden_state(state, num_rows):
+    """Expands the hidden state of one (or several) histories so that each
+    history is repeated num_rows // num_histories times. A single history
+    is broadcast without copying."""
+    if isinstance(state,tuple) and isinstance(state[0],tuple):
+        # (layers, (2, (samples, num_heads, seq_len, dim)))
+        return tuple([(_expand_rows(h1,num_rows,0), _expand_rows(h2,num_rows,0))
+                      for (h1,h2) in state])
+    elif isinstance(state, tuple):
+        # (2, (layers, samples, dim))
+        return tuple([_expand_rows(s,num_rows,1) for s in state])
+    return _expand_rows(state,num_rows,1)
+
+def _map_hidden_state(state, fn):
+    """Applies fn to every tensor of an RNN, LSTM or GPT-2 hidden state."""
+    if isinstance(state, tuple):
+        return tuple([_map_hidden_state(s, fn) for s in state])
+    return fn(state)
+
+def _cat_hidden_states(states):
+    """Concatenates a list of hidden states along their batch dimension."""
+    if isinstance(states[0],tuple) and isinstance(states[0][0],tuple):
+        return tuple([(torch.cat([s[l][0] for s in states],dim=0),
+                       torch.cat([s[l][1] for s in states],dim=0))
+                      for l in range(len(states[0]))])
+    elif isinstance(states[0], tuple):
+        return tuple([torch.cat(s,dim=1) for s in zip(*states)])
+    return torch.cat(states,dim=1)
+
+def _index_hidden_state(state, inds):
+    """Selects rows of a hidden state along its batch dimension."""
+    if isinstance(state,tuple) and isinstance(state[0],tuple):
+        return tuple([(h1[inds], h2[inds]) for (h1,h2) in state])
+    elif isinstance(state, tuple):
+        return tuple([s[:,inds] for s in state])
+    return state[:,inds]
+
 def _tup_cpu(tup, force=False):
     if isinstance(tup,tuple) and isinstance(tup[0],tuple):
         return _tup_cpu_gpt2(tup)
@@ -185,25 +232,61 @@ def flatten(list_of_lists):
 def min_variance_top_k(logits, min_var_reduction = 0.0,
                        filter_value=-float('Inf'),
                        is_log_prob=False,
-                       max_num_tree_beams=None):
-    num_logits = logits.shape[0]
-    probs, prob_inds = torch.sort(logits.exp(), descending=True)
-    global_var = probs.var()
-    local_vars = torch.Tensor([
-        (probs[:i].var(unbiased=False) + probs[i:].var(unbiased=False))
-        for i in range(1,min(num_logits,max_num_tree_beams)-1,1)
-    ])
-
-    min_idx = torch.argmin(local_vars)
-    min_sep_var = local_vars[min_idx]
-
-    # Satisfies variance criteria
-    if not max_num_tree_beams: max_num_tree_beams=min_idx
-    indices_to_remove = prob_inds[min(max_num_tree_beams,min_idx)+1:]
-    logits[indices_to_remove] = filter_value
-
-    return logits
-
+                       max_num_tree_beams=None,
+                       lengths=None):
+    """
+    Keeps the most probable entries of `logits` up to the split of the sorted
+    probabilities that minimizes the summed variance of both sides. Every split
+    is scored at once from prefix sums of p and p^2. `logits` may also be a batch
+    (queries x n), padded past the per-row `lengths`.
+    """
+    squeeze = logits.dim() == 1
+    if squeeze: logits = logits.unsqueeze(0)
+    num_rows, num_logits = logits.shape
+    if num_logits < 3:
+        return logits.squeeze(0) if squeeze else logits
+    if lengths is None:
+        lengths = torch.full((num_rows,), num_logits, dtype=torch.long, device=logits.device)
+    lengths = torch.as_tensor(lengths, dtype=torch.long, device=logits.device)
+    max_splits = lengths.clamp(max=max_num_tree_beams) if max_num_tree_beams else lengths
+
+    probs, prob_inds = torch.sort(logits.exp(), dim=-1, descending=True)
+    probs = probs.double()
+    zeros = torch.zeros((num_rows, 1), dtype=torch.float64, device=logits.device)
+    sums = torch.cat([zeros, probs.cumsum(dim=-1)], dim=-1)  # sums[:, i] = sum of first i
+    sq_sums = torch.cat([zeros, (probs**2).cumsum(dim=-1)], dim=-1)
+
+    # Biased variances of probs[:i] and probs[i:length] for splits 1 <= i < max_splits-1
+    splits = torch.arange(1, num_logits - 1, device=logits.device)
+    left_n, right_n = splits.double(), (lengths.unsqueeze(-1) - splits).double()
+    right_sums = sums.gather(-1, lengths.unsqueeze(-1)) - sums[:, splits]
+    right_sq_sums = sq_sums.gather(-1, lengths.unsqueeze(-1)) - sq_sums[:, splits]
+    local_vars = (sq_sums[:, splits] / left_n - (sums[:, splits] / left_n)**2 +
+                  right_sq_sums / right_n - (right_sums / right_n)**2)
+    local_vars = local_vars.masked_fill(splits >= (max_splits - 1).unsqueeze(-1), float('inf'))
+
+    # Keep everything before the best split (all entries if there is no valid split)
+    num_keep = torch.where(torch.isfinite(local_vars).any(dim=-1),
+                           torch.argmin(local_vars, dim=-1) + 1,
+                           torch.full_like(lengths, num_logits))
+
+    # Prefix sums can order near-ties differently from per-split float32 variances, so
+    # splits within a relative 1e-4 of the best are re-scored the way the per-split
+    # version did (two-pass .var() on the float32 probabilities), first minimum wins
+    best = local_vars.min(dim=-1, keepdim=True).values
+    near = torch.isfinite(local_vars) & (local_vars <= best + 1e-4 * best.abs() + 1e-12)
+    float_probs = probs.to(logits.dtype)
+    for row in (near.sum(dim=-1) > 1).nonzero().squeeze(-1).tolist():
+        candidates = near[row].nonzero().squeeze(-1) + 1
+        length = lengths[row].item()
+        scores = torch.stack([float_probs[row, :i].var(unbiased=False) + float_probs[row, i:length].var(unbiased=False)
+                              for i in candidates.tolist()])
+        num_keep[row] = candidates[torch.argmin(scores)]
+    sorted_to_remove = torch.arange(num_logits, device=logits.device) >= num_keep.unsqueeze(-1)
+    indices_to_remove = sorted_to_remove.scatter(-1, prob_inds, sorted_to_remove)
+    logits.masked_fill_(indices_to_remove, filter_value)
+
+    return logits.squeeze(0) if squeeze else logits
 
 
 def top_k_top_p_filtering(logits, top_k=0, top_p=0.0,min_var=False, filter_value=-float('Inf'), is_log_prob=False):
@@ -242,6 +325,38 @@ def top_k_top_p_filtering(logits, top_k=0, top_p=0.0,min_var=False, filter_value
 
     return logits  #.unsqueeze(0).unsqueeze(0)
 
+
+def select_frontier(logits, top_k=0, top_p=0.0, is_log_prob=False, init_k=1024):
+    """
+    Survivor indices (ascending) of a flat tensor of logits under the same rules as
+    top_k_top_p_filtering, without sorting the whole tensor. Top-k keeps everything
+    tied with the k-th largest value. Top-p only partially sorts the largest
+    entries, doubling how many until they cover top_p of the mass.
+    """
+    assert logits.dim() == 1
+    num_logits = logits.shape[0]
+    finite = logits != -float('inf')
+    top_k = min(top_k, num_logits)
+    if top_k > 0:
+        kth_value = torch.topk(logits, top_k, sorted=False)[0].min()
+        return ((logits >= kth_value) & finite).nonzero().squeeze(-1)
+
+    if top_p > 0.0:
+        log_norm = 0.0 if is_log_prob else torch.logsumexp(logits, dim=-1)
+        k = min(init_k, num_logits)
+        while True:
+            top_logits, top_inds = torch.topk(logits, k, sorted=True)
+            cumulative_probs = (top_logits - log_norm).exp().cumsum(dim=-1)
+            if cumulative_probs[-1] > top_p or k == num_logits:
+                break
+            k = min(2*k, num_logits)
+        # Keep up to and including the first token above the threshold
+        num_keep = 1 + (cumulative_probs[:-1] <= top_p).sum().item()
+        survivors = top_inds[:num_keep]
+        return torch.sort(survivors[finite[survivors]])[0]
+
+    return finite.nonzero().squeeze(-1)
+
 #######################################################################
 # Utilities for determining number of beam search beams with a budget
 #######################################################################
@@ -283,6 +398,23 @@ def _set_random_seed(seed):
         np.random.seed(seed)
         torch.manual_seed(seed)
 
+def query_generator(seed, dataset, query_index, estimator, device='cpu'):
+    """Independent torch.Generator of one (seed, dataset, query index, estimator), so a
+    query's samples do not depend on which queries ran before it or where. It lives on
+    `device`, so draws there never round trip through the host."""
+    key = "/".join([str(seed), str(dataset), str(query_index), str(estimator)])
+    generator = torch.Generator(device=device)
+    generator.manual_seed(int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], 'little') & (2**63 - 1))
+    return generator
+
+def sample_categorical(logits, generator=None):
+    """One draw per row of (unnormalized) log probabilities, (rows, 1). Draws come from
+    `generator` (on its own device) if given, otherwise from the global RNG."""
+    probs = torch.softmax(logits.float(), dim=-1)
+    if generator is None:
+        return torch.multinomial(probs, 1)
+    return torch.multinomial(probs.to(generator.device), 1, generator=generator).to(logits.device)
+
 def set_random_seed(args):
     """Set random seed for reproducibility."""
 
@@ -22,6 +22,7 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 
 from .utils import read_pkl, write_pkl
+from .results import read_results
 
 #################################################################################
 #   Function-Class Declaration
@@ -31,6 +32,11 @@ from .utils import read_pkl, write_pkl
 # Visualizations for Search v. Sample Scatter plots
 #######################################################################
 
+def _gather_terms(data, terms, *index):
+    """data[q, *index, terms[q]] for every query q, only reading those entries
+    when `data` is memory-mapped"""
+    terms = np.asarray(terms)
+    return np.asarray(data[(np.arange(terms.shape[0]),) + index + (terms,)])
 
 def plot_search_vs_sample_relative(gt_data_path, samp_data_path_imp, hist_len,seq_len, num_plots,
                           sample_sizes = None,samp_data_path_rand=None, shuffle = False,plot_cols=2,
@@ -40,23 +46,23 @@ def plot_search_vs_sample_relative(gt_data_path, samp_data_path_imp, hist_len,se
             .format(num_plots,plot_cols)
     title = "Number of samples: {}"
     fig, axs = plt.subplots(num_plots//plot_cols,plot_cols, figsize = (num_plots*3,plot_cols*6))
-    gt_data = read_pkl(gt_data_path)
-    samp_data_imp = read_pkl(samp_data_path_imp)
+    gt_data = read_results(gt_data_path)
+    samp_data_imp = read_results(samp_data_path_imp)
     if samp_data_path_rand:
-        samp_data_rand = read_pkl(samp_data_path_rand)
-    data_dict = {"gt_data":torch.gather(gt_data['dist_lower_bound'],1,gt_data['excluded_terms'].unsqueeze(-1)).squeeze(),
+        samp_data_rand = read_results(samp_data_path_rand)
+    excluded_terms = np.asarray(gt_data['excluded_terms'])
+    data_dict = {"gt_data":_gather_terms(gt_data['dist_lower_bound'],excluded_terms),
                  "imp_samp":samp_data_imp['sample_estimates'],
                  "hybrid_samp":None if not samp_data_path_rand else samp_data_rand['sample_estimates'],}
-    excluded_terms = gt_data['excluded_terms']
 
     for i in range(num_plots):
         ref = np.arange(0,1,0.01)
-        imp_vec =torch.gather(data_dict['imp_samp'][:,i],1,gt_data['excluded_terms'].unsqueeze(-1)).squeeze().numpy()
-        axs[i//plot_cols][i%plot_cols].scatter(data_dict['gt_data'].numpy(), imp_vec, color = "blue", label = "importance")
+        imp_vec =_gather_terms(data_dict['imp_samp'],excluded_terms,i)
+        axs[i//plot_cols][i%plot_cols].scatter(data_dict['gt_data'], imp_vec, color = "blue", label = "importance")
         axs[i//plot_cols][i%plot_cols].plot(list(ref),list(ref),linestyle="dashed", color = "red",linewidth=2)
         if samp_data_path_rand:
-            hybrid_vec =torch.gather(data_dict['hybrid_samp'][:,i],1,gt_data['excluded_terms'].unsqueeze(-1)).squeeze().numpy()
-            axs[i//plot_cols][i%plot_cols].scatter(data_dict['gt_data'].numpy(), hybrid_vec, color = "green", label = "hybrid")
+            hybrid_vec =_gather_terms(data_dict['hybrid_samp'],excluded_terms,i)
+            axs[i//plot_cols][i%plot_cols].scatter(data_dict['gt_data'], hybrid_vec, color = "green", label = "hybrid")
         axs[i//plot_cols][i%plot_cols].set_title(title.format(sample_sizes[i]))
         axs[i//plot_cols][i%plot_cols].legend()
         if ylim: axs[i//plot_cols][i%plot_cols].set_ylim(ylim)
@@ -73,11 +79,11 @@ def plot_search_vs_sample(gt_data_path, samp_data_path_imp, hist_len,seq_len, nu
             .format(num_plots,plot_cols)
     title = "Number of samples: {}"
     fig, axs = plt.subplots(num_plots//plot_cols,plot_cols, figsize = (num_plots*3,plot_cols*6))
-    gt_data = read_pkl(gt_data_path)
-    samp_data_imp = read_pkl(samp_data_path_imp)
+    gt_data = read_results(gt_data_path)
+    samp_data_imp = read_results(samp_data_path_imp)
     if samp_data_path_rand:
-        samp_data_rand = read_pkl(samp_data_path_rand)
-    data_dict = {"gt_data":torch.gather(gt_data['dist_lower_bound'],1,gt_data['excluded_terms'].unsqueeze(-1)).squeeze(),
+        samp_data_rand = read_results(samp_data_path_rand)
+    data_dict = {"gt_data":_gather_terms(gt_data['dist_lower_bound'],gt_data['excluded_terms']),
                  "imp_samp":samp_data_imp['sample_estimates'],
                  "rand_samp":None if not samp_data_path_rand else samp_data_rand['hybrid_bs_is_estimate'],}
 
@@ -102,8 +108,9 @@ def plot_entropy_variance(
     temperatures=[0.1,0.25,0.5,0.75,1,2,3,4,5,6,7,8,9,10,50,100],
     std = True,
  ):
-    data_dict = read_pkl(data_path)
-    logits = data_dict['logits']
+    data_dict = read_results(data_path)
+    logits = torch.from_numpy(np.array(data_dict['logits']))
+    excluded_tokens = torch.from_numpy(np.array(data_dict['excluded_tokens']))
     ref_probs = F.softmax(logits,dim=-1)
     sammples = defaultdict(dict)
     for t in temperatures:
@@ -112,8 +119,8 @@ def plot_entropy_variance(
         # (vocab)
         entropy_est_vocab = -((temp_probs/ref_probs)*torch.log(temp_probs)).sum(dim=1)
         # (seqs, 1)
-        entropy_est = torch.gather(entropy_est_vocab, 1, data_dict['excluded_tokens'].unsqueeze(0)).flatten()
-        variance = torch.gather(torch.var(temp_probs,dim=1),1,data_dict['excluded_tokens'].unsqueeze(0)).flatten()
+        entropy_est = torch.gather(entropy_est_vocab, 1, excluded_tokens.unsqueeze(0)).flatten()
+        variance = torch.gather(torch.var(temp_probs,dim=1),1,excluded_tokens.unsqueeze(0)).flatten()
         samples[t] = {"entropy":entropy_est, "variance": variance_est}
 
 
@@ -126,9 +133,9 @@ def plot_search_vs_sample_mae(
     title = "Error vs. Sample Sizes"
     fig, axs = plt.subplots(1, 2, figsize = (12, 5))
     fig.suptitle(title)
-    gt_data = read_pkl(gt_data_path)
-    samp_data_imp = read_pkl(samp_data_path_imp)
-    samp_data_rand = read_pkl(samp_data_path_rand)
+    gt_data = read_results(gt_data_path)
+    samp_data_imp = read_results(samp_data_path_imp)
+    samp_data_rand = read_results(samp_data_path_rand)
 
     ax = axs[0]
     total_samples = samp_data_imp.shape[1]
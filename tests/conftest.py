@@ -0,0 +1,21 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from seq_queries.model import CausalLM
+
+VOCAB_SIZE, HIDDEN_SIZE = 5, 8
+CHARS = ['<BOS>'] + [chr(ord('a') + i) for i in range(VOCAB_SIZE - 1)]
+TEXT_DICT = {"char_to_id": {c: i for i, c in enumerate(CHARS)},
+             "id_to_char": {i: c for i, c in enumerate(CHARS)}}
+
+
+def make_model(rnn_type="LSTM", num_layers=1, seed=0):
+    torch.manual_seed(seed)
+    rnn = getattr(nn, rnn_type)(VOCAB_SIZE, HIDDEN_SIZE, num_layers=num_layers, batch_first=True)
+    return CausalLM(vocab_size=VOCAB_SIZE, embed_dim=HIDDEN_SIZE, rnn=rnn).eval()
+
+
+@pytest.fixture
+def model():
+    return make_model()
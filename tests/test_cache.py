@@ -0,0 +1,87 @@
+import torch
+
+from seq_queries.cache import EstimateCache, HistoryPrefixTrie
+from seq_queries.sample import encode_hist
+
+
+class _Setting(object):
+
+    """Argument with no JSON form"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return f"_Setting({self.value})"
+
+
+def test_estimate_cache_keys_model_temperature(tmp_path, model):
+    cache = EstimateCache(str(tmp_path), 2**20)
+    hist = torch.tensor([1, 2, 3])
+    kwargs = {"seq_len": 3, "excluded_terms": [0]}
+
+    model.temperature = 0.5
+    first = cache.key(model, "mc_estimate", 0, hist, kwargs)
+    model.temperature = 2.0
+    second = cache.key(model, "mc_estimate", 0, hist, kwargs)
+    model.temperature = 0.5
+    assert first != second
+    assert first == cache.key(model, "mc_estimate", 0, hist, kwargs)
+
+
+def test_estimate_cache_keys_non_json_kwargs(tmp_path, model):
+    cache = EstimateCache(str(tmp_path), 2**20)
+    hist = torch.tensor([1, 2, 3])
+
+    first = cache.key(model, "mc_estimate", 0, hist, {"setting": _Setting(1)})
+    second = cache.key(model, "mc_estimate", 0, hist, {"setting": _Setting(2)})
+    assert first != second
+
+
+def test_estimate_cache_hits_and_evicts(tmp_path, model):
+    cache = EstimateCache(str(tmp_path), 2**20)
+    hist = torch.tensor([1, 2, 3])
+    key = cache.key(model, "mc_estimate", 0, hist, {"seq_len": 3})
+
+    assert cache.get(key) is None
+    cache.put(key, {"sample_estimates": torch.ones(5)})
+    assert torch.equal(cache.get(key)['sample_estimates'], torch.ones(5))
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # A warm cache reopened in a new session still holds the entry
+    assert EstimateCache(str(tmp_path), 2**20).get(key) is not None
+
+    cache.max_bytes = 0
+    other = cache.key(model, "mc_estimate", 1, hist, {"seq_len": 3})
+    cache.put(other, {"sample_estimates": torch.zeros(5)})
+    assert cache.get(key) is None and cache.evictions == 1
+
+
+@torch.no_grad()
+def test_prefix_trie_matches_uncached_encoding(model):
+    trie = HistoryPrefixTrie(2**20, checkpoint_lengths=[6])
+    hists = torch.tensor([[1, 2, 3, 4, 1, 2, 3, 4, 1],
+                          [1, 2, 3, 4, 1, 2, 4, 4, 1]])
+    for hist in hists:
+        cached = encode_hist(hist, model, prefix_cache=trie)
+        uncached = encode_hist(hist, model)
+        torch.testing.assert_close(cached['logits'], uncached['logits'])
+        torch.testing.assert_close(cached['rnn_args'], uncached['rnn_args'])
+
+    # The second history resumes from the declared length 6, not the power of two 4
+    assert trie.stats()['tokens_reused'] == 6
+    assert trie.stats()['tokens_wasted'] == 0
+
+
+@torch.no_grad()
+def test_prefix_trie_lookup_returns_copies(model):
+    trie = HistoryPrefixTrie(2**20)
+    hist = torch.tensor([1, 2, 3, 4])
+    expected = encode_hist(hist, model)
+    encode_hist(hist, model, prefix_cache=trie)
+    _, state = trie.lookup(hist)
+    state['rnn_args'][0].zero_()
+    state['logits'].zero_()
+    _, state = trie.lookup(hist)
+    torch.testing.assert_close(state['logits'], expected['logits'])
+    torch.testing.assert_close(state['rnn_args'], expected['rnn_args'])
@@ -0,0 +1,48 @@
+import pytest
+import torch
+
+from conftest import VOCAB_SIZE, make_model
+
+
+@pytest.mark.parametrize("rnn_type", ["RNN", "GRU", "LSTM"])
+@pytest.mark.parametrize("num_layers", [1, 2])
+@torch.no_grad()
+def test_embedding_lookup_matches_one_hot(rnn_type, num_layers):
+    model = make_model(rnn_type, num_layers)
+    src = torch.randint(0, VOCAB_SIZE, (4, 6))
+
+    model.embedding_lookup = False
+    one_hot = model(src)
+    model.embedding_lookup = True
+    lookup = model(src)
+    torch.testing.assert_close(lookup['logits'], one_hot['logits'])
+
+    # Continuing from a returned state, as next token sampling does
+    next_src = torch.randint(0, VOCAB_SIZE, (4, 1))
+    model.embedding_lookup = False
+    one_hot_next = model(next_src, one_hot['misc_output'])
+    model.embedding_lookup = True
+    lookup_next = model(next_src, lookup['misc_output'])
+    torch.testing.assert_close(lookup_next['logits'], one_hot_next['logits'])
+    torch.testing.assert_close(lookup_next['misc_output'], one_hot_next['misc_output'])
+
+
+@torch.no_grad()
+def test_embedding_lookup_follows_new_weights():
+    model = make_model("LSTM", 2)
+    src = torch.randint(0, VOCAB_SIZE, (4, 1))
+    model.embedding_lookup = True
+    model(src)
+
+    # A different RNN, then new parameter objects loaded into it
+    model.rnn = make_model("LSTM", 2, seed=1).rnn
+    model.embedding_lookup = False
+    one_hot = model(src)
+    model.embedding_lookup = True
+    torch.testing.assert_close(model(src)['logits'], one_hot['logits'])
+
+    model.load_state_dict(make_model("LSTM", 2, seed=2).state_dict(), assign=True)
+    model.embedding_lookup = False
+    one_hot = model(src)
+    model.embedding_lookup = True
+    torch.testing.assert_close(model(src)['logits'], one_hot['logits'])
@@ -0,0 +1,58 @@
+import numpy as np
+import torch
+
+from seq_queries.utils import write_pkl
+from seq_queries.results import write_columnar, read_results, convert_pkl, save_results, results_exist
+
+
+def _estimates():
+    return {
+        "sample_estimates": torch.rand(4, 3, 5),
+        "model_iters": torch.LongTensor([10, 20, 30, 40]),
+        "num_beams": [1, 2, 3, 4],
+        "ragged": [torch.rand(3), torch.rand(5)],
+        "prefix_cache_stats": {"hits": 2, "misses": 1},
+        "metadata": {"seed": 1234, "proposal_func": _estimates, "model": torch.nn.Linear(2, 2)},
+    }
+
+
+def _check_round_trip(results, estimates):
+    assert isinstance(results['sample_estimates'], np.memmap)
+    np.testing.assert_array_equal(results['sample_estimates'], estimates['sample_estimates'].numpy())
+    np.testing.assert_array_equal(results['model_iters'], estimates['model_iters'].numpy())
+    np.testing.assert_array_equal(results['num_beams'], np.array(estimates['num_beams']))
+    for read, written in zip(results['ragged'], estimates['ragged']):
+        assert torch.equal(read, written)
+    assert results['prefix_cache_stats'] == estimates['prefix_cache_stats']
+    # Functions are kept by name, objects with no JSON form are left out
+    assert results['metadata'] == {"seed": 1234, "proposal_func": "_estimates"}
+
+
+def test_columnar_round_trip(tmp_path):
+    estimates = _estimates()
+    path = str(tmp_path / "val-dl_run")
+    write_columnar(estimates, path)
+    _check_round_trip(read_results(path), estimates)
+
+
+def test_save_results_keeps_pkl_paths(tmp_path):
+    estimates = _estimates()
+    pkl_path = str(tmp_path / "val-dl_run.pkl")
+    assert not results_exist(pkl_path)
+    save_results(estimates, pkl_path)
+    assert results_exist(pkl_path)
+    _check_round_trip(read_results(pkl_path), estimates)
+
+
+def test_convert_pkl_round_trip(tmp_path):
+    estimates = _estimates()
+    del estimates['metadata']['model']
+    pkl_path = str(tmp_path / "val-dl_legacy.pkl")
+    write_pkl(estimates, pkl_path)
+
+    # Legacy pickles read whole, with tensors as arrays
+    legacy = read_results(pkl_path)
+    np.testing.assert_array_equal(legacy['sample_estimates'], estimates['sample_estimates'].numpy())
+
+    assert convert_pkl(pkl_path) == str(tmp_path / "val-dl_legacy")
+    _check_round_trip(read_results(pkl_path), estimates)
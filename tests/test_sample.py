@@ -0,0 +1,92 @@
+import itertools
+
+import torch
+
+from seq_queries.sample import (mc_estimate_batched, lm_proposal, uniform_proposal, beam_search_lower_bound,
+                                 tree_is_estimate_nr, exact_enumeration, enumerate_sequences, geom_interp)
+from seq_queries.tree import BeamSearchSampleTree
+
+from conftest import VOCAB_SIZE, TEXT_DICT
+
+
+def test_mc_estimate_batched_empty_exclusions(model):
+    # Hitting time (query_2) runs exclude nothing for every query
+    hists = torch.randint(1, VOCAB_SIZE, (3, 4))
+    for proposal_func in [lm_proposal, uniform_proposal]:
+        outputs = mc_estimate_batched(hists, num_mc_samples=8, seq_len=3, model=model,
+                                      excluded_terms=[[], [], []], proposal_func=proposal_func,
+                                      vocab_size=VOCAB_SIZE, batch_size=8, device='cpu', sub_estimates=[])
+        assert len(outputs) == 3
+        for output in outputs:
+            assert output['sample_estimates'].shape[-1] == VOCAB_SIZE
+            assert torch.isfinite(output['sample_estimates']).all()
+
+
+def test_mc_estimate_batched_charges_own_rows(model):
+    # 3 queries do not divide the packed row count evenly
+    hists = torch.randint(1, VOCAB_SIZE, (3, 4))
+    outputs = mc_estimate_batched(hists, num_mc_samples=5, seq_len=3, model=model,
+                                  excluded_terms=[[0], [1], [2]], proposal_func=lm_proposal,
+                                  vocab_size=VOCAB_SIZE, batch_size=5, device='cpu', sub_estimates=[])
+    for output in outputs:
+        assert output['model_iters'].item() == 5 * 3
+
+
+def _pruned_tree(model, hist, num_beams, seq_len, excluded_terms):
+    output = beam_search_lower_bound(hist, num_beams, seq_len, model, excluded_terms, geom_interp,
+                                     batch_size=64, device='cpu', vocab_size=VOCAB_SIZE,
+                                     bs_tree=BeamSearchSampleTree(TEXT_DICT))
+    output['tree'].prune()
+    return output
+
+
+@torch.no_grad()
+def test_tree_is_estimate_nr_unbiased(model):
+    # Small enough to enumerate, the HT estimates average to the mass the tree leaves out
+    hist, seq_len, excluded_terms, sub_estimates = torch.tensor([1, 2, 3]), 3, [0], [1, 2, 4, 8]
+    exact = exact_enumeration(hist, seq_len, model, excluded_terms, batch_size=64, device='cpu',
+                              vocab_size=VOCAB_SIZE)['bs_lower_bound'].double()
+    search = _pruned_tree(model, hist, 3, seq_len, excluded_terms)
+    leftover = exact - search['bs_lower_bound'].double()
+
+    estimates, model_iters = [], []
+    for seed in range(300):
+        model.model_iters = 0
+        output = tree_is_estimate_nr(search['tree'], search['bs_lower_bound'], max(sub_estimates), seq_len,
+                                     model, excluded_terms, batch_size=64, device='cpu',
+                                     sub_estimates=sub_estimates, generator=torch.Generator().manual_seed(seed))
+        estimates.append(output['is_estimates'].double())
+        model_iters.append(output['model_iters'])
+    estimates = torch.stack(estimates)  # (seeds x sub-estimates x vocab)
+    std_err = estimates.std(dim=0) / estimates.shape[0]**0.5
+    assert ((estimates.mean(dim=0) - leftover).abs() <= 5 * std_err + 1e-6).all()
+
+    for iters in model_iters:
+        assert (iters[1:] > iters[:-1]).all()
+
+
+@torch.no_grad()
+def test_exact_enumeration_matches_brute_force(model):
+    hist, seq_len, excluded_terms = torch.tensor([1, 2]), 3, [0, 3]
+    allowed = [t for t in range(VOCAB_SIZE) if t not in excluded_terms]
+
+    # Score every allowed sequence with a full forward pass over history + sequence
+    sequences = torch.tensor(list(itertools.product(allowed, repeat=seq_len)))
+    src = torch.cat((hist.expand(sequences.shape[0], -1), sequences), dim=-1)
+    log_probs = torch.log_softmax(model(src)['logits'], dim=-1).double()
+    seq_log_probs = torch.gather(log_probs[:, hist.shape[0]-1:-1], -1, sequences.unsqueeze(-1)).squeeze(-1).sum(dim=-1)
+    expected = (seq_log_probs.unsqueeze(-1) + log_probs[:, -1]).exp().sum(dim=0)
+
+    # Small chunks, so parents are split across model calls
+    leaves = [block for block in enumerate_sequences(hist, seq_len, model, batch_size=64, device='cpu',
+                                                     excluded_terms=excluded_terms, chunk_size=5)
+              if block['depth'] == seq_len]
+    assert torch.equal(torch.cat([block['sequences'] for block in leaves]), sequences)
+    torch.testing.assert_close(torch.cat([block['log_probs'] for block in leaves]).double(), seq_log_probs,
+                               rtol=1e-5, atol=1e-6)
+
+    output = exact_enumeration(hist, seq_len, model, excluded_terms, batch_size=64, device='cpu',
+                               vocab_size=VOCAB_SIZE, enumeration_chunk_size=5)
+    torch.testing.assert_close(output['bs_lower_bound'].double(), expected, rtol=1e-5, atol=1e-6)
+    torch.testing.assert_close(output['true_coverage'].double(), seq_log_probs.exp().sum(), rtol=1e-5, atol=1e-6)
+    assert output['num_beams_over_time'].tolist() == [len(allowed)**(i+1) for i in range(seq_len)]
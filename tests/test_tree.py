@@ -0,0 +1,103 @@
+import torch
+
+from seq_queries.tree import BeamSearchSampleTree
+
+from conftest import VOCAB_SIZE, HIDDEN_SIZE, TEXT_DICT
+
+
+def _conditionals(num_nodes, generator):
+    return torch.log_softmax(torch.randn(num_nodes, VOCAB_SIZE, generator=generator), dim=-1)
+
+
+def _states(num_nodes, generator):
+    return (torch.randn(1, num_nodes, HIDDEN_SIZE, generator=generator),
+            torch.randn(1, num_nodes, HIDDEN_SIZE, generator=generator))
+
+
+def _hand_built_tree():
+    # Root -> symbols 2 and 4 at depth 1, node 1 (symbol 4) -> complete beams 1 and 3 at depth 2
+    generator = torch.Generator().manual_seed(0)
+    tree = BeamSearchSampleTree(TEXT_DICT)
+    log_q = [_conditionals(1, generator), _conditionals(2, generator), _conditionals(2, generator)]
+    log_p = [_conditionals(1, generator), _conditionals(2, generator), _conditionals(2, generator)]
+    states = [_states(1, generator), _states(2, generator), _states(2, generator)]
+    parents = tree.add_root_node(log_q[0], log_p[0], states[0])
+    parents = tree.add_child_nodes(torch.tensor([2, 4]), parents, log_q[1], log_p[1], states[1],
+                                   torch.tensor([0, 0]), depth=1)
+    tree.add_child_nodes(torch.tensor([1, 3]), parents, log_q[2], log_p[2], states[2],
+                         torch.tensor([1, 1]), depth=2)
+    return tree, log_q, log_p, states
+
+
+def test_child_index_matches_hand_built_tree():
+    tree, _, _, _ = _hand_built_tree()
+    assert tree.child_index(0, torch.tensor([0, 0, 0]), torch.tensor([2, 4, 3])).tolist() == [0, 1, -1]
+    assert tree.child_index(1, torch.tensor([1, 1, 0, 1]), torch.tensor([1, 3, 1, 2])).tolist() == [0, 1, -1, -1]
+
+
+@torch.no_grad()
+def test_sample_sequences_follow_conditionals():
+    tree, log_q, log_p, states = _hand_built_tree()
+    tree.prune()
+
+    # Pruned q: the complete beams are left out of node 1, the root is reweighted by what is left
+    q_1 = log_q[1].exp()
+    q_1[1, [1, 3]] = 0
+    left = q_1.sum(dim=-1)
+    q_1 = q_1 / left.unsqueeze(-1)
+    q_0 = log_q[0].exp()[0]
+    q_0[[2, 4]] *= left
+    q_0 = q_0 / q_0.sum()
+
+    expected = {}
+    for a in range(VOCAB_SIZE):
+        if a in (2, 4):
+            node = [2, 4].index(a)
+            for b in range(VOCAB_SIZE):
+                expected[(a, b)] = (q_0[a] * q_1[node, b]).item()
+        else:
+            expected[(a,)] = q_0[a].item()
+
+    num_samples = 20000
+    draws = tree.sample_sequences(num_samples, 2, torch.Generator().manual_seed(1))
+    counts = {}
+    for sample, depth in zip(draws['samples'].tolist(), draws['depths'].tolist()):
+        counts[tuple(sample[:depth])] = counts.get(tuple(sample[:depth]), 0) + 1
+    assert set(counts) <= {key for key, prob in expected.items() if prob > 0}
+    for key, prob in expected.items():
+        tolerance = 4 * (prob * (1 - prob) / num_samples)**0.5 + 1e-3
+        assert abs(counts.get(key, 0) / num_samples - prob) <= tolerance
+
+    # Returned log q and log p are the sums of the per-node conditionals along each path
+    for i in range(1000):
+        a, depth = draws['samples'][i, 0].item(), draws['depths'][i].item()
+        exp_log_q, exp_log_p = q_0[a].log(), log_p[0][0, a]
+        if depth == 2:
+            node, b = [2, 4].index(a), draws['samples'][i, 1].item()
+            exp_log_q, exp_log_p = exp_log_q + q_1[node, b].log(), exp_log_p + log_p[1][node, b]
+            expected_state = tuple(s[:, node] for s in states[1])
+        else:
+            expected_state = tuple(s[:, 0] for s in states[0])
+        torch.testing.assert_close(draws['log_q'][i], exp_log_q, rtol=1e-5, atol=1e-5)
+        torch.testing.assert_close(draws['log_p'][i], exp_log_p)
+        torch.testing.assert_close(tuple(s[:, i] for s in draws['hidden_states']), expected_state)
+
+
+def test_path_hidden_states_match_hand_built_tree():
+    generator = torch.Generator().manual_seed(2)
+    tree = BeamSearchSampleTree(TEXT_DICT, uses_attention=True)
+    heads, dim, hist_len = 2, 3, 4
+    root_state = ((torch.randn(1, heads, hist_len, dim, generator=generator),
+                   torch.randn(1, heads, hist_len, dim, generator=generator)),)
+    child_state = ((torch.randn(2, heads, hist_len + 1, dim, generator=generator),
+                    torch.randn(2, heads, hist_len + 1, dim, generator=generator)),)
+    parents = tree.add_root_node(_conditionals(1, generator), _conditionals(1, generator), root_state)
+    tree.add_child_nodes(torch.tensor([2, 4]), parents, _conditionals(2, generator),
+                         _conditionals(2, generator), child_state, torch.tensor([0, 0]), depth=1)
+
+    # Each path is the root's cache followed by the newest position of each node on it
+    layers = tree.path_hidden_states(torch.tensor([[0, 1], [0, 0]]))
+    for k in range(2):
+        expected = torch.stack([torch.cat([root_state[0][k][0], child_state[0][k][node, :, -1:]], dim=-2)
+                                for node in [1, 0]])
+        assert torch.equal(layers[0][k], expected)
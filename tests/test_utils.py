@@ -0,0 +1,75 @@
+import pytest
+import torch
+
+from seq_queries.utils import min_variance_top_k, query_generator, sample_categorical
+
+
+def _min_variance_top_k_reference(logits, max_num_tree_beams, filter_value=-float('Inf')):
+    # The per-split list comprehension min_variance_top_k replaced
+    num_logits = logits.shape[0]
+    probs, prob_inds = torch.sort(logits.exp(), descending=True)
+    local_vars = torch.Tensor([
+        (probs[:i].var(unbiased=False) + probs[i:].var(unbiased=False))
+        for i in range(1, min(num_logits, max_num_tree_beams) - 1, 1)
+    ])
+    min_idx = torch.argmin(local_vars)
+    indices_to_remove = prob_inds[min(max_num_tree_beams, min_idx) + 1:]
+    logits[indices_to_remove] = filter_value
+    return logits
+
+
+def _frontier(num_logits, tied, generator):
+    if tied:
+        # Few distinct values, so many splits score the same
+        scores = torch.randint(0, 3, (num_logits,), generator=generator).float()
+    else:
+        scores = torch.randn(num_logits, generator=generator) * 3
+    return torch.log_softmax(scores, dim=-1)
+
+
+def _assert_same_selection(new, reference, tied):
+    kept, reference_kept = torch.isfinite(new), torch.isfinite(reference)
+    assert kept.sum() == reference_kept.sum()
+    if tied:
+        # Tied entries may sort in either order, so compare the kept values
+        assert torch.equal(new[kept].sort().values, reference[reference_kept].sort().values)
+    else:
+        assert torch.equal(kept, reference_kept)
+
+
+@pytest.mark.parametrize("tied", [False, True])
+def test_min_variance_top_k_matches_reference(tied):
+    generator = torch.Generator().manual_seed(0)
+    for num_logits in [4, 7, 20, 100]:
+        for max_num_tree_beams in [4, 10, 1000]:
+            for _ in range(20):
+                logits = _frontier(num_logits, tied, generator)
+                new = min_variance_top_k(logits.clone(), max_num_tree_beams=max_num_tree_beams)
+                reference = _min_variance_top_k_reference(logits.clone(), max_num_tree_beams)
+                _assert_same_selection(new, reference, tied)
+
+
+@pytest.mark.parametrize("tied", [False, True])
+def test_min_variance_top_k_batched_matches_reference(tied):
+    generator = torch.Generator().manual_seed(1)
+    num_logits, max_num_tree_beams = 30, 12
+    for _ in range(20):
+        lengths = torch.randint(4, num_logits + 1, (8,), generator=generator)
+        rows = [_frontier(length, tied, generator) for length in lengths.tolist()]
+        batch = torch.full((len(rows), num_logits), -float('Inf'))
+        for row, frontier in enumerate(rows):
+            batch[row, :len(frontier)] = frontier
+        new = min_variance_top_k(batch, max_num_tree_beams=max_num_tree_beams, lengths=lengths)
+        for row, frontier in enumerate(rows):
+            reference = _min_variance_top_k_reference(frontier.clone(), max_num_tree_beams)
+            assert not torch.isfinite(new[row, len(frontier):]).any()
+            _assert_same_selection(new[row, :len(frontier)], reference, tied)
+
+
+@pytest.mark.parametrize("device", ["cpu"] + (["cuda"] if torch.cuda.is_available() else []))
+def test_query_generator_draws_on_device(device):
+    logits = torch.randn(6, 5, device=device)
+    draws = [sample_categorical(logits, query_generator(1, "shakespeare", 3, "mc_estimate", device=device))
+             for _ in range(2)]
+    assert draws[0].device.type == device
+    assert torch.equal(draws[0], draws[1])